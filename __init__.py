@@ -21,14 +21,24 @@ bl_info = {
 classes = [
     ops.IMPORT_OT_cdcca,
     ops.IMPORT_OT_cdp3d,
+    ops.IMPORT_OT_cdp3d_reload,
+    ops.IMPORT_OT_cdp3d_clear_linked_cache,
+    ops.IMPORT_OT_cdp3d_library_refresh,
+    ops.IMPORT_OT_cdp3d_library_import,
+    ops.IMPORT_OT_cdtrk,
     ops.EXPORT_OT_cdcca,
     ops.EXPORT_OT_cdp3d,
     gui.MATERIAL_PT_p3d_material,
     gui.DATA_PT_p3d_light,
     gui.DATA_PT_p3d_mesh,
+    gui.VIEW3D_PT_p3d_report,
+    gui.VIEW3D_PT_p3d_source,
+    gui.VIEW3D_PT_p3d_library,
     props.CDP3DMaterialProps,
     props.CDP3DLightProps,
-    props.CDP3DMeshProps
+    props.CDP3DMeshProps,
+    props.CDP3DCollectionProps,
+    props.CDP3DLibraryProps
 ]
 
 # Add to a menu
@@ -40,22 +50,33 @@ def menu_func_export(self, context):
 def menu_func_import(self, context):
     self.layout.operator(ops.IMPORT_OT_cdp3d.bl_idname, text='Crashday Model (.p3d)')
     self.layout.operator(ops.IMPORT_OT_cdcca.bl_idname, text='Crashday Carinfo (.cca)')
+    self.layout.operator(ops.IMPORT_OT_cdtrk.bl_idname, text='Crashday Track (.trk)')
 
 
 def register():
+    ops.library.register()
+
     for cls in classes:
         bpy.utils.register_class(cls)
 
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
     bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
 
+    # checks source files of watched imported models
+    bpy.app.timers.register(ops.import_cdp3d.watch_models, persistent=True)
+
 
 def unregister():
+    if bpy.app.timers.is_registered(ops.import_cdp3d.watch_models):
+        bpy.app.timers.unregister(ops.import_cdp3d.watch_models)
+
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_export)
     bpy.types.TOPBAR_MT_file_export.remove(menu_func_import)
 
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
 
+    ops.library.unregister()
+
 if __name__ == '__main__':
     register()
\ No newline at end of file
@@ -0,0 +1,91 @@
+import numpy as np
+
+# Packing of small textures into atlases to reduce the amount of texture runs (draw calls).
+
+UV_EPSILON = 1e-4
+
+def get_texture_uv_ranges(meshes):
+    # returns texture name: (min uv, max uv) over every poly using that texture
+    ranges = {}
+    for m in meshes:
+        for pol in m.polys:
+            us = (pol.u1, pol.u2, pol.u3)
+            vs = (pol.v1, pol.v2, pol.v3)
+            low, high = ranges.get(pol.texture, (1.0, 0.0))
+            ranges[pol.texture] = (min(low, *us, *vs), max(high, *us, *vs))
+
+    return ranges
+
+def get_packable_textures(meshes, textures):
+    # only textures which are never tiled can be moved into an atlas
+    ranges = get_texture_uv_ranges(meshes)
+    return [tex for tex in textures if tex in ranges and
+            ranges[tex][0] >= -UV_EPSILON and ranges[tex][1] <= 1.0 + UV_EPSILON]
+
+def next_power_of_two(value):
+    size = 1
+    while size < value:
+        size *= 2
+    return size
+
+def pack_rects(sizes, atlas_size, padding=2):
+    '''Shelf packs (width, height) sizes into square atlases of atlas_size.
+    Returns (atlas index, x, y) for every size and the (width, height) of every atlas,
+    atlas heights are cut down to the used power of two'''
+    order = sorted(range(len(sizes)), key=lambda i: (sizes[i][1], sizes[i][0]), reverse=True)
+
+    placements = [None] * len(sizes)
+    atlases = []
+    atlas = -1
+    x = y = shelf_height = atlas_size
+    for i in order:
+        w = sizes[i][0] + padding * 2
+        h = sizes[i][1] + padding * 2
+        if w > atlas_size or h > atlas_size:
+            continue
+
+        if x + w > atlas_size:
+            # start a new shelf
+            x = 0
+            y += shelf_height
+            shelf_height = h
+        if y + h > atlas_size:
+            # start a new atlas
+            atlas += 1
+            atlases.append(0)
+            x = y = 0
+            shelf_height = h
+
+        placements[i] = (atlas, x + padding, y + padding)
+        atlases[atlas] = max(atlases[atlas], y + h)
+        x += w
+
+    return placements, [(atlas_size, next_power_of_two(height)) for height in atlases]
+
+def compose_atlas(size, images, placements, padding=2):
+    # images are (height, width, 4) float arrays with bottom row first like blender pixels
+    pixels = np.zeros((size[1], size[0], 4), dtype=np.float32)
+    for image, (atlas, x, y) in zip(images, placements):
+        h, w = image.shape[:2]
+        # repeat the edges of the image into padding, so filtering does not bleed
+        padded = np.pad(image, ((padding, padding), (padding, padding), (0, 0)), mode='edge')
+        pixels[y - padding:y + h + padding, x - padding:x + w + padding] = padded
+
+    return pixels
+
+def remap_polys(meshes, rects):
+    # rects is texture name: (atlas name, x, y, width, height, atlas width, atlas height)
+    for m in meshes:
+        for pol in m.polys:
+            rect = rects.get(pol.texture)
+            if rect is None:
+                continue
+
+            name, x, y, w, h, atlas_w, atlas_h = rect
+            pol.texture = name
+            pol.u1 = (x + pol.u1 * w) / atlas_w
+            pol.u2 = (x + pol.u2 * w) / atlas_w
+            pol.u3 = (x + pol.u3 * w) / atlas_w
+            pol.v1 = (y + pol.v1 * h) / atlas_h
+            pol.v2 = (y + pol.v2 * h) / atlas_h
+            pol.v3 = (y + pol.v3 * h) / atlas_h
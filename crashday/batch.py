@@ -0,0 +1,94 @@
+import copy
+
+import numpy as np
+
+from . import p3d
+from . import lod
+from . import split
+
+# Draw call batching, small static meshes with the same flags are merged into one mesh,
+# so a scene built from many props is drawn with a few submeshes instead of one per prop.
+
+EXCLUDED_FLAGS = p3d.DYNAMIC_FLAGS | lod.ALL_LOD_FLAGS | lod.MAIN_FLAGS
+EXCLUDED_NAMES = ('main', 'mainshad', 'maincoll')
+
+def can_batch(name, m, max_polys):
+    return (name not in EXCLUDED_NAMES and not m.flags & EXCLUDED_FLAGS and
+            0 < len(m.polys) <= max_polys and len(m.vertices) <= split.MAX_VERTICES)
+
+def merge_meshes(meshes, name, textures):
+    '''Merges meshes into one mesh with tight bounds, all meshes must have the same flags'''
+    vertices = np.concatenate([np.array([tuple(v) for v in m.vertices], dtype=np.float64).reshape(-1, 3) + np.array(tuple(m.pos))
+                               for m in meshes])
+    low = vertices.min(axis=0)
+    high = vertices.max(axis=0)
+    center = (low + high) / 2.0
+
+    merged = p3d.Mesh()
+    merged.name = name
+    merged.flags = meshes[0].flags
+    merged.pos = tuple(float(c) for c in center)
+    merged.length = float(high[0] - low[0])
+    merged.height = float(high[2] - low[2])
+    merged.depth = float(high[1] - low[1])
+    merged.vertices = [tuple(v) for v in (vertices - center).tolist()]
+    merged.num_vertices = len(merged.vertices)
+
+    merged.materials_used = []
+    merged.polys = []
+    offset = 0
+    for m in meshes:
+        for material_name in m.materials_used:
+            if material_name not in merged.materials_used:
+                merged.materials_used.append(material_name)
+        for pol in m.polys:
+            pol = copy.copy(pol)
+            pol.p1 += offset
+            pol.p2 += offset
+            pol.p3 += offset
+            merged.polys.append(pol)
+        offset += len(m.vertices)
+
+    merged.sort_polys(textures)
+    return merged
+
+def batch_meshes(named_meshes, textures, max_polys=4000, cell_size=20.0):
+    '''Merges small meshes with the same flags which are in the same horizontal cell of cell_size.
+    named_meshes is a list of (name, mesh), merged meshes are at most max_polys polys and get
+    batch_1, batch_2... names which no mesh uses yet. Returns the new list of (name, mesh) and (batch name, merged names) of every batch'''
+    result = []
+    merged_names = []
+    groups = {}
+    for name, m in named_meshes:
+        if not can_batch(name, m, max_polys):
+            result.append((name, m))
+            continue
+        cell = (int(np.floor(m.pos[0] / cell_size)), int(np.floor(m.pos[1] / cell_size)))
+        groups.setdefault((m.flags, cell), []).append((name, m))
+
+    # batch names already used by meshes of the model are skipped
+    used_names = {name for name, m in named_meshes} | {m.name for name, m in named_meshes}
+    count = 0
+    for key in sorted(groups):
+        batches = [[]]
+        polys = vertices = 0
+        for name, m in groups[key]:
+            if batches[-1] and (polys + len(m.polys) > max_polys or vertices + len(m.vertices) > split.MAX_VERTICES):
+                batches.append([])
+                polys = vertices = 0
+            batches[-1].append((name, m))
+            polys += len(m.polys)
+            vertices += len(m.vertices)
+
+        for members in batches:
+            if len(members) == 1:
+                result.append(members[0])
+                continue
+            count += 1
+            while 'batch_{}'.format(count) in used_names:
+                count += 1
+            merged = merge_meshes([m for name, m in members], 'batch_{}'.format(count), textures)
+            result.append((merged.name, merged))
+            merged_names.append((merged.name, [name for name, m in members]))
+
+    return result, merged_names
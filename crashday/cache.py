@@ -0,0 +1,52 @@
+import os
+import hashlib
+import tempfile
+
+# On-disk caches of the addon live in one folder in the temp directory,
+# every kind of cache uses its own subfolder.
+
+CACHE_FOLDER = 'cdp3d_cache'
+
+def get_cache_dir(*subfolders):
+    path = os.path.join(tempfile.gettempdir(), CACHE_FOLDER, *subfolders)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def get_file_key(path, *extra):
+    # files are identified by their path, size and modification time
+    st = os.stat(path)
+    key = '|'.join(str(i) for i in (os.path.abspath(path), st.st_size, st.st_mtime_ns) + extra)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def touch(path):
+    # marks a cache file as used, trim_cache removes the least recently used files first
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def trim_cache(folder, max_size, keep=()):
+    '''Removes least recently used files of a cache folder until it is at most max_size bytes.
+    Paths in keep are never removed. Returns the amount of removed files'''
+    files = []
+    total = 0
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+    removed = 0
+    keep = {os.path.normcase(os.path.abspath(path)) for path in keep}
+    for mtime, size, path in sorted(files):
+        if total <= max_size:
+            break
+        if os.path.normcase(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,140 @@
+import numpy as np
+
+from . import p3d
+
+# Geometry compaction of p3d meshes before polys are sorted into texture runs.
+# P3D stores uvs per polygon corner, so vertices only have to be split
+# where the game should not smooth over them.
+
+# triangles with a smaller doubled area are treated as degenerate
+DEGENERATE_AREA = 1e-10
+
+# offsets of a grid cell and its 26 neighbours
+NEIGHBOUR_CELLS = np.array([(x, y, z, 0) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)], dtype=np.int64)
+
+def get_row_keys(rows):
+    '''Returns rows of an int64 array as single comparable values'''
+    rows = np.ascontiguousarray(rows)
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+def weld_vertices(vertices, groups, weld_distance):
+    '''Returns the smallest vertex index every vertex is welded to. Vertices of the same group
+    are welded if they are at most weld_distance apart, also over chains of close vertices'''
+    num_vertices = len(vertices)
+    if weld_distance <= 0.0:
+        # adding 0.0 turns -0.0 into 0.0, so both have the same bits
+        keys = np.column_stack(((vertices + 0.0).view(np.int64), groups))
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        return first[inverse.reshape(-1)]
+
+    # close vertices are in the same or in a neighbouring cell, so only those are compared
+    cells = np.column_stack((np.floor(vertices / weld_distance).astype(np.int64), groups))
+    cell_keys = get_row_keys(cells)
+    order = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[order]
+
+    a_parts = []
+    b_parts = []
+    for offset in NEIGHBOUR_CELLS:
+        neighbour_keys = get_row_keys(cells + offset)
+        starts = np.searchsorted(sorted_keys, neighbour_keys, side='left')
+        counts = np.searchsorted(sorted_keys, neighbour_keys, side='right') - starts
+        a = np.repeat(np.arange(num_vertices), counts)
+        b = order[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        close = a < b
+        close[close] = ((vertices[a[close]] - vertices[b[close]]) ** 2).sum(axis=1) <= weld_distance ** 2
+        a_parts.append(a[close])
+        b_parts.append(b[close])
+    a = np.concatenate(a_parts)
+    b = np.concatenate(b_parts)
+
+    # every vertex takes the smallest vertex index of its cluster
+    labels = np.arange(num_vertices)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, a, labels[b])
+        np.minimum.at(new_labels, b, labels[a])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+def compact_mesh(m, weld_distance=0.0001, sharp_vertices=()):
+    '''Welds vertices, removes degenerate, duplicate polys and unused vertices of m in place.
+    Vertices used by smooth (gouraud) polys are never welded if they lie on a border
+    or on one of the sharp_vertices, because that is how hard edges are made in CD.
+    Returns a dict with the amount of removed elements'''
+    stats = {
+        'vertices': len(m.vertices),
+        'polys': len(m.polys),
+        'welded': 0,
+        'unused': 0,
+        'degenerate': 0,
+        'duplicate': 0,
+    }
+
+    num_vertices = len(m.vertices)
+    if num_vertices == 0 or len(m.polys) == 0:
+        return stats
+
+    vertices = np.array([tuple(v) for v in m.vertices], dtype=np.float64).reshape(-1, 3)
+    tris = np.array([(pol.p1, pol.p2, pol.p3) for pol in m.polys], dtype=np.int64).reshape(-1, 3)
+
+    smooth_polys = np.array([pol.material in p3d.SMOOTH_MATERIAL_TYPES for pol in m.polys], dtype=bool)
+    smooth_vertices = np.zeros(num_vertices, dtype=bool)
+    smooth_vertices[tris[smooth_polys].ravel()] = True
+
+    # edges used by a single triangle are left by splitting edges by hand or by EdgeSplit
+    edges = np.sort(tris[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    edges, edge_counts = np.unique(edges, axis=0, return_counts=True)
+
+    locked = np.zeros(num_vertices, dtype=bool)
+    locked[edges[edge_counts == 1].ravel()] = True
+    locked[np.asarray(sharp_vertices, dtype=np.int64)] = True
+    locked &= smooth_vertices
+
+    # weld vertices closer than weld_distance. Smooth and flat vertices are welded
+    # separately, so flat polys do not change the smoothing of gouraud ones
+    groups = np.where(locked, np.arange(num_vertices) + 2, smooth_vertices.astype(np.int64))
+    labels = weld_vertices(vertices, groups, weld_distance)
+    tris = labels[tris]
+    stats['welded'] = num_vertices - len(np.unique(labels))
+
+    # zero area polys are never visible
+    a = vertices[tris[:, 0]]
+    b = vertices[tris[:, 1]]
+    c = vertices[tris[:, 2]]
+    area = np.linalg.norm(np.cross(b - a, c - a), axis=1)
+    degenerate = ((tris[:, 0] == tris[:, 1]) | (tris[:, 1] == tris[:, 2]) |
+                  (tris[:, 2] == tris[:, 0]) | (area <= DEGENERATE_AREA))
+    stats['degenerate'] = int(degenerate.sum())
+
+    # duplicates use the same vertices with the same winding and the same texture run.
+    # rotate every triangle to start with its smallest index to compare them
+    runs = {}
+    run_ids = np.array([runs.setdefault((pol.texture, pol.material), len(runs)) for pol in m.polys], dtype=np.int64)
+    rotation = (np.argmin(tris, axis=1)[:, None] + np.arange(3)) % 3
+    keys = np.column_stack((np.take_along_axis(tris, rotation, axis=1), run_ids))
+
+    candidates = np.nonzero(~degenerate)[0]
+    _, first = np.unique(keys[candidates], axis=0, return_index=True)
+    keep = np.sort(candidates[first])
+    stats['duplicate'] = len(candidates) - len(keep)
+
+    # strip vertices which are not used by any of the remaining polys
+    used = np.unique(tris[keep].ravel())
+    stats['unused'] = num_vertices - stats['welded'] - len(used)
+
+    new_index = np.full(num_vertices, -1, dtype=np.int64)
+    new_index[used] = np.arange(len(used))
+    tris = new_index[tris[keep]]
+
+    m.vertices = [m.vertices[v] for v in used]
+    m.num_vertices = len(m.vertices)
+
+    m.polys = [m.polys[t] for t in keep]
+    for pol, tri in zip(m.polys, tris.tolist()):
+        pol.p1, pol.p2, pol.p3 = tri
+    m.num_polys = len(m.polys)
+
+    return stats
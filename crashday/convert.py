@@ -0,0 +1,569 @@
+import os
+import sys
+import json
+import struct
+import argparse
+import tempfile
+
+import numpy as np
+
+from . import p3d
+from . import split
+
+# Blender-free conversion between p3d and obj or binary gltf (.glb).
+# p3d models are read mesh by mesh when converting to obj or glb, so only one mesh is in memory.
+# Converting obj or glb to p3d loads the whole model, as p3d needs all textures before the first mesh.
+#
+# Usage from the addon folder:
+#   python -m crashday.convert model.p3d model.glb
+#   python -m crashday.convert models/*.p3d -o previews -f glb
+#   python -m crashday.convert model.obj model.p3d
+
+GLB_MAGIC = b'glTF'
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+COMPONENT_TYPES = {
+    5121: np.uint8,
+    5123: np.uint16,
+    5125: np.uint32,
+    5126: np.float32,
+}
+COMPONENT_COUNTS = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4}
+
+# p3d meshes use blender axes with z up, gltf and obj use y up
+def to_y_up(positions):
+    return np.column_stack((positions[:, 0], positions[:, 2], -positions[:, 1]))
+
+def from_y_up(positions):
+    return np.column_stack((positions[:, 0], -positions[:, 2], positions[:, 1]))
+
+def int_to_color(value):
+    return [((value >> 16) & 255)/255.0, ((value >> 8) & 255)/255.0, (value & 255)/255.0]
+
+def color_to_int(value):
+    return (int(round(value[0]*255)) << 16) | (int(round(value[1]*255)) << 8) | int(round(value[2]*255))
+
+def get_material_name(texture, material):
+    return '{} {}'.format(texture, material.lower())
+
+def split_material_name(name):
+    # inverse of get_material_name, unknown names are used as gouraud textures
+    texture, _, material = name.rpartition(' ')
+    if texture and material.upper() in p3d.MATERIAL_TYPES:
+        return texture, material.upper()
+    return name, 'GOURAUD'
+
+def get_runs(m, textures):
+    # yields (texture, material type, first poly, poly count) of every non-empty run
+    for tex, ti in zip(textures, m.texture_infos):
+        for material, start, count in ti.get_runs():
+            if count > 0:
+                yield tex, material, start, count
+
+def get_corner_vertices(tris, uvs):
+    # p3d stores uvs per corner, gltf and obj per vertex. Returns unique (vertex, uv)
+    # corners as vertex indices and uvs, and indices of corners for every triangle
+    keys = np.column_stack((tris.reshape(-1).astype(np.float64), uvs.reshape(-1, 2)))
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return tris.reshape(-1)[first], uvs.reshape(-1, 2)[first], inverse.reshape(-1)
+
+def make_mesh(name, flags, positions, tris, uvs, runs, is_main=False):
+    '''Creates a p3d mesh from world positions, runs are (texture, material type) of every triangle.
+    Mesh position is the center of its bounds, main mesh always stays at 0.0'''
+    m = p3d.Mesh()
+    m.name = name
+    m.flags = flags
+
+    if len(positions) > 0:
+        low = positions.min(axis=0)
+        high = positions.max(axis=0)
+    else:
+        low = high = np.zeros(3)
+    m.length, m.depth, m.height = (float(i) for i in high - low)
+
+    center = np.zeros(3) if is_main else (low + high) / 2.0
+    m.pos = [float(i) for i in center]
+    m.vertices = [tuple(v) for v in (positions - center).tolist()]
+    m.num_vertices = len(m.vertices)
+
+    for tri, uv, (tex, material) in zip(tris.tolist(), uvs.tolist(), runs):
+        pol = p3d.Polygon()
+        pol.texture = tex
+        pol.material = material
+        pol.p1, pol.p2, pol.p3 = tri
+        (pol.u1, pol.v1), (pol.u2, pol.v2), (pol.u3, pol.v3) = uv
+        m.polys.append(pol)
+
+    return m
+
+def finish_model(p, extras=None):
+    # fills textures, texture infos, counts and model bounds after meshes are added
+    p.textures = []
+    for m in p.meshes:
+        for pol in m.polys:
+            if pol.texture not in p.textures:
+                p.textures.append(pol.texture)
+    p.num_textures = len(p.textures)
+
+    for m in p.meshes:
+        m.sort_polys(p.textures)
+
+    p.num_meshes = len(p.meshes)
+    p.num_lights = len(p.lights)
+
+    if extras and 'length' in extras:
+        p.length, p.height, p.depth = extras['length'], extras['height'], extras['depth']
+    else:
+        main = next((m for m in p.meshes if m.name == 'main'), p.meshes[0] if p.meshes else None)
+        if main is not None:
+            p.length, p.height, p.depth = main.length, main.height, main.depth
+
+class GlbWriter:
+    '''Writes a binary gltf mesh by mesh. Binary data is streamed into a temporary file
+    and copied after the json chunk, because json has to know all buffer sizes'''
+    def __init__(self, file):
+        self.file = file
+        self.bin = tempfile.TemporaryFile()
+        self.bin_length = 0
+        self.materials = {}
+        self.lights = []
+        self.gltf = {
+            'asset': {'version': '2.0', 'generator': 'blender-p3d-import-export'},
+            'scene': 0,
+            'scenes': [{'nodes': []}],
+            'nodes': [],
+            'meshes': [],
+            'materials': [],
+            'accessors': [],
+            'bufferViews': [],
+        }
+
+    def add_view(self, data, target, stride=None):
+        data = data.tobytes()
+        view = {'buffer': 0, 'byteOffset': self.bin_length, 'byteLength': len(data), 'target': target}
+        if stride:
+            view['byteStride'] = stride
+        self.gltf['bufferViews'].append(view)
+
+        # every view is aligned to 4 bytes
+        self.bin.write(data + b'\x00' * (-len(data) % 4))
+        self.bin_length += len(data) + (-len(data) % 4)
+
+        return len(self.gltf['bufferViews']) - 1
+
+    def add_accessor(self, view, component_type, count, accessor_type, offset=0, low=None, high=None):
+        accessor = {'bufferView': view, 'byteOffset': offset, 'componentType': component_type,
+                    'count': count, 'type': accessor_type}
+        if low is not None:
+            accessor['min'] = low
+            accessor['max'] = high
+        self.gltf['accessors'].append(accessor)
+        return len(self.gltf['accessors']) - 1
+
+    def get_material(self, tex, material):
+        key = (tex, material)
+        if key not in self.materials:
+            metal = 'METAL' in material or material == 'SHINING'
+            self.gltf['materials'].append({
+                'name': get_material_name(tex, material),
+                'pbrMetallicRoughness': {'metallicFactor': 1.0 if metal else 0.0, 'roughnessFactor': 0.5 if metal else 0.9},
+                'extras': {'texture': tex, 'material_type': material},
+            })
+            self.materials[key] = len(self.gltf['materials']) - 1
+        return self.materials[key]
+
+    def add_mesh(self, m, textures):
+        positions, tris, uvs = split.get_mesh_arrays(m)
+
+        primitives = []
+        for tex, material, start, count in get_runs(m, textures):
+            vertices, corner_uvs, indices = get_corner_vertices(tris[start:start + count], uvs[start:start + count])
+
+            # one interleaved view with positions and uvs for every run
+            run_positions = to_y_up(positions[vertices]).astype(np.float32)
+            interleaved = np.empty((len(vertices), 5), dtype=np.float32)
+            interleaved[:, :3] = run_positions
+            interleaved[:, 3] = corner_uvs[:, 0]
+            # gltf uvs start at the top of the image
+            interleaved[:, 4] = 1.0 - corner_uvs[:, 1]
+            view = self.add_view(interleaved, ARRAY_BUFFER, stride=20)
+            position = self.add_accessor(view, 5126, len(vertices), 'VEC3',
+                                         low=run_positions.min(axis=0).tolist(), high=run_positions.max(axis=0).tolist())
+            texcoord = self.add_accessor(view, 5126, len(vertices), 'VEC2', offset=12)
+
+            if len(vertices) < 65536:
+                index_view = self.add_view(indices.astype(np.uint16), ELEMENT_ARRAY_BUFFER)
+                index_accessor = self.add_accessor(index_view, 5123, len(indices), 'SCALAR')
+            else:
+                index_view = self.add_view(indices.astype(np.uint32), ELEMENT_ARRAY_BUFFER)
+                index_accessor = self.add_accessor(index_view, 5125, len(indices), 'SCALAR')
+
+            primitives.append({
+                'attributes': {'POSITION': position, 'TEXCOORD_0': texcoord},
+                'indices': index_accessor,
+                'material': self.get_material(tex, material),
+            })
+
+        node = {'name': m.name, 'translation': to_y_up(np.array([m.pos], dtype=np.float64))[0].tolist(),
+                'extras': {'flags': m.flags}}
+        if primitives:
+            self.gltf['meshes'].append({'name': m.name, 'primitives': primitives})
+            node['mesh'] = len(self.gltf['meshes']) - 1
+
+        self.gltf['nodes'].append(node)
+        self.gltf['scenes'][0]['nodes'].append(len(self.gltf['nodes']) - 1)
+
+    def add_light(self, light):
+        self.lights.append({'name': light.name, 'type': 'point', 'color': int_to_color(light.color),
+                            'range': light.range})
+        self.gltf['nodes'].append({
+            'name': light.name,
+            'translation': to_y_up(np.array([light.pos], dtype=np.float64))[0].tolist(),
+            'extensions': {'KHR_lights_punctual': {'light': len(self.lights) - 1}},
+            'extras': {'corona': bool(light.show_corona), 'lens_flares': bool(light.show_lens_flares),
+                       'lightup_environment': bool(light.lightup_environment)},
+        })
+        self.gltf['scenes'][0]['nodes'].append(len(self.gltf['nodes']) - 1)
+
+    def close(self, p):
+        gltf = self.gltf
+        gltf['scenes'][0]['extras'] = {'length': p.length, 'height': p.height, 'depth': p.depth}
+        if self.lights:
+            gltf['extensionsUsed'] = ['KHR_lights_punctual']
+            gltf['extensions'] = {'KHR_lights_punctual': {'lights': self.lights}}
+        for key in ('meshes', 'materials', 'accessors', 'bufferViews'):
+            if not gltf[key]:
+                del gltf[key]
+        if self.bin_length:
+            gltf['buffers'] = [{'byteLength': self.bin_length}]
+
+        data = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+        data += b' ' * (-len(data) % 4)
+
+        length = 12 + 8 + len(data) + (8 + self.bin_length if self.bin_length else 0)
+        self.file.write(struct.pack('<4s2I', GLB_MAGIC, 2, length))
+        self.file.write(struct.pack('<2I', len(data), GLB_JSON_CHUNK))
+        self.file.write(data)
+
+        if self.bin_length:
+            self.file.write(struct.pack('<2I', self.bin_length, GLB_BIN_CHUNK))
+            self.bin.seek(0)
+            while True:
+                chunk = self.bin.read(1 << 20)
+                if not chunk:
+                    break
+                self.file.write(chunk)
+        self.bin.close()
+
+class ObjWriter:
+    '''Writes an obj and its mtl mesh by mesh. Mesh positions are applied to vertices,
+    p3d only data like flags and lights is stored in #p3d comments'''
+    def __init__(self, file, mtl_name):
+        self.file = file
+        self.mtl_name = mtl_name
+        self.materials = []
+        self.num_vertices = 0
+        self.num_uvs = 0
+        file.write('# blender-p3d-import-export\nmtllib {}\n'.format(mtl_name))
+
+    def add_mesh(self, m, textures):
+        positions, tris, uvs = split.get_mesh_arrays(m)
+        positions = to_y_up(positions + np.array(tuple(m.pos), dtype=np.float64))
+
+        f = self.file
+        f.write('o {}\n#p3d flags {}\n'.format(m.name, m.flags))
+        np.savetxt(f, positions, fmt='v %.6f %.6f %.6f')
+
+        for tex, material, start, count in get_runs(m, textures):
+            name = get_material_name(tex, material)
+            if name not in self.materials:
+                self.materials.append(name)
+
+            run_uvs, uv_index = np.unique(uvs[start:start + count].reshape(-1, 2), axis=0, return_inverse=True)
+            np.savetxt(f, run_uvs, fmt='vt %.6f %.6f')
+
+            faces = np.empty((count, 6), dtype=np.int64)
+            faces[:, 0::2] = tris[start:start + count] + self.num_vertices + 1
+            faces[:, 1::2] = uv_index.reshape(-1, 3) + self.num_uvs + 1
+            f.write('usemtl {}\n'.format(name))
+            np.savetxt(f, faces, fmt='f %d/%d %d/%d %d/%d')
+
+            self.num_uvs += len(run_uvs)
+
+        self.num_vertices += len(positions)
+
+    def add_light(self, light):
+        self.file.write('#p3d light {} {} {} {} {} {} {:d} {:d} {:d}\n'.format(
+            light.name, light.pos[0], light.pos[1], light.pos[2], light.range, light.color,
+            bool(light.show_corona), bool(light.show_lens_flares), bool(light.lightup_environment)))
+
+    def close(self, p):
+        self.file.write('#p3d size {} {} {}\n'.format(p.length, p.height, p.depth))
+
+    def write_mtl(self, file):
+        for name in self.materials:
+            tex, material = split_material_name(name)
+            file.write('newmtl {}\nKd 1.0 1.0 1.0\nmap_Kd {}.tga\n\n'.format(name, tex))
+
+def p3d_to_glb(src, dst):
+    with open(src, 'rb') as file, open(dst, 'wb') as out:
+        p = p3d.P3D()
+        p.read_header(file)
+
+        writer = GlbWriter(out)
+        for light in p.lights:
+            writer.add_light(light)
+        for m in p.read_meshes(file):
+            writer.add_mesh(m, p.textures)
+        writer.close(p)
+
+def p3d_to_obj(src, dst):
+    mtl_path = os.path.splitext(dst)[0] + '.mtl'
+    with open(src, 'rb') as file, open(dst, 'w') as out:
+        p = p3d.P3D()
+        p.read_header(file)
+
+        writer = ObjWriter(out, os.path.basename(mtl_path))
+        for light in p.lights:
+            writer.add_light(light)
+        for m in p.read_meshes(file):
+            writer.add_mesh(m, p.textures)
+        writer.close(p)
+
+    with open(mtl_path, 'w') as mtl:
+        writer.write_mtl(mtl)
+
+def read_accessor(gltf, data, index):
+    accessor = gltf['accessors'][index]
+    view = gltf['bufferViews'][accessor['bufferView']]
+    dtype = np.dtype(COMPONENT_TYPES[accessor['componentType']])
+    components = COMPONENT_COUNTS[accessor['type']]
+    stride = view.get('byteStride', dtype.itemsize * components)
+
+    values = np.ndarray((accessor['count'], components), dtype=dtype, buffer=data,
+                        offset=view.get('byteOffset', 0) + accessor.get('byteOffset', 0),
+                        strides=(stride, dtype.itemsize))
+    return values.copy()
+
+def glb_to_p3d(src, dst):
+    with open(src, 'rb') as file:
+        data = file.read()
+
+    magic, version, length = struct.unpack_from('<4s2I', data, 0)
+    if magic != GLB_MAGIC or version != 2:
+        raise ValueError('{} is not a binary gltf 2.0 file'.format(src))
+
+    gltf = None
+    bin_data = b''
+    offset = 12
+    while offset < length:
+        chunk_length, chunk_type = struct.unpack_from('<2I', data, offset)
+        chunk = data[offset + 8:offset + 8 + chunk_length]
+        if chunk_type == GLB_JSON_CHUNK:
+            gltf = json.loads(chunk)
+        elif chunk_type == GLB_BIN_CHUNK:
+            bin_data = chunk
+        offset += 8 + chunk_length
+
+    materials = []
+    for material in gltf.get('materials', []):
+        extras = material.get('extras', {})
+        if 'texture' in extras:
+            materials.append((extras['texture'], extras.get('material_type', 'GOURAUD')))
+        else:
+            materials.append(split_material_name(material.get('name', 'colwhite')))
+
+    lights = gltf.get('extensions', {}).get('KHR_lights_punctual', {}).get('lights', [])
+
+    p = p3d.P3D()
+    scene = gltf['scenes'][gltf.get('scene', 0)]
+    for node_index in scene['nodes']:
+        node = gltf['nodes'][node_index]
+        translation = from_y_up(np.array([node.get('translation', [0.0, 0.0, 0.0])], dtype=np.float64))[0]
+        extras = node.get('extras', {})
+
+        light_index = node.get('extensions', {}).get('KHR_lights_punctual', {}).get('light')
+        if light_index is not None:
+            light = p3d.Light()
+            light.name = node.get('name', lights[light_index].get('name', 'light'))
+            light.pos = translation.tolist()
+            light.range = lights[light_index].get('range', 1.0)
+            light.color = color_to_int(lights[light_index].get('color', [1.0, 1.0, 1.0]))
+            light.show_corona = extras.get('corona', True)
+            light.show_lens_flares = extras.get('lens_flares', True)
+            light.lightup_environment = extras.get('lightup_environment', True)
+            p.lights.append(light)
+            continue
+
+        if 'mesh' not in node:
+            continue
+
+        positions = []
+        tris = []
+        uvs = []
+        runs = []
+        num_vertices = 0
+        for primitive in gltf['meshes'][node['mesh']]['primitives']:
+            if primitive.get('mode', 4) != 4:
+                continue
+
+            primitive_positions = read_accessor(gltf, bin_data, primitive['attributes']['POSITION']).astype(np.float64)
+            if 'TEXCOORD_0' in primitive['attributes']:
+                primitive_uvs = read_accessor(gltf, bin_data, primitive['attributes']['TEXCOORD_0']).astype(np.float64)
+                primitive_uvs[:, 1] = 1.0 - primitive_uvs[:, 1]
+            else:
+                primitive_uvs = np.zeros((len(primitive_positions), 2))
+            if 'indices' in primitive:
+                indices = read_accessor(gltf, bin_data, primitive['indices']).reshape(-1, 3).astype(np.int64)
+            else:
+                indices = np.arange(len(primitive_positions), dtype=np.int64).reshape(-1, 3)
+
+            positions.append(from_y_up(primitive_positions) + translation)
+            tris.append(indices + num_vertices)
+            uvs.append(primitive_uvs[indices])
+            runs += [materials[primitive['material']] if 'material' in primitive else ('colwhite', 'GOURAUD')] * len(indices)
+            num_vertices += len(primitive_positions)
+
+        if not tris:
+            continue
+
+        # corners were split by uvs, weld them back so gouraud smoothing works
+        positions, inverse = np.unique(np.concatenate(positions), axis=0, return_inverse=True)
+        tris = inverse.reshape(-1)[np.concatenate(tris)]
+
+        name = node.get('name', 'mesh{}'.format(len(p.meshes)))
+        p.meshes.append(make_mesh(name, extras.get('flags', 2), positions, tris, np.concatenate(uvs), runs,
+                                  is_main=name == 'main'))
+
+    finish_model(p, scene.get('extras'))
+
+    with open(dst, 'wb') as file:
+        p.write(file)
+
+def obj_to_p3d(src, dst):
+    p = p3d.P3D()
+    positions = []
+    uvs = []
+    extras = None
+
+    name = None
+    flags = 2
+    faces = []
+    runs = []
+    run = ('colwhite', 'GOURAUD')
+
+    def add_mesh():
+        if not faces:
+            return
+        face_array = np.array(faces, dtype=np.int64).reshape(-1, 3, 2)
+        used, tris = np.unique(face_array[:, :, 0], return_inverse=True)
+        mesh_positions = from_y_up(np.array(positions, dtype=np.float64).reshape(-1, 3)[used])
+        if uvs:
+            corner_uvs = np.array(uvs, dtype=np.float64).reshape(-1, 2)[face_array[:, :, 1]]
+        else:
+            corner_uvs = np.zeros((len(face_array), 3, 2))
+        mesh_name = name or 'mesh{}'.format(len(p.meshes))
+        p.meshes.append(make_mesh(mesh_name, flags, mesh_positions, tris.reshape(-1, 3), corner_uvs, runs,
+                                  is_main=mesh_name == 'main'))
+
+    with open(src, 'r') as file:
+        for line in file:
+            values = line.split()
+            if not values:
+                continue
+
+            if values[0] == 'v':
+                positions.append([float(i) for i in values[1:4]])
+            elif values[0] == 'vt':
+                uvs.append([float(i) for i in values[1:3]])
+            elif values[0] == 'f':
+                corners = []
+                for corner in values[1:]:
+                    indices = corner.split('/')
+                    v = int(indices[0])
+                    v = v - 1 if v > 0 else len(positions) + v
+                    vt = 0
+                    if len(indices) > 1 and indices[1]:
+                        vt = int(indices[1])
+                        vt = vt - 1 if vt > 0 else len(uvs) + vt
+                    corners.append((v, vt))
+                # triangulate polygons as fans
+                for i in range(1, len(corners) - 1):
+                    faces.append((corners[0], corners[i], corners[i + 1]))
+                    runs.append(run)
+            elif values[0] == 'usemtl':
+                run = split_material_name(' '.join(values[1:]))
+            elif values[0] in ('o', 'g'):
+                add_mesh()
+                name = ' '.join(values[1:]) or None
+                flags = 2
+                faces = []
+                runs = []
+            elif values[0] == '#p3d' and len(values) > 1:
+                if values[1] == 'flags':
+                    flags = int(values[2])
+                elif values[1] == 'size':
+                    extras = {'length': float(values[2]), 'height': float(values[3]), 'depth': float(values[4])}
+                elif values[1] == 'light':
+                    light = p3d.Light()
+                    light.name = values[2]
+                    light.pos = [float(i) for i in values[3:6]]
+                    light.range = float(values[6])
+                    light.color = int(values[7])
+                    light.show_corona, light.show_lens_flares, light.lightup_environment = (int(i) for i in values[8:11])
+                    p.lights.append(light)
+
+    add_mesh()
+    finish_model(p, extras)
+
+    with open(dst, 'wb') as file:
+        p.write(file)
+
+CONVERTERS = {
+    ('.p3d', '.glb'): p3d_to_glb,
+    ('.p3d', '.obj'): p3d_to_obj,
+    ('.glb', '.p3d'): glb_to_p3d,
+    ('.obj', '.p3d'): obj_to_p3d,
+}
+
+def convert(src, dst):
+    key = (os.path.splitext(src)[1].lower(), os.path.splitext(dst)[1].lower())
+    converter = CONVERTERS.get(key)
+    if converter is None:
+        raise ValueError('Can\'t convert {} to {}'.format(*key))
+    converter(src, dst)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert Crashday p3d models to and from obj and glb without Blender.')
+    parser.add_argument('inputs', nargs='+', help='input files, the last one is the output file if -o is not used')
+    parser.add_argument('-o', '--output', help='output folder for converted files')
+    parser.add_argument('-f', '--format', default='glb', choices=('glb', 'obj', 'p3d'),
+                        help='output format when converting into a folder')
+    args = parser.parse_args(argv)
+
+    if args.output is None:
+        if len(args.inputs) != 2:
+            parser.error('use "convert input output" or "convert inputs... -o folder"')
+        jobs = [(args.inputs[0], args.inputs[1])]
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        jobs = [(src, os.path.join(args.output, os.path.splitext(os.path.basename(src))[0] + '.' + args.format))
+                for src in args.inputs]
+
+    failed = 0
+    for src, dst in jobs:
+        try:
+            convert(src, dst)
+            print('{} -> {}'.format(src, dst))
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            failed += 1
+            print('!!! Failed to convert {}: {}'.format(src, e), file=sys.stderr)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
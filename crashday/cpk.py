@@ -0,0 +1,97 @@
+import os
+import io
+import glob
+import json
+import zlib
+import struct
+import zipfile
+
+from . import cache
+
+# Crashday .cpk archives are zip files. Opening a zip parses its whole central directory,
+# which is slow for big archives, so entry offsets are cached on disk and entries are
+# read directly by offset.
+
+LOCAL_HEADER_FORMAT = '<4s5H3I2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+
+def normalise_name(name):
+    return name.replace('\\', '/').lstrip('/').lower()
+
+class CpkArchive:
+    def __init__(self, path):
+        self.path = path
+        # name: (local header offset, compressed size, size, compression method)
+        self.entries = {}
+        self.load_index()
+
+    def __str__(self):
+        return '{} ({} entries)'.format(self.path, len(self.entries))
+
+    def load_index(self):
+        index_path = os.path.join(cache.get_cache_dir('cpk'), cache.get_file_key(self.path) + '.json')
+        try:
+            with open(index_path, 'r') as file:
+                self.entries = {name: tuple(entry) for name, entry in json.load(file).items()}
+            return
+        except (OSError, ValueError):
+            pass
+
+        with zipfile.ZipFile(self.path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                self.entries[normalise_name(info.filename)] = (
+                    info.header_offset, info.compress_size, info.file_size, info.compress_type)
+
+        with open(index_path, 'w') as file:
+            json.dump(self.entries, file)
+
+    def find(self, name):
+        # entries are stored relative to data folder, but paths may include it
+        name = normalise_name(name)
+        if name in self.entries:
+            return name
+        if name.startswith('data/') and name[5:] in self.entries:
+            return name[5:]
+        return None
+
+    def read(self, name):
+        entry = self.find(name)
+        if entry is None:
+            raise KeyError('{} was not found in {}'.format(name, self.path))
+
+        offset, compressed_size, size, method = self.entries[entry]
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            header = struct.unpack(LOCAL_HEADER_FORMAT, file.read(LOCAL_HEADER_SIZE))
+            if header[0] != b'PK\x03\x04':
+                raise ValueError('Broken local header of {} in {}'.format(name, self.path))
+
+            name_length, extra_length = header[9], header[10]
+            file.seek(name_length + extra_length, os.SEEK_CUR)
+            data = file.read(compressed_size)
+
+        if method == zipfile.ZIP_STORED:
+            return data
+        if method == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15, size)
+
+        raise ValueError('Unsupported compression method {} of {} in {}'.format(method, name, self.path))
+
+    def open(self, name):
+        return io.BytesIO(self.read(name))
+
+# opened archives, so every archive index is loaded once per session
+archives = {}
+
+def get_archive(path):
+    path = os.path.abspath(path)
+    archive = archives.get(path)
+    if archive is None:
+        archive = CpkArchive(path)
+        archives[path] = archive
+    return archive
+
+def find_archives(folder):
+    return sorted(glob.glob(os.path.join(folder, '*.cpk')))
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import queue
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import http.server
+
+# Local conversion server keeping background Blender workers with the addon registered,
+# so build scripts don't pay Blender startup for every model.
+#
+# Start the server from the addon folder:
+#   python -m crashday.daemon serve --blender /path/to/blender --workers 4
+# and post jobs to it, the response streams log lines and the result as JSON lines:
+#   python -m crashday.daemon submit '{"type": "import", "input": "car.p3d", "output": "car.blend"}'
+#   python -m crashday.daemon submit '{"type": "export", "input": "car.blend", "collection": "car",
+#                                      "output": "car.p3d", "options": {"compact_geometry": true}}'
+
+DEFAULT_PORT = 8765
+RESULT_PREFIX = 'CDP3D_RESULT '
+# host names a local client uses to reach the server
+LOCAL_HOSTS = ('127.0.0.1', 'localhost')
+# seconds a job waits for an idle worker before it fails
+WORKER_WAIT = 600
+
+ADDON_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_SCRIPT = os.path.join(ADDON_FOLDER, 'ops', 'worker.py')
+
+class Worker:
+    '''Background Blender reading jobs from stdin, see ops/worker.py'''
+    def __init__(self, blender):
+        self.blender = blender
+        self.process = None
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [self.blender, '--background', '--factory-startup', '--python', WORKER_SCRIPT, '--', ADDON_FOLDER],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, bufsize=1)
+
+        # addon registration is done once, before the first job
+        for line in self.read_lines():
+            pass
+
+    def read_lines(self):
+        # yields log lines until a result line, which is stored in self.result
+        self.result = None
+        for line in self.process.stdout:
+            if line.startswith(RESULT_PREFIX):
+                self.result = json.loads(line[len(RESULT_PREFIX):])
+                return
+            yield line.rstrip('\n')
+
+        raise RuntimeError('Blender worker exited with code {}'.format(self.process.wait()))
+
+    def run(self, job):
+        '''Sends a job and yields its log lines, the result is in self.result afterwards'''
+        if self.process.poll() is not None:
+            self.start()
+
+        self.process.stdin.write(json.dumps(job) + '\n')
+        self.process.stdin.flush()
+        yield from self.read_lines()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+class WorkerPool:
+    def __init__(self, blender, count):
+        self.idle = queue.Queue()
+        self.workers = []
+        self.errors = []
+
+        # workers are started in parallel, startup is what the pool saves
+        threads = [threading.Thread(target=self.add_worker, args=(blender,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for error in self.errors:
+            print('! Blender worker failed to start: {}'.format(error))
+        if not self.workers:
+            raise RuntimeError('no Blender worker started: {}'.format(self.errors[0] if self.errors else 'no workers requested'))
+
+    def add_worker(self, blender):
+        try:
+            worker = Worker(blender)
+        except (OSError, RuntimeError, ValueError) as e:
+            self.errors.append(e)
+            return
+        self.workers.append(worker)
+        self.idle.put(worker)
+
+    def run(self, job):
+        # yields {'log': line} for every log line and {'result': result} at the end
+        try:
+            worker = self.idle.get(timeout=WORKER_WAIT)
+        except queue.Empty:
+            yield {'result': {'ok': False, 'error': 'no worker became idle in {} s'.format(WORKER_WAIT)}}
+            return
+
+        finished = False
+        try:
+            for line in worker.run(job):
+                yield {'log': line}
+            finished = True
+            yield {'result': worker.result}
+        except (OSError, RuntimeError) as e:
+            finished = True
+            yield {'result': {'ok': False, 'error': str(e)}}
+        finally:
+            # a client which disconnected leaves the rest of the job in the worker output,
+            # it is read away so the next job doesn't get it
+            if not finished:
+                try:
+                    for line in worker.read_lines():
+                        pass
+                except (OSError, RuntimeError):
+                    pass
+            self.idle.put(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+def make_handler(pool):
+    class JobHandler(http.server.BaseHTTPRequestHandler):
+        # responses are streamed and end when the connection is closed
+        protocol_version = 'HTTP/1.0'
+
+        def do_POST(self):
+            # browsers can post to local servers from any page, their requests carry an Origin header
+            # or a form content type. Host is checked against DNS rebinding to 127.0.0.1
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            host = self.headers.get('Host', '').rsplit(':', 1)[0].lower()
+            if 'Origin' in self.headers or host not in LOCAL_HOSTS:
+                self.send_error(403, 'jobs are only accepted from local scripts')
+                return
+            if content_type != 'application/json':
+                self.send_error(415, 'jobs must be posted as application/json')
+                return
+
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(job, dict) or job.get('type') not in ('import', 'export') or 'input' not in job:
+                    raise ValueError('job needs a type of import or export and an input')
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+
+            for message in pool.run(job):
+                self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+        def log_message(self, format, *args):
+            print('{} {}'.format(self.address_string(), format % args))
+
+    return JobHandler
+
+def serve(blender, workers, port):
+    print('Starting {} Blender workers'.format(workers))
+    try:
+        pool = WorkerPool(blender, workers)
+    except RuntimeError as e:
+        print('!!! Server was not started, {}'.format(e), file=sys.stderr)
+        return 1
+    print('Started {} of {} Blender workers'.format(len(pool.workers), workers))
+
+    # only local clients, jobs can read and write any file
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), make_handler(pool))
+    print('Serving on http://127.0.0.1:{}'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.stop()
+    return 0
+
+def submit(job, port=DEFAULT_PORT):
+    '''Posts a job to a running server and yields its messages'''
+    request = urllib.request.Request('http://127.0.0.1:{}/'.format(port), data=json.dumps(job).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            yield json.loads(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert models with a pool of warm background Blender workers.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve_parser = commands.add_parser('serve', help='start the server')
+    serve_parser.add_argument('--blender', default='blender', help='path to the Blender executable')
+    serve_parser.add_argument('-n', '--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                              help='amount of Blender workers')
+    serve_parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT)
+
+    submit_parser = commands.add_parser('submit', help='run a job on a running server')
+    submit_parser.add_argument('job', help='job as JSON')
+    submit_parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        return serve(args.blender, args.workers, args.port)
+
+    result = None
+    try:
+        for message in submit(json.loads(args.job), args.port):
+            if 'log' in message:
+                print(message['log'])
+            else:
+                result = message['result']
+    except urllib.error.HTTPError as e:
+        print('!!! Job was rejected: {}'.format(e.reason), file=sys.stderr)
+        return 1
+    except urllib.error.URLError as e:
+        print('!!! Server is not running on port {}: {}'.format(args.port, e.reason), file=sys.stderr)
+        return 1
+
+    print(json.dumps(result))
+    return 0 if result and result.get('ok') else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import os
+import sys
+import glob
+import struct
+import hashlib
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+from . import thumbnail
+
+# DXT compressed .dds textures with a full mip chain. Opaque textures use DXT1 (BC1), textures with
+# alpha use DXT5 (BC3). Blocks of every mip level are encoded together as arrays.
+# The hash of the source image is stored in the reserved part of the header, so unchanged
+# textures are not encoded again.
+#
+# Usage from the addon folder:
+#   python -m crashday.dds "mods/mymod/textures/*.tga"
+#   python -m crashday.dds source/*.tga -o mods/mymod/textures
+
+HEADER_FORMAT = '<4s7I44s32s5I'
+# caps, height, width, pixel format, mipmap count and linear size
+HEADER_FLAGS = 0x1 | 0x2 | 0x4 | 0x1000 | 0x20000 | 0x80000
+# complex, texture and mipmap
+HEADER_CAPS = 0x8 | 0x1000 | 0x400000
+PIXEL_FORMAT_FOURCC = 0x4
+# tag of the source hash in reserved header bytes, changing it encodes every texture again
+HASH_TAG = b'CDH1'
+# blocks encoded at once, limits memory used by distance arrays
+BATCH_BLOCKS = 1 << 14
+
+def make_mips(image):
+    '''Returns the mip chain of a (height, width, 4) uint8 image down to 1x1, made with a 2x2 box filter'''
+    levels = [image]
+    while image.shape[0] > 1 or image.shape[1] > 1:
+        f = image.astype(np.float32)
+        if f.shape[0] > 1:
+            f = f[:f.shape[0] // 2 * 2]
+            f = (f[0::2] + f[1::2]) / 2.0
+        if f.shape[1] > 1:
+            f = f[:, :f.shape[1] // 2 * 2]
+            f = (f[:, 0::2] + f[:, 1::2]) / 2.0
+        image = np.floor(f + 0.5).astype(np.uint8)
+        levels.append(image)
+    return levels
+
+def get_blocks(image):
+    # (blocks, 16, 4) pixels of 4x4 blocks in row order, edges are repeated to fill partial blocks
+    h, w = image.shape[:2]
+    image = np.pad(image, ((0, -h % 4), (0, -w % 4), (0, 0)), mode='edge')
+    bh, bw = image.shape[0] // 4, image.shape[1] // 4
+    return image.reshape(bh, 4, bw, 4, 4).transpose(0, 2, 1, 3, 4).reshape(-1, 16, 4)
+
+def to_565(colors):
+    c = np.floor(colors * np.array((31.0, 63.0, 31.0)) / 255.0 + 0.5).astype(np.uint16)
+    return (c[..., 0] << 11) | (c[..., 1] << 5) | c[..., 2]
+
+def from_565(values):
+    r = (values >> 11) & 31
+    g = (values >> 5) & 63
+    b = values & 31
+    return np.stack(((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)), axis=-1).astype(np.float32)
+
+def encode_colors(blocks):
+    '''Encodes (blocks, 16, 3) colors into (blocks, 8) uint8 BC1 color blocks. Endpoints are the
+    extreme colors along the principal axis of every block'''
+    n = len(blocks)
+    colors = blocks.astype(np.float32)
+    centered = colors - colors.mean(axis=1, keepdims=True)
+    covariance = np.einsum('nki,nkj->nij', centered, centered)
+
+    axis = np.ones((n, 3), dtype=np.float32)
+    for i in range(8):
+        axis = np.einsum('nij,nj->ni', covariance, axis)
+        length = np.linalg.norm(axis, axis=1, keepdims=True)
+        axis = np.where(length > 1e-6, axis / np.maximum(length, 1e-6), np.float32(0.57735))
+
+    projection = np.einsum('nki,ni->nk', centered, axis)
+    rows = np.arange(n)
+    c0 = to_565(colors[rows, projection.argmax(axis=1)])
+    c1 = to_565(colors[rows, projection.argmin(axis=1)])
+
+    # four color mode needs c0 > c1
+    swap = c0 < c1
+    c0, c1 = np.where(swap, c1, c0), np.where(swap, c0, c1)
+
+    p0 = from_565(c0)
+    p1 = from_565(c1)
+    palette = np.stack((p0, p1, (2.0 * p0 + p1) / 3.0, (p0 + 2.0 * p1) / 3.0), axis=1)
+    distances = ((colors[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=-1)
+    indices = distances.argmin(axis=2).astype(np.uint32)
+    indices[c0 == c1] = 0
+
+    packed = (indices << (2 * np.arange(16, dtype=np.uint32))).sum(axis=1, dtype=np.uint32)
+
+    out = np.empty((n, 8), dtype=np.uint8)
+    out[:, 0:2] = c0.astype('<u2').view(np.uint8).reshape(n, 2)
+    out[:, 2:4] = c1.astype('<u2').view(np.uint8).reshape(n, 2)
+    out[:, 4:8] = packed.astype('<u4').view(np.uint8).reshape(n, 4)
+    return out
+
+def encode_alpha(alpha):
+    '''Encodes (blocks, 16) alpha values into (blocks, 8) uint8 BC3 alpha blocks'''
+    n = len(alpha)
+    a = alpha.astype(np.float32)
+    a0 = alpha.max(axis=1)
+    a1 = alpha.min(axis=1)
+
+    # eight value mode, a0 > a1
+    weights = np.array([(7 - i) / 7.0 for i in range(8)], dtype=np.float32)
+    order = np.array((0, 7, 1, 2, 3, 4, 5, 6))
+    palette = a0[:, None] * weights[order] + a1[:, None] * (1.0 - weights[order])
+    indices = np.abs(a[:, :, None] - palette[:, None, :]).argmin(axis=2).astype(np.uint64)
+    indices[a0 == a1] = 0
+
+    packed = (indices << (3 * np.arange(16, dtype=np.uint64))).sum(axis=1, dtype=np.uint64)
+
+    out = np.empty((n, 8), dtype=np.uint8)
+    out[:, 0] = a0
+    out[:, 1] = a1
+    out[:, 2:8] = packed.astype('<u8').view(np.uint8).reshape(n, 8)[:, :6]
+    return out
+
+def encode_level(image, use_alpha):
+    blocks = get_blocks(image)
+    parts = []
+    for start in range(0, len(blocks), BATCH_BLOCKS):
+        batch = blocks[start:start + BATCH_BLOCKS]
+        colors = encode_colors(batch[:, :, :3])
+        parts.append(np.concatenate((encode_alpha(batch[:, :, 3]), colors), axis=1) if use_alpha else colors)
+    return np.concatenate(parts).tobytes()
+
+def make_header(width, height, levels, use_alpha, source_hash):
+    block_size = 16 if use_alpha else 8
+    linear_size = max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * block_size
+    reserved = HASH_TAG + bytes.fromhex(source_hash)
+    pixel_format = struct.pack('<2I4s5I', 32, PIXEL_FORMAT_FOURCC, b'DXT5' if use_alpha else b'DXT1', 0, 0, 0, 0, 0)
+    return struct.pack(HEADER_FORMAT, b'DDS ', 124, HEADER_FLAGS, height, width, linear_size, 0, levels,
+                       reserved, pixel_format, HEADER_CAPS, 0, 0, 0, 0)
+
+def read_source_hash(path):
+    # returns the source hash stored in a .dds written by this module, or None
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(struct.calcsize(HEADER_FORMAT))
+    except OSError:
+        return None
+    if len(header) < struct.calcsize(HEADER_FORMAT) or header[:4] != b'DDS ':
+        return None
+    reserved = struct.unpack(HEADER_FORMAT, header)[8]
+    if reserved[:len(HASH_TAG)] != HASH_TAG:
+        return None
+    return reserved[len(HASH_TAG):len(HASH_TAG) + 20].hex()
+
+def get_output_path(source, folder=None):
+    name = os.path.splitext(os.path.basename(source))[0] + '.dds'
+    return os.path.join(folder if folder else os.path.dirname(source), name)
+
+def convert_texture(source, output, force=False):
+    '''Writes a .tga texture as .dds. Returns 'written', 'unchanged' or an error message'''
+    try:
+        with open(source, 'rb') as file:
+            source_hash = hashlib.sha1(file.read()).hexdigest()
+        if not force and read_source_hash(output) == source_hash:
+            return 'unchanged'
+
+        image = thumbnail.read_tga(source)
+        if image is None:
+            return 'unsupported image'
+
+        use_alpha = bool((image[:, :, 3] < 255).any())
+        levels = make_mips(image)
+        data = [make_header(image.shape[1], image.shape[0], len(levels), use_alpha, source_hash)]
+        data += [encode_level(level, use_alpha) for level in levels]
+
+        # written under a temporary name, so the game never sees a half written file
+        temp_path = output + '.{}.tmp'.format(os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(b''.join(data))
+        os.replace(temp_path, output)
+        return 'written'
+    except OSError as e:
+        return str(e)
+
+def convert_textures(sources, outputs, force=False, max_workers=None):
+    # returns results in the order of sources, textures are encoded on a process pool
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(convert_texture, sources, outputs, [force] * len(sources)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert .tga textures into DXT compressed .dds textures with mipmaps.')
+    parser.add_argument('inputs', nargs='+', help='.tga files or glob patterns, ** matches subfolders')
+    parser.add_argument('-o', '--output', default=None, help='output folder, default is the folder of every texture')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='amount of worker processes')
+    parser.add_argument('-f', '--force', action='store_true', help='convert textures even if they did not change')
+    args = parser.parse_args(argv)
+
+    sources = []
+    for pattern in args.inputs:
+        sources += sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    outputs = [get_output_path(source, args.output) for source in sources]
+
+    failed = 0
+    for source, output, result in zip(sources, outputs, convert_textures(sources, outputs, args.force, args.jobs)):
+        if result not in ('written', 'unchanged'):
+            failed += 1
+            print('!!! {}: {}'.format(source, result))
+        else:
+            print('{} -> {} {}'.format(source, output, result))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import math
+
+import numpy as np
+
+# Vertex splitting for hard edges. CD computes smooth normals per vertex, so a hard edge needs
+# separate vertices on both sides of it. Loops around every vertex are grouped into fans connected
+# over smooth edges and every fan gets its own vertex, which is the least amount of vertices
+# giving exactly the hard edges of the mesh.
+
+def get_loop_polys(loop_starts, loop_totals):
+    '''Returns the poly of every loop and the next loop of the same poly'''
+    polys = np.repeat(np.arange(len(loop_starts)), loop_totals)
+    starts = loop_starts[polys]
+    totals = loop_totals[polys]
+    next_loops = starts + (np.arange(len(polys)) - starts + 1) % totals
+    return polys, next_loops
+
+def get_angle_sharp_edges(loop_edges, loop_polys, poly_normals, num_edges, angle):
+    '''Returns a bool array of edges between polys meeting at more than angle radians.
+    Edges used by more than two polys are always sharp'''
+    counts = np.bincount(loop_edges, minlength=num_edges)
+    order = np.argsort(loop_edges, kind='stable')
+    first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    sharp = counts > 2
+    manifold = np.flatnonzero(counts == 2)
+    p1 = loop_polys[order[first[manifold]]]
+    p2 = loop_polys[order[first[manifold] + 1]]
+    cosines = (poly_normals[p1] * poly_normals[p2]).sum(axis=1)
+    sharp[manifold] = cosines < math.cos(angle)
+    return sharp
+
+def split_vertices(loop_vertices, loop_edges, next_loops, sharp_edges):
+    '''Returns the new vertex of every loop and the original vertex of every new vertex,
+    after splitting vertices along sharp_edges, a bool array of edges'''
+    num_loops = len(loop_vertices)
+
+    # every loop touches its edge at its own vertex and at the vertex of the next loop
+    ends_loop = np.concatenate((np.arange(num_loops), next_loops))
+    ends_edge = np.concatenate((loop_edges, loop_edges))
+    smooth = ~sharp_edges[ends_edge]
+    ends_loop = ends_loop[smooth]
+    ends_edge = ends_edge[smooth]
+    ends_vertex = loop_vertices[ends_loop]
+
+    # loops at the same vertex of the same smooth edge are in one fan
+    keys = ends_edge.astype(np.int64) * (int(loop_vertices.max(initial=0)) + 1) + ends_vertex
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    ends_loop = ends_loop[order]
+    same = keys[1:] == keys[:-1]
+    a = ends_loop[:-1][same]
+    b = ends_loop[1:][same]
+
+    # every loop takes the smallest loop index of its fan, fans are small so this ends quickly
+    labels = np.arange(num_loops)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, a, labels[b])
+        np.minimum.at(new_labels, b, labels[a])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    fans, loop_new_vertices = np.unique(labels, return_inverse=True)
+    return loop_new_vertices.ravel(), loop_vertices[fans]
@@ -0,0 +1,282 @@
+import sys
+import copy
+import heapq
+import pickle
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+from . import p3d
+
+# Level of detail generation for p3d meshes using quadric edge collapse decimation.
+# Decimation is pure python, so levels are generated on a process pool. Blender's python
+# can't start it for addon modules, the exporter runs it from the addon folder instead:
+#   python -m crashday.lod meshes.pickle levels.pickle
+# Meshes are passed as plain data, see get_mesh_data.
+
+# flags of generated levels, main mesh uses LOD flags, other meshes use SUB flags
+LOD_FLAGS = {level: p3d.get_flag_mask(('LOD{}'.format(level),)) for level in (2, 3, 4)}
+SUB_LOD_FLAGS = {level: p3d.get_flag_mask(('SUB{}'.format(level),)) for level in (2, 3, 4)}
+NOLOD_FLAG = p3d.get_flag_mask(('NOLOD',))
+ALL_LOD_FLAGS = p3d.get_flag_mask(('NOLOD', 'LOD0', 'LOD2', 'LOD3', 'LOD4', 'SUB0', 'SUB2', 'SUB3', 'SUB4'))
+# main, tracing and collision flags, there can only be one mesh with them
+MAIN_FLAGS = p3d.MAIN_FLAG | p3d.TRACE_FLAG | p3d.COLLISION_FLAG
+
+UV_EPSILON = 1e-6
+POLY_FIELDS = ('p1', 'u1', 'v1', 'p2', 'u2', 'v2', 'p3', 'u3', 'v3', 'texture', 'material')
+
+def sub(a, b):
+    return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+def cross(a, b):
+    return (a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0])
+
+def dot(a, b):
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+def calc_quadrics(positions, tris):
+    # area weighted sum of plane quadrics of the triangles around every vertex
+    a = positions[tris[:, 0]]
+    normals = np.cross(positions[tris[:, 1]] - a, positions[tris[:, 2]] - a)
+    areas = np.linalg.norm(normals, axis=1)
+    normals /= np.maximum(areas, 1e-20)[:, None]
+
+    planes = np.column_stack((normals, -np.einsum('ij,ij->i', normals, a)))
+    face_quadrics = planes[:, :, None] * planes[:, None, :] * areas[:, None, None]
+
+    quadrics = np.zeros((len(positions), 4, 4))
+    for k in range(3):
+        np.add.at(quadrics, tris[:, k], face_quadrics)
+
+    return quadrics
+
+def get_locked_vertices(tris, uvs, runs, num_vertices):
+    # vertices on borders, uv seams and between material runs are never moved
+    locked = [False] * num_vertices
+
+    edge_count = {}
+    for tri in tris:
+        for a, b in ((tri[0], tri[1]), (tri[1], tri[2]), (tri[2], tri[0])):
+            key = (a, b) if a < b else (b, a)
+            edge_count[key] = edge_count.get(key, 0) + 1
+
+    for (a, b), count in edge_count.items():
+        if count != 2:
+            locked[a] = True
+            locked[b] = True
+
+    vertex_runs = [None] * num_vertices
+    vertex_uvs = [None] * num_vertices
+    for t, tri in enumerate(tris):
+        for k, v in enumerate(tri):
+            if vertex_runs[v] is None:
+                vertex_runs[v] = runs[t]
+                vertex_uvs[v] = uvs[t][k]
+                continue
+
+            if vertex_runs[v] != runs[t]:
+                locked[v] = True
+
+            uv = uvs[t][k]
+            if abs(uv[0] - vertex_uvs[v][0]) > UV_EPSILON or abs(uv[1] - vertex_uvs[v][1]) > UV_EPSILON:
+                locked[v] = True
+
+    return locked, list(edge_count)
+
+def decimate(vertices, polys, target_polys):
+    '''Decimates polys with half-edge collapses ordered by quadric error.
+    Returns new vertices and copies of remaining polys using them'''
+    positions = np.array([tuple(v) for v in vertices], dtype=np.float64).reshape(-1, 3)
+    points = [tuple(v) for v in positions.tolist()]
+
+    tris = [[pol.p1, pol.p2, pol.p3] for pol in polys]
+    uvs = [[(pol.u1, pol.v1), (pol.u2, pol.v2), (pol.u3, pol.v3)] for pol in polys]
+    runs = [(pol.texture, pol.material) for pol in polys]
+
+    num_vertices = len(points)
+    vertex_tris = [set() for v in range(num_vertices)]
+    for t, tri in enumerate(tris):
+        for v in tri:
+            vertex_tris[v].add(t)
+
+    locked, edges = get_locked_vertices(tris, uvs, runs, num_vertices)
+    quadrics = calc_quadrics(positions, np.array(tris, dtype=np.int64).reshape(-1, 3))
+    versions = [0] * num_vertices
+
+    heap = []
+
+    def push(v, u):
+        # collapse v into u
+        if locked[v]:
+            return
+        p = np.append(positions[u], 1.0)
+        cost = float(p @ (quadrics[v] + quadrics[u]) @ p)
+        heapq.heappush(heap, (cost, v, u, versions[v], versions[u]))
+
+    def get_neighbours(v):
+        return {x for t in vertex_tris[v] for x in tris[t]}
+
+    for a, b in edges:
+        push(a, b)
+        push(b, a)
+
+    alive = len(tris)
+    dead = [False] * len(tris)
+    removed = [False] * num_vertices
+    while alive > target_polys and heap:
+        cost, v, u, version_v, version_u = heapq.heappop(heap)
+        if removed[v] or removed[u] or version_v != versions[v] or version_u != versions[u]:
+            continue
+
+        shared = {t for t in vertex_tris[v] if u in tris[t]}
+        if not shared:
+            continue
+
+        # link condition, collapsing must not create non-manifold geometry
+        common = (get_neighbours(v) & get_neighbours(u)) - {u, v}
+        if len(common) != len(shared):
+            continue
+
+        # moving v must not flip or collapse any of the remaining triangles
+        flips = False
+        for t in vertex_tris[v] - shared:
+            a, b, c = (points[x] for x in tris[t])
+            before = cross(sub(b, a), sub(c, a))
+            a, b, c = (points[u] if x == v else points[x] for x in tris[t])
+            after = cross(sub(b, a), sub(c, a))
+            if dot(before, after) <= 0.0 or dot(after, after) <= 1e-20:
+                flips = True
+                break
+        if flips:
+            continue
+
+        # v is not on a uv seam, so every corner of v is in the same uv island as this one
+        t = next(iter(shared))
+        uv_u = uvs[t][tris[t].index(u)]
+
+        for t in vertex_tris[v]:
+            if t in shared:
+                dead[t] = True
+                alive -= 1
+                for x in tris[t]:
+                    if x != v:
+                        vertex_tris[x].discard(t)
+            else:
+                k = tris[t].index(v)
+                tris[t][k] = u
+                uvs[t][k] = uv_u
+                vertex_tris[u].add(t)
+
+        vertex_tris[v].clear()
+        removed[v] = True
+
+        quadrics[u] += quadrics[v]
+        versions[u] += 1
+        for w in get_neighbours(u) - {u}:
+            push(w, u)
+            push(u, w)
+
+    # build the remaining geometry without removed vertices
+    new_index = {}
+    new_vertices = []
+    new_polys = []
+    for t, tri in enumerate(tris):
+        if dead[t]:
+            continue
+        for v in tri:
+            if v not in new_index:
+                new_index[v] = len(new_vertices)
+                new_vertices.append(points[v])
+
+        pol = copy.copy(polys[t])
+        pol.p1, pol.p2, pol.p3 = (new_index[v] for v in tri)
+        (pol.u1, pol.v1), (pol.u2, pol.v2), (pol.u3, pol.v3) = uvs[t]
+        new_polys.append(pol)
+
+    return new_vertices, new_polys
+
+def get_lod_flags(flags, level):
+    lod_flags = LOD_FLAGS if flags & 1 else SUB_LOD_FLAGS
+    return (flags & ~ALL_LOD_FLAGS & ~MAIN_FLAGS) | lod_flags[level]
+
+def decimate_mesh(m, level, ratio, textures):
+    lod = p3d.Mesh()
+    lod.name = '{}_lod{}'.format(m.name, level)
+    lod.flags = get_lod_flags(m.flags, level)
+    lod.pos = m.pos
+    lod.length, lod.height, lod.depth = m.length, m.height, m.depth
+    lod.materials_used = m.materials_used
+
+    lod.vertices, lod.polys = decimate(m.vertices, m.polys, int(len(m.polys) * ratio))
+    lod.num_vertices = len(lod.vertices)
+    lod.sort_polys(textures)
+
+    return lod
+
+def get_mesh_data(m):
+    # a mesh as builtin types only, so it can be pickled by a process which can't import the addon
+    return {
+        'name': m.name,
+        'flags': m.flags,
+        'pos': tuple(m.pos),
+        'size': (m.length, m.height, m.depth),
+        'materials_used': [tuple(material) for material in m.materials_used],
+        'vertices': [tuple(v) for v in m.vertices],
+        'polys': [tuple(getattr(pol, field) for field in POLY_FIELDS) for pol in m.polys],
+    }
+
+def make_mesh(data, textures):
+    m = p3d.Mesh()
+    m.name = data['name']
+    m.flags = data['flags']
+    m.pos = data['pos']
+    m.length, m.height, m.depth = data['size']
+    m.materials_used = data['materials_used']
+    m.vertices = data['vertices']
+    m.num_vertices = len(m.vertices)
+    m.polys = []
+    for values in data['polys']:
+        pol = p3d.Polygon()
+        for field, value in zip(POLY_FIELDS, values):
+            setattr(pol, field, value)
+        m.polys.append(pol)
+    m.sort_polys(textures)
+    return m
+
+def decimate_data(data, level, ratio, textures):
+    return get_mesh_data(decimate_mesh(make_mesh(data, textures), level, ratio, textures))
+
+def get_levels(ratios):
+    # (level, ratio) of levels to generate, ratios is a dict of level: poly ratio
+    return [(level, ratio) for level, ratio in sorted(ratios.items()) if 0.0 < ratio < 1.0]
+
+def generate_lods(meshes, ratios, textures, max_workers=None):
+    '''Generates decimated levels for every mesh data, ratios is a dict of level: poly ratio.
+    Returns a list of generated level data for every mesh'''
+    levels = get_levels(ratios)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [[executor.submit(decimate_data, data, level, ratio, textures) for level, ratio in levels]
+                   for data in meshes]
+
+        return [[f.result() for f in mesh_futures] for mesh_futures in futures]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate decimated LOD levels of meshes written by the exporter.')
+    parser.add_argument('input', help='pickle with meshes, ratios and textures')
+    parser.add_argument('output', help='pickle the levels of every mesh are written to')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='amount of worker processes')
+    args = parser.parse_args(argv)
+
+    with open(args.input, 'rb') as file:
+        job = pickle.load(file)
+
+    levels = generate_lods(job['meshes'], job['ratios'], job['textures'], args.jobs)
+
+    with open(args.output, 'wb') as file:
+        pickle.dump(levels, file)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
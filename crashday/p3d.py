@@ -1,4 +1,6 @@
+import io
 import struct
+import fnmatch
 
 # TODO:
 # - add error checking for struct reading\writing
@@ -22,6 +24,78 @@ def wf(file, format, *args):
 def wf_str(file, st):
     wf(file, '<%ds' % (len(st)+1), st.encode('ASCII', 'replace'))
 
+# order in which material runs of every texture are stored
+MATERIAL_TYPES = ('FLAT', 'FLAT_METAL', 'GOURAUD', 'GOURAUD_METAL', 'GOURAUD_METAL_ENV', 'SHINING')
+# material types which are smoothed by the game
+SMOOTH_MATERIAL_TYPES = ('GOURAUD', 'GOURAUD_METAL', 'GOURAUD_METAL_ENV')
+
+# mesh flags, index of the name is the bit of the flag
+MESH_FLAGS = ('MAIN', 'VIS', 'TRACE', 'COLL', 'NOLOD', 'LOD0', 'LOD2', 'LOD3', 'LOD4',
+    'SUB0', 'SUB2', 'SUB3', 'SUB4', 'DET', 'BRG', 'BRP', 'BRW', 'BRM', 'BRE',
+    'LIPL', 'HDL', 'BRL', 'DMG', 'NOCL')
+
+# sizes of fixed parts of a mesh block
+MESH_HEADER_SIZE = struct.calcsize('<i6f')
+TEXTURE_INFO_SIZE = struct.calcsize('<7H')
+VERTEX_SIZE = struct.calcsize('<3f')
+POLYGON_SIZE = struct.calcsize('<H2fH2fH2f')
+
+def find_str_end(data, offset):
+    # offset of the terminating zero of a string in bytes or mmap data
+    end = data.find(b'\x00', offset)
+    if end < 0:
+        raise ValueError('Unterminated string at offset {}'.format(offset))
+    return end
+
+def get_mesh_size(data, offset, num_textures):
+    # size of a mesh block starting at its name, found without decoding vertices or polygons
+    end = find_str_end(data, offset) + 1
+    end += MESH_HEADER_SIZE + TEXTURE_INFO_SIZE * num_textures
+    num_vertices = struct.unpack_from('<H', data, end)[0]
+    end += 2 + VERTEX_SIZE * num_vertices
+    num_polys = struct.unpack_from('<H', data, end)[0]
+    end += 2 + POLYGON_SIZE * num_polys
+    return end - offset
+
+def get_mesh_flags(data, offset):
+    # flags of a mesh block starting at its name
+    return struct.unpack_from('<i', data, find_str_end(data, offset) + 1)[0]
+
+def get_flag_mask(flags):
+    # bit mask of MESH_FLAGS names
+    mask = 0
+    for flag in flags:
+        mask |= 1 << MESH_FLAGS.index(flag)
+    return mask
+
+MAIN_FLAG = get_flag_mask(('MAIN',))
+VISIBLE_FLAG = get_flag_mask(('VIS',))
+TRACE_FLAG = get_flag_mask(('TRACE',))
+COLLISION_FLAG = get_flag_mask(('COLL',))
+DAMAGED_FLAG = get_flag_mask(('DMG',))
+# detachable and breakable parts, the game can remove them
+LOOSE_FLAGS = get_flag_mask(('DET', 'BRG', 'BRP', 'BRW', 'BRM', 'BRE'))
+# meshes changed by the game one by one: loose parts, license plate, lights and damaged meshes
+DYNAMIC_FLAGS = LOOSE_FLAGS | get_flag_mask(('LIPL', 'HDL', 'BRL', 'DMG'))
+
+def match_mesh(name, flags, include=(), exclude=(), required_flags=0, forbidden_flags=0):
+    '''Checks a mesh against name glob patterns, which ignore case, and flag masks. The mesh has to match
+    one of include patterns if there are any, none of exclude patterns, have all required_flags and none of forbidden_flags'''
+    name = name.lower()
+    if include and not any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in include):
+        return False
+    if any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in exclude):
+        return False
+    return flags & required_flags == required_flags and not flags & forbidden_flags
+
+def get_tris(polys):
+    # vertex indices of every poly
+    return [(pol.p1, pol.p2, pol.p3) for pol in polys]
+
+def count_runs(m):
+    # non-empty texture and material runs of a mesh, every run is a separate draw call
+    return sum(1 for ti in m.texture_infos for material, start, count in ti.get_runs() if count > 0)
+
 class TextureInfo:
     def __init__(self):
         self.texture_start = 0
@@ -58,6 +132,14 @@ class TextureInfo:
             self.num_shining
             )
 
+    def get_runs(self):
+        # yields (material type, first poly, poly count) for every material run of this texture
+        start = self.texture_start
+        for material in MATERIAL_TYPES:
+            count = getattr(self, 'num_' + material.lower())
+            yield material, start, count
+            start += count
+
 class Light:
     def __init__(self):
         self.name = 'light'
@@ -213,6 +295,26 @@ pos: {}\nsize: {:.2f} {:.2f} {:.2f} \n'''.format(
             polys_in_tex = add_material_type('GOURAUD_METAL_ENV', j.num_gouraud_metal_env, polys_in_tex)
             polys_in_tex = add_material_type('SHINING', j.num_shining, polys_in_tex) 
 
+    def sort_polys(self, textures):
+        # reorder polys into CD format, grouped by texture and then by material type
+        # and fill texture infos to describe those groups
+        runs = {}
+        for pol in self.polys:
+            runs.setdefault((pol.texture, pol.material), []).append(pol)
+
+        self.polys = []
+        self.texture_infos = []
+        for tex in textures:
+            ti = TextureInfo()
+            ti.texture_start = len(self.polys)
+            for material in MATERIAL_TYPES:
+                run = runs.get((tex, material), [])
+                setattr(ti, 'num_' + material.lower(), len(run))
+                self.polys += run
+            self.texture_infos.append(ti)
+
+        self.num_polys = len(self.polys)
+
     def write(self, file):
         def w(format, *args):
             wf(file, format, *args)
@@ -232,6 +334,10 @@ pos: {}\nsize: {:.2f} {:.2f} {:.2f} \n'''.format(
         for ti in self.texture_infos:
             ti.write(file)
 
+        if len(self.vertices) > 65535 or len(self.polys) > 65535:
+            raise ValueError('Mesh {} has {} vertices and {} polys, p3d can only store 65535 of each'.format(
+                self.name, len(self.vertices), len(self.polys)))
+
         if self.num_vertices != len(self.vertices):
             print('Counted num_vertices differs from actual amount of vertices! Report this error!')
             self.num_vertices = len(self.vertices)
@@ -241,7 +347,7 @@ pos: {}\nsize: {:.2f} {:.2f} {:.2f} \n'''.format(
 
         if self.num_polys != len(self.polys):
             print('Counted num_polys differs from actual amount of polys! Report this error!')
-            self.num_polys = (self.polys)
+            self.num_polys = len(self.polys)
         w('<H', self.num_polys)
         for p in self.polys:
             p.write(file)
@@ -280,7 +386,8 @@ class P3D:
             self.length, self.height, self.depth, self.num_lights, 
             self.num_meshes, self.num_textures)
 
-    def read(self, file):
+    def read_header(self, file):
+        # reads everything before the meshes
         def r(format):
             return rf(file, format)
 
@@ -318,16 +425,27 @@ class P3D:
         # MESHES + 4 bytes size signature
         file.read(10)
         self.num_meshes = r('<H')
-        self.meshes = []
+
+    def read_meshes(self, file):
+        # yields meshes one by one, so big models can be processed without keeping all of them.
+        # file must be positioned right after read_header
         for i in range(self.num_meshes):
             # SUBMESH + 4 bytes size signature
             file.read(11)
             p = Mesh()
             p.read(file, self.textures, self.num_textures)
-            self.meshes.append(p)
+            yield p
+
+    def read(self, file):
+        # file can be any file-like object or a buffer with the whole model
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            file = io.BytesIO(file)
+
+        self.read_header(file)
+        self.meshes = list(self.read_meshes(file))
 
         file.read(8)
-        self.user_data_size = r('<i')
+        self.user_data_size = rf(file, '<i')
 
     def write(self, file):
         def w(format, *args):
@@ -374,4 +492,22 @@ class P3D:
         file.write( b'USER')
         w('<I', 1337)
         w('<i', 0)
-            
\ No newline at end of file
+
+def scan_meshes(data):
+    '''Reads the header of a whole model in data and finds its mesh blocks.
+    Returns the P3D with textures and lights but no meshes and a (name, offset, size) list of mesh blocks'''
+    file = io.BytesIO(data)
+    p = P3D()
+    p.read_header(file)
+
+    blocks = []
+    offset = file.tell()
+    for i in range(p.num_meshes):
+        # SUBMESH + 4 bytes size signature
+        offset += 11
+        size = get_mesh_size(data, offset, p.num_textures)
+        name = str(data[offset:find_str_end(data, offset)], 'utf-8', 'replace')
+        blocks.append((name, offset, size))
+        offset += size
+
+    return p, blocks
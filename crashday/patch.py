@@ -0,0 +1,321 @@
+import os
+import sys
+import mmap
+import glob
+import fnmatch
+import shutil
+import struct
+import tempfile
+import argparse
+
+from . import p3d
+
+# In-place patching of p3d files. Fixed-size fields (mesh flags, lights, texture infos) are
+# rewritten directly in a memory-mapped file. Texture renames changing the size of the texture
+# list write a patched copy which atomically replaces the file. Geometry is never decoded.
+#
+# Usage from the addon folder:
+#   python -m crashday.patch models/*.p3d --mesh-flags "lod*:+NOCL"
+#   python -m crashday.patch car.p3d --light "*:range=4,color=ffcc00" --rename-texture old=new
+
+LIGHT_FORMAT = '<4fi3B'
+MESH_HEADER_FORMAT = '<i6f'
+TEXTURE_INFO_FORMAT = '<7H'
+
+# size fields written by this addon, the game does not read them
+SIZE_PLACEHOLDER = 1337
+
+class Layout:
+    '''Offsets of patchable fields of a p3d file'''
+    def __init__(self):
+        self.tex_size_offset = 0
+        self.tex_start = 0
+        self.tex_end = 0
+        self.textures = []
+        # (name, offset of light struct)
+        self.lights = []
+        # (name, offset of mesh header, offset of first texture info)
+        self.meshes = []
+
+def expect_tag(data, offset, tag):
+    if data[offset:offset + len(tag)] != tag:
+        raise ValueError('Expected {} section at offset {}'.format(tag.decode('ascii'), offset))
+    return offset + len(tag)
+
+def read_name(data, offset):
+    end = p3d.find_str_end(data, offset)
+    return str(data[offset:end], 'utf-8', 'replace'), end + 1
+
+def scan_layout(data):
+    '''Finds offsets of every patchable field in bytes or mmap data of a whole p3d file'''
+    layout = Layout()
+
+    offset = expect_tag(data, 0, b'P3D\x02') + 12
+
+    offset = expect_tag(data, offset, b'TEX')
+    layout.tex_size_offset = offset
+    num_textures = data[offset + 4]
+    offset += 5
+    layout.tex_start = offset
+    for i in range(num_textures):
+        name, offset = read_name(data, offset)
+        layout.textures.append(name[:-4] if name.endswith('.tga') else name)
+    layout.tex_end = offset
+
+    offset = expect_tag(data, offset, b'LIGHTS') + 4
+    num_lights = struct.unpack_from('<H', data, offset)[0]
+    offset += 2
+    for i in range(num_lights):
+        name, offset = read_name(data, offset)
+        layout.lights.append((name, offset))
+        offset += struct.calcsize(LIGHT_FORMAT)
+
+    offset = expect_tag(data, offset, b'MESHES') + 4
+    num_meshes = struct.unpack_from('<H', data, offset)[0]
+    offset += 2
+    for i in range(num_meshes):
+        start = expect_tag(data, offset, b'SUBMESH') + 4
+        name, header = read_name(data, start)
+        layout.meshes.append((name, header, header + struct.calcsize(MESH_HEADER_FORMAT)))
+        offset = start + p3d.get_mesh_size(data, start, num_textures)
+
+    expect_tag(data, offset, b'USER')
+
+    return layout
+
+def parse_flags(value):
+    # flag names separated by commas or | or a number
+    try:
+        return int(value, 0)
+    except ValueError:
+        pass
+
+    flags = 0
+    for name in value.replace('|', ',').split(','):
+        name = name.strip().upper()
+        if name:
+            if name not in p3d.MESH_FLAGS:
+                raise ValueError('Unknown mesh flag {}'.format(name))
+            flags |= 1 << p3d.MESH_FLAGS.index(name)
+    return flags
+
+class P3DPatcher:
+    '''Patches a p3d file in place, use as a context manager or call close()'''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'r+b')
+        self.data = mmap.mmap(self.file.fileno(), 0)
+        self.layout = scan_layout(self.data)
+        self.changes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            self.data.flush()
+            self.data.close()
+            self.data = None
+            self.file.close()
+
+    def write(self, offset, format, *values):
+        old = self.data[offset:offset + struct.calcsize(format)]
+        struct.pack_into(format, self.data, offset, *values)
+        if self.data[offset:offset + len(old)] != old:
+            self.changes += 1
+
+    def find_meshes(self, pattern):
+        return [m for m in self.layout.meshes if fnmatch.fnmatchcase(m[0], pattern)]
+
+    def find_lights(self, pattern):
+        return [l for l in self.layout.lights if fnmatch.fnmatchcase(l[0], pattern)]
+
+    def get_mesh_flags(self, name):
+        for mesh_name, header, _ in self.layout.meshes:
+            if mesh_name == name:
+                return struct.unpack_from('<i', self.data, header)[0]
+        raise KeyError('Mesh {} was not found in {}'.format(name, self.path))
+
+    def set_mesh_flags(self, pattern, flags=None, add=0, remove=0):
+        # sets flags of every mesh matching the name pattern, returns the amount of matched meshes
+        meshes = self.find_meshes(pattern)
+        for name, header, _ in meshes:
+            value = struct.unpack_from('<i', self.data, header)[0] if flags is None else flags
+            self.write(header, '<i', (value | add) & ~remove)
+        return len(meshes)
+
+    def get_light(self, name):
+        for light_name, offset in self.layout.lights:
+            if light_name == name:
+                light = p3d.Light()
+                light.name = light_name
+                (light.pos[0], light.pos[2], light.pos[1], light.range, light.color,
+                 light.show_corona, light.show_lens_flares,
+                 light.lightup_environment) = struct.unpack_from(LIGHT_FORMAT, self.data, offset)
+                return light
+        raise KeyError('Light {} was not found in {}'.format(name, self.path))
+
+    def set_light(self, pattern, pos=None, range=None, color=None,
+                  show_corona=None, show_lens_flares=None, lightup_environment=None):
+        # changes given values of every light matching the name pattern, returns the amount of matched lights
+        lights = self.find_lights(pattern)
+        for name, offset in lights:
+            values = list(struct.unpack_from(LIGHT_FORMAT, self.data, offset))
+            if pos is not None:
+                values[0], values[2], values[1] = pos
+            for i, value in ((3, range), (4, color), (5, show_corona), (6, show_lens_flares), (7, lightup_environment)):
+                if value is not None:
+                    values[i] = value
+            self.write(offset, LIGHT_FORMAT, *values)
+        return len(lights)
+
+    def get_texture_info(self, name, texture):
+        for mesh_name, _, infos in self.layout.meshes:
+            if mesh_name == name:
+                ti = p3d.TextureInfo()
+                (ti.texture_start, ti.num_flat, ti.num_flat_metal, ti.num_gouraud, ti.num_gouraud_metal,
+                 ti.num_gouraud_metal_env, ti.num_shining) = struct.unpack_from(
+                    TEXTURE_INFO_FORMAT, self.data, infos + self.layout.textures.index(texture) * struct.calcsize(TEXTURE_INFO_FORMAT))
+                return ti
+        raise KeyError('Mesh {} was not found in {}'.format(name, self.path))
+
+    def set_texture_info(self, name, texture, ti):
+        # texture infos must still cover the polygons of the mesh, nothing is checked here
+        for mesh_name, _, infos in self.layout.meshes:
+            if mesh_name == name:
+                self.write(infos + self.layout.textures.index(texture) * struct.calcsize(TEXTURE_INFO_FORMAT),
+                           TEXTURE_INFO_FORMAT, ti.texture_start, ti.num_flat, ti.num_flat_metal, ti.num_gouraud,
+                           ti.num_gouraud_metal, ti.num_gouraud_metal_env, ti.num_shining)
+                return
+        raise KeyError('Mesh {} was not found in {}'.format(name, self.path))
+
+    def rename_textures(self, names):
+        '''Renames textures with a dict of old name: new name, names are not case sensitive.
+        A texture list of the same size is rewritten in place, otherwise the patched file is written
+        next to the original and replaces it. Returns the amount of renamed textures'''
+        names = {old.lower(): new for old, new in names.items()}
+        textures = [names.get(tex.lower(), tex) for tex in self.layout.textures]
+        renamed = sum(1 for old, new in zip(self.layout.textures, textures) if old != new)
+        if renamed == 0:
+            return 0
+
+        block = b''.join((tex + '.tga').lower().encode('ascii', 'replace') + b'\x00' for tex in textures)
+        start, end = self.layout.tex_start, self.layout.tex_end
+
+        if len(block) == end - start:
+            self.data[start:end] = block
+        else:
+            # keep the texture section size right if the file has real section sizes
+            size = struct.unpack_from('<I', self.data, self.layout.tex_size_offset)[0]
+            if size != SIZE_PLACEHOLDER:
+                size += len(block) - (end - start)
+            head = bytearray(self.data[:start])
+            struct.pack_into('<I', head, self.layout.tex_size_offset, size)
+
+            # a failed write leaves the original file untouched
+            fd, temp_path = tempfile.mkstemp(suffix='.p3d', dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(head)
+                    f.write(block)
+                    f.write(self.data[end:])
+                    f.flush()
+                    os.fsync(f.fileno())
+                shutil.copymode(self.path, temp_path)
+                self.close()
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            finally:
+                if self.data is None:
+                    self.file = open(self.path, 'r+b')
+                    self.data = mmap.mmap(self.file.fileno(), 0)
+
+        self.layout = scan_layout(self.data)
+        self.changes += renamed
+        return renamed
+
+def parse_light_values(value):
+    # key=value pairs separated by commas
+    values = {}
+    for pair in value.split(','):
+        key, _, v = pair.partition('=')
+        key = key.strip()
+        if key == 'range':
+            values['range'] = float(v)
+        elif key == 'color':
+            values['color'] = int(v.lstrip('#'), 16)
+        elif key in ('corona', 'flares', 'environment'):
+            values[{'corona': 'show_corona', 'flares': 'show_lens_flares',
+                    'environment': 'lightup_environment'}[key]] = int(v) != 0
+        elif key == 'pos':
+            values['pos'] = [float(i) for i in v.split(';')]
+        else:
+            raise ValueError('Unknown light value {}'.format(key))
+    return values
+
+def parse_mesh_flags(value):
+    # "=VIS,MAIN" sets flags, "+DET" adds, "-NOCL" removes, several separated by spaces
+    flags = None
+    add = remove = 0
+    for part in value.split():
+        if part.startswith('+'):
+            add |= parse_flags(part[1:])
+        elif part.startswith('-'):
+            remove |= parse_flags(part[1:])
+        else:
+            flags = parse_flags(part.lstrip('='))
+    return flags, add, remove
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Patch mesh flags, lights and texture names of p3d files in place.')
+    parser.add_argument('inputs', nargs='+', help='p3d files or glob patterns')
+    parser.add_argument('--mesh-flags', action='append', default=[], metavar='PATTERN:FLAGS',
+                        help='change flags of meshes matching the name pattern, e.g. "lod*:+NOCL -VIS" or "main:=MAIN,VIS"')
+    parser.add_argument('--light', action='append', default=[], metavar='PATTERN:VALUES',
+                        help='change lights matching the name pattern, e.g. "*:range=4,color=ffcc00,corona=0"')
+    parser.add_argument('--rename-texture', action='append', default=[], metavar='OLD=NEW',
+                        help='rename a texture reference')
+    args = parser.parse_args(argv)
+
+    mesh_flags = []
+    for value in args.mesh_flags:
+        pattern, _, flags = value.partition(':')
+        mesh_flags.append((pattern, parse_mesh_flags(flags)))
+    lights = []
+    for value in args.light:
+        pattern, _, values = value.partition(':')
+        lights.append((pattern, parse_light_values(values)))
+    names = {}
+    for value in args.rename_texture:
+        old, _, new = value.partition('=')
+        names[old] = new
+
+    paths = []
+    for pattern in args.inputs:
+        paths += sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+
+    failed = 0
+    for path in paths:
+        try:
+            with P3DPatcher(path) as patcher:
+                for pattern, (flags, add, remove) in mesh_flags:
+                    patcher.set_mesh_flags(pattern, flags, add, remove)
+                for pattern, values in lights:
+                    patcher.set_light(pattern, **values)
+                if names:
+                    patcher.rename_textures(names)
+                print('{}: {} changes'.format(path, patcher.changes))
+        except (OSError, ValueError, struct.error) as e:
+            failed += 1
+            print('!!! Failed to patch {}: {}'.format(path, e), file=sys.stderr)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
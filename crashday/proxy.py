@@ -0,0 +1,47 @@
+from . import p3d
+from . import compact
+from . import lod
+
+# Simplified shadow (mainshad) and collision (maincoll) meshes generated from the main mesh.
+# Those meshes are never drawn, so they don't need uvs or materials, which lets
+# decimation go much further than for visible lods.
+
+SHADOW_FLAGS = p3d.TRACE_FLAG
+COLLISION_FLAGS = p3d.COLLISION_FLAG
+
+def make_proxy_mesh(main, name, flags, vertices, tris, max_polys, textures):
+    m = p3d.Mesh()
+    m.name = name
+    m.flags = flags
+    m.pos = main.pos
+    m.length, m.height, m.depth = main.length, main.height, main.depth
+
+    # put every poly into one flat run without uvs, so only the shape of the mesh matters
+    texture = main.polys[0].texture if main.polys else textures[0]
+    m.polys = []
+    for tri in tris:
+        pol = p3d.Polygon()
+        pol.texture = texture
+        pol.material = 'FLAT'
+        pol.p1, pol.p2, pol.p3 = tri
+        m.polys.append(pol)
+
+    m.vertices = list(vertices)
+
+    # vertices split for hard edges or uvs would stop decimation on every seam
+    compact.compact_mesh(m)
+    if len(m.polys) > max_polys:
+        m.vertices, m.polys = lod.decimate(m.vertices, m.polys, max_polys)
+
+    m.num_vertices = len(m.vertices)
+    m.sort_polys(textures)
+
+    return m
+
+def make_shadow_mesh(main, max_polys, textures):
+    return make_proxy_mesh(main, 'mainshad', SHADOW_FLAGS, main.vertices, p3d.get_tris(main.polys), max_polys, textures)
+
+def make_collision_mesh(main, max_polys, textures, hull=None):
+    # hull is an optional (vertices, tris) convex hull of the main mesh
+    vertices, tris = hull if hull is not None else (main.vertices, p3d.get_tris(main.polys))
+    return make_proxy_mesh(main, 'maincoll', COLLISION_FLAGS, vertices, tris, max_polys, textures)
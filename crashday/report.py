@@ -0,0 +1,100 @@
+import math
+import struct
+
+from . import p3d
+from . import split
+
+# Performance report of a p3d model, used to check runtime cost of a model before shipping it.
+
+TGA_IMAGE_TYPES = (1, 2, 3, 9, 10, 11)
+
+def read_texture_size(path):
+    '''Reads (width, height, format) of a .tga or .dds texture from its header.
+    Returns None if the file does not exist or is not a supported texture'''
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(128)
+    except OSError:
+        return None
+
+    if header[:4] == b'DDS ' and len(header) >= 128:
+        height, width = struct.unpack_from('<2I', header, 12)
+        four_cc = header[84:88].rstrip(b'\x00').decode('ascii', 'replace')
+        return width, height, 'DDS ' + (four_cc or 'RGB')
+
+    if len(header) >= 18 and header[2] in TGA_IMAGE_TYPES:
+        width, height, bpp = struct.unpack_from('<2HB', header, 12)
+        return width, height, 'TGA {}bit'.format(bpp)
+
+    return None
+
+def get_flag_names(flags):
+    return ' '.join(name for bit, name in enumerate(p3d.MESH_FLAGS) if flags & (1 << bit))
+
+def is_finite(values):
+    return all(math.isfinite(v) for v in values)
+
+def make_report(p, texture_sizes,
+                max_vertices=split.MAX_VERTICES,
+                max_polys=split.MAX_POLYS,
+                max_draw_calls=32,
+                max_texture_size=1024):
+    '''Returns report lines and the amount of problems found.
+    texture_sizes is texture name: (width, height, format) or None if texture was not found'''
+    lines = []
+    problems = 0
+
+    def problem(message):
+        nonlocal problems
+        problems += 1
+        lines.append('! ' + message)
+
+    lines.append('Model size: {:.2f} {:.2f} {:.2f}, {} meshes, {} lights, {} textures'.format(
+        p.length, p.height, p.depth, len(p.meshes), len(p.lights), len(p.textures)))
+    if not is_finite((p.length, p.height, p.depth)) or p.length <= 0.0 or p.depth <= 0.0:
+        problem('Model bounding box is empty or invalid, nothing will collide with it')
+
+    total_vertices = 0
+    total_polys = 0
+    total_draw_calls = 0
+    for m in p.meshes:
+        draw_calls = p3d.count_runs(m)
+        total_vertices += len(m.vertices)
+        total_polys += len(m.polys)
+        total_draw_calls += draw_calls
+
+        lines.append('{}: {} vertices, {} polys, {} draw calls, size {:.2f} {:.2f} {:.2f}, flags {}'.format(
+            m.name, len(m.vertices), len(m.polys), draw_calls,
+            m.length, m.height, m.depth, get_flag_names(m.flags)))
+
+        if len(m.vertices) > max_vertices:
+            problem('{} has {} vertices, budget is {}'.format(m.name, len(m.vertices), max_vertices))
+        if len(m.polys) > max_polys:
+            problem('{} has {} polys, budget is {}'.format(m.name, len(m.polys), max_polys))
+        if len(m.vertices) > split.MAX_VERTICES or len(m.polys) > split.MAX_POLYS:
+            problem('{} is over the p3d limit of {} vertices and {} polys'.format(m.name, split.MAX_VERTICES, split.MAX_POLYS))
+        if draw_calls > max_draw_calls:
+            problem('{} has {} draw calls, budget is {}'.format(m.name, draw_calls, max_draw_calls))
+
+        if not is_finite(tuple(m.pos) + (m.length, m.height, m.depth)):
+            problem('{} has invalid position or size'.format(m.name))
+        elif m.length <= 0.0 and m.height <= 0.0 and m.depth <= 0.0:
+            problem('{} has zero size'.format(m.name))
+        elif (abs(m.pos[0]) - m.length / 2.0 > p.length / 2.0 or
+              abs(m.pos[1]) - m.depth / 2.0 > p.depth / 2.0):
+            lines.append('! {} is outside model bounding box, it will have no collisions'.format(m.name))
+
+    lines.append('Total: {} vertices, {} polys, {} draw calls'.format(total_vertices, total_polys, total_draw_calls))
+
+    for tex in p.textures:
+        size = texture_sizes.get(tex)
+        if size is None:
+            lines.append('! Texture {} was not found, size unknown'.format(tex))
+            continue
+
+        width, height, texture_format = size
+        lines.append('Texture {}: {}x{} {}'.format(tex, width, height, texture_format))
+        if max(width, height) > max_texture_size:
+            problem('Texture {} is {}x{}, budget is {}'.format(tex, width, height, max_texture_size))
+
+    return lines, problems
@@ -0,0 +1,139 @@
+import copy
+
+import numpy as np
+
+from . import p3d
+
+# P3D stores vertex and poly counts as unsigned shorts
+MAX_VERTICES = 65535
+MAX_POLYS = 65535
+
+# tracing and collision flags, shadows and collisions of main mesh use the mesh with them
+PROXY_FLAGS = p3d.TRACE_FLAG | p3d.COLLISION_FLAG
+
+def is_over_limit(m, max_vertices=MAX_VERTICES, max_polys=MAX_POLYS):
+    return len(m.vertices) > max_vertices or len(m.polys) > max_polys
+
+def partition_polys(tris, centroids, polys, max_vertices, max_polys):
+    # split polys in half along the longest axis of their centroids until every part fits,
+    # this keeps parts spatially coherent so the game can still cull them
+    if len(polys) <= max_polys and len(np.unique(tris[polys])) <= max_vertices:
+        return [polys]
+
+    c = centroids[polys]
+    axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+    ordered = polys[np.argsort(c[:, axis], kind='stable')]
+    half = len(ordered) // 2
+
+    return (partition_polys(tris, centroids, np.sort(ordered[:half]), max_vertices, max_polys) +
+            partition_polys(tris, centroids, np.sort(ordered[half:]), max_vertices, max_polys))
+
+def get_mesh_arrays(m):
+    # vertices, vertex indices and corner uvs of every poly of m
+    vertices = np.array([tuple(v) for v in m.vertices], dtype=np.float64).reshape(-1, 3)
+    tris = np.array(p3d.get_tris(m.polys), dtype=np.int64).reshape(-1, 3)
+    uvs = np.array([(pol.u1, pol.v1, pol.u2, pol.v2, pol.u3, pol.v3) for pol in m.polys],
+                   dtype=np.float64).reshape(-1, 3, 2)
+    return vertices, tris, uvs
+
+def make_part(m, textures, vertices, tris, part, name, flags, keep_bounds=False):
+    # creates a mesh of polys in part, with tight bounds unless keep_bounds is set
+    used = np.unique(tris[part].ravel())
+    new_index = np.full(len(vertices), -1, dtype=np.int64)
+    new_index[used] = np.arange(len(used))
+
+    sm = p3d.Mesh()
+    sm.name = name
+    sm.flags = flags
+    sm.materials_used = m.materials_used
+
+    part_vertices = vertices[used]
+    if keep_bounds:
+        sm.pos = m.pos
+        sm.length, sm.height, sm.depth = m.length, m.height, m.depth
+        center = np.zeros(3)
+    else:
+        low = part_vertices.min(axis=0)
+        high = part_vertices.max(axis=0)
+        center = (low + high) / 2.0
+        sm.pos = tuple(float(p + c) for p, c in zip(m.pos, center))
+        sm.length = float(high[0] - low[0])
+        sm.height = float(high[2] - low[2])
+        sm.depth = float(high[1] - low[1])
+
+    sm.vertices = [tuple(v) for v in (part_vertices - center).tolist()]
+    sm.num_vertices = len(sm.vertices)
+
+    sm.polys = [copy.copy(m.polys[t]) for t in part]
+    for pol, tri in zip(sm.polys, new_index[tris[part]].tolist()):
+        pol.p1, pol.p2, pol.p3 = tri
+    sm.sort_polys(textures)
+    return sm
+
+def split_mesh(m, textures, max_vertices=MAX_VERTICES, max_polys=MAX_POLYS):
+    '''Splits a mesh which is over the p3d limits into several meshes.
+    The first part keeps the name and position of the original mesh, others get a _1, _2... suffix.
+    Polys of m should already be sorted with Mesh.sort_polys'''
+    vertices, tris, _ = get_mesh_arrays(m)
+    centroids = vertices[tris].mean(axis=1)
+    parts = partition_polys(tris, centroids, np.arange(len(tris)), max_vertices, max_polys)
+
+    meshes = []
+    for i, part in enumerate(parts):
+        if i == 0:
+            # the first part keeps the original bounds, so main mesh stays at 0.0
+            meshes.append(make_part(m, textures, vertices, tris, part, m.name, m.flags, keep_bounds=True))
+        else:
+            # there can only be one main mesh
+            meshes.append(make_part(m, textures, vertices, tris, part, '{}_{}'.format(m.name, i), m.flags & ~p3d.MAIN_FLAG))
+
+    return meshes
+
+def grid_parts(centroids, cell_size):
+    # polys grouped by the horizontal grid cell of their centroid, the grid starts at the mesh corner
+    xy = centroids[:, :2]
+    cells = np.floor((xy - xy.min(axis=0)) / cell_size).astype(np.int64)
+    _, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.flatnonzero(np.diff(inverse[order])) + 1
+    return np.split(order, bounds)
+
+def chunk_mesh(m, textures, mode='GRID', cell_size=10.0, max_polys=2000):
+    '''Partitions a visible mesh into spatially coherent chunks with tight bounds, so the game can cull
+    them separately. mode is GRID for horizontal cells of cell_size or KD for halving along the longest
+    axis until chunks have at most max_polys polys. The first chunk keeps the name of m, others get
+    a _c1, _c2... suffix, all of them keep its flags. Main mesh keeps its position and bounds in the
+    first chunk and its tracing and collision flags move to one invisible copy of the whole mesh,
+    so shadows and collisions stay the same. Returns [m] if the mesh is not chunked'''
+    # invisible meshes are never drawn, other meshes with main flags can't be split
+    if not m.flags & p3d.VISIBLE_FLAG or (m.flags & PROXY_FLAGS and not m.flags & p3d.MAIN_FLAG) or not m.polys:
+        return [m]
+
+    vertices, tris, _ = get_mesh_arrays(m)
+    centroids = vertices[tris].mean(axis=1)
+    if mode == 'KD':
+        parts = partition_polys(tris, centroids, np.arange(len(tris)), MAX_VERTICES, max_polys)
+    else:
+        parts = grid_parts(centroids, cell_size)
+    if len(parts) < 2:
+        return [m]
+
+    meshes = []
+    is_main = m.flags & p3d.MAIN_FLAG
+    for i, part in enumerate(parts):
+        name = m.name if i == 0 else '{}_c{}'.format(m.name, i)
+        if not is_main:
+            meshes.append(make_part(m, textures, vertices, tris, part, name, m.flags))
+        elif i == 0:
+            meshes.append(make_part(m, textures, vertices, tris, part, name, m.flags & ~PROXY_FLAGS, keep_bounds=True))
+        else:
+            meshes.append(make_part(m, textures, vertices, tris, part, name, m.flags & ~PROXY_FLAGS & ~p3d.MAIN_FLAG))
+
+    if is_main and m.flags & PROXY_FLAGS:
+        proxy = copy.copy(m)
+        proxy.name = 'maincoll' if m.flags & p3d.COLLISION_FLAG else 'mainshad'
+        proxy.flags = m.flags & ~p3d.MAIN_FLAG & ~p3d.VISIBLE_FLAG
+        meshes.append(proxy)
+
+    return meshes
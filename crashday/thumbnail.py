@@ -0,0 +1,300 @@
+import os
+import sys
+import glob
+import zlib
+import struct
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+from . import p3d
+from . import cache
+
+# Thumbnails of p3d models drawn by a small software rasterizer, so no GPU and no Blender is needed.
+# The main mesh is drawn with flat shading and optionally its textures. Thumbnails are cached
+# as .png files keyed by model path, size and mtime.
+#
+# Usage from the addon folder:
+#   python -m crashday.thumbnail "mods/**/*.p3d" -s 128
+
+THUMBNAIL_SIZE = 128
+# view direction, yaw around the up axis and pitch down
+VIEW_YAW = np.radians(35.0)
+VIEW_PITCH = np.radians(30.0)
+LIGHT_DIRECTION = np.array((-0.4, -0.6, 0.7)) / np.linalg.norm((-0.4, -0.6, 0.7))
+AMBIENT = 0.3
+UNTEXTURED_COLOR = np.array((0.75, 0.75, 0.75))
+# maximum amount of pixel samples tested at once
+BATCH_SAMPLES = 1 << 21
+
+def read_tga(path):
+    '''Reads an uncompressed or rle compressed 24 or 32 bit .tga into a (height, width, 4) uint8 array,
+    first row is the top of the image. Returns None for unsupported files'''
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+
+    if len(data) < 18:
+        return None
+    id_length, color_map_type, image_type = data[0], data[1], data[2]
+    width, height, bpp, descriptor = struct.unpack_from('<2H2B', data, 12)
+    if color_map_type != 0 or image_type not in (2, 10) or bpp not in (24, 32):
+        return None
+
+    channels = bpp // 8
+    count = width * height
+    offset = 18 + id_length
+    if image_type == 2:
+        pixels = np.frombuffer(data, np.uint8, count * channels, offset)
+    else:
+        pixels = bytearray()
+        while len(pixels) < count * channels:
+            header = data[offset]
+            offset += 1
+            if header & 0x80:
+                pixels += data[offset:offset + channels] * ((header & 0x7f) + 1)
+                offset += channels
+            else:
+                size = ((header & 0x7f) + 1) * channels
+                pixels += data[offset:offset + size]
+                offset += size
+        pixels = np.frombuffer(bytes(pixels[:count * channels]), np.uint8)
+
+    pixels = pixels.reshape(height, width, channels)
+    image = np.full((height, width, 4), 255, dtype=np.uint8)
+    # tga stores bgr(a)
+    image[:, :, :3] = pixels[:, :, 2::-1]
+    if channels == 4:
+        image[:, :, 3] = pixels[:, :, 3]
+
+    # bottom to top unless the origin bit is set
+    if not descriptor & 0x20:
+        image = image[::-1]
+    return image
+
+def write_png(path, image):
+    # image is a (height, width, 4) uint8 array
+    height, width = image.shape[:2]
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, -1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(chunk(b'IHDR', struct.pack('>2I5B', width, height, 8, 6, 0, 0, 0)))
+        file.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        file.write(chunk(b'IEND', b''))
+
+def find_texture_folders(path):
+    # textures of a mod are in the textures folder next to its models folder
+    folders = []
+    folder = os.path.dirname(os.path.abspath(path))
+    while True:
+        parent, name = os.path.split(folder)
+        if name.lower() == 'models':
+            folders.append(os.path.join(parent, 'textures'))
+            break
+        if parent == folder:
+            break
+        folder = parent
+    return folders
+
+def load_textures(textures, folders):
+    # texture name: image array or None if it was not found
+    images = {}
+    for tex in textures:
+        images[tex] = None
+        for folder in folders:
+            image = read_tga(os.path.join(folder, tex + '.tga'))
+            if image is not None:
+                images[tex] = image
+                break
+    return images
+
+def read_main_mesh(path):
+    # only meshes up to the main mesh are decoded
+    p = p3d.P3D()
+    with open(path, 'rb') as file:
+        p.read_header(file)
+        first = None
+        for m in p.read_meshes(file):
+            if m.name == 'main' or m.flags & 1:
+                return p, m
+            if first is None:
+                first = m
+    return p, first
+
+def project(vertices, size):
+    # rotates vertices into view space and fits them into the image, returns screen (x, y, depth) and view space vertices
+    yaw_cos, yaw_sin = np.cos(VIEW_YAW), np.sin(VIEW_YAW)
+    pitch_cos, pitch_sin = np.cos(VIEW_PITCH), np.sin(VIEW_PITCH)
+    rotation = np.array(((1.0, 0.0, 0.0), (0.0, pitch_cos, -pitch_sin), (0.0, pitch_sin, pitch_cos))) @ \
+               np.array(((yaw_cos, -yaw_sin, 0.0), (yaw_sin, yaw_cos, 0.0), (0.0, 0.0, 1.0)))
+    view = vertices @ rotation.T
+
+    low = view.min(axis=0)
+    high = view.max(axis=0)
+    center = (low + high) / 2.0
+    scale = 0.9 * size / max(high[0] - low[0], high[2] - low[2], 1e-6)
+
+    screen = np.empty_like(view)
+    screen[:, 0] = (view[:, 0] - center[0]) * scale + size / 2.0
+    screen[:, 1] = size / 2.0 - (view[:, 2] - center[2]) * scale
+    screen[:, 2] = view[:, 1]
+    return screen, view
+
+def rasterize(screen, tris, size):
+    '''Z-buffer rasterization of all triangles at once, in batches of pixel samples.
+    Returns the triangle index (-1 for empty pixels) and barycentric coordinates of every pixel'''
+    x = screen[tris, 0]
+    y = screen[tris, 1]
+    z = screen[tris, 2]
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+
+    x_min = np.clip(np.floor(x.min(axis=1)), 0, size - 1).astype(np.int64)
+    x_max = np.clip(np.ceil(x.max(axis=1)), 0, size - 1).astype(np.int64)
+    y_min = np.clip(np.floor(y.min(axis=1)), 0, size - 1).astype(np.int64)
+    y_max = np.clip(np.ceil(y.max(axis=1)), 0, size - 1).astype(np.int64)
+    widths = x_max - x_min + 1
+    counts = widths * (y_max - y_min + 1)
+
+    visible = np.flatnonzero(np.abs(area) > 1e-12)
+
+    depth_buffer = np.full(size * size, np.inf)
+    tri_buffer = np.full(size * size, -1, dtype=np.int64)
+    bary_buffer = np.zeros((size * size, 3))
+
+    # split triangles into batches with a bounded amount of samples
+    batches = np.cumsum(counts[visible]) // BATCH_SAMPLES
+    for ids in np.split(visible, np.flatnonzero(np.diff(batches)) + 1):
+        if len(ids) == 0:
+            continue
+
+        tri = np.repeat(ids, counts[ids])
+        first = np.repeat(np.cumsum(counts[ids]) - counts[ids], counts[ids])
+        local = np.arange(len(tri)) - first
+        px = x_min[tri] + local % widths[tri]
+        py = y_min[tri] + local // widths[tri]
+        sx = px + 0.5
+        sy = py + 0.5
+
+        tx = x[tri]
+        ty = y[tri]
+        w0 = ((tx[:, 1] - sx) * (ty[:, 2] - sy) - (tx[:, 2] - sx) * (ty[:, 1] - sy)) / area[tri]
+        w1 = ((tx[:, 2] - sx) * (ty[:, 0] - sy) - (tx[:, 0] - sx) * (ty[:, 2] - sy)) / area[tri]
+        w2 = 1.0 - w0 - w1
+        inside = (w0 >= -1e-6) & (w1 >= -1e-6) & (w2 >= -1e-6)
+
+        tri, w0, w1, w2 = tri[inside], w0[inside], w1[inside], w2[inside]
+        pixel = (py * size + px)[inside]
+        depth = w0 * z[tri, 0] + w1 * z[tri, 1] + w2 * z[tri, 2]
+
+        # nearest sample of every pixel in this batch
+        order = np.lexsort((depth, pixel))
+        pixel, first = np.unique(pixel[order], return_index=True)
+        nearest = order[first]
+
+        closer = depth[nearest] < depth_buffer[pixel]
+        pixel = pixel[closer]
+        nearest = nearest[closer]
+        depth_buffer[pixel] = depth[nearest]
+        tri_buffer[pixel] = tri[nearest]
+        bary_buffer[pixel] = np.column_stack((w0[nearest], w1[nearest], w2[nearest]))
+
+    return tri_buffer, bary_buffer
+
+def render_thumbnail(path, size=THUMBNAIL_SIZE, use_textures=True, texture_folders=None):
+    '''Renders the main mesh of a p3d model into a (size, size, 4) uint8 array with transparent background'''
+    p, m = read_main_mesh(path)
+    image = np.zeros((size * size, 4), dtype=np.uint8)
+    if m is None or not m.polys:
+        return image.reshape(size, size, 4)
+
+    vertices = np.array([tuple(v) for v in m.vertices], dtype=np.float64).reshape(-1, 3)
+    tris = np.array([(pol.p1, pol.p2, pol.p3) for pol in m.polys], dtype=np.int64)
+    uvs = np.array([(pol.u1, pol.v1, pol.u2, pol.v2, pol.u3, pol.v3) for pol in m.polys], dtype=np.float64).reshape(-1, 3, 2)
+    textures = sorted(set(pol.texture for pol in m.polys))
+    texture_ids = np.array([textures.index(pol.texture) for pol in m.polys]) if len(textures) > 1 else np.zeros(len(m.polys), dtype=np.int64)
+
+    screen, view = project(vertices, size)
+    tri_buffer, bary_buffer = rasterize(screen, tris, size)
+
+    # flat shading from face normals, both sides are lit the same
+    normals = np.cross(view[tris[:, 1]] - view[tris[:, 0]], view[tris[:, 2]] - view[tris[:, 0]])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+    shade = AMBIENT + (1.0 - AMBIENT) * np.abs(normals @ LIGHT_DIRECTION)
+
+    covered = np.flatnonzero(tri_buffer >= 0)
+    tri = tri_buffer[covered]
+    colors = np.tile(UNTEXTURED_COLOR, (len(covered), 1))
+
+    if use_textures:
+        if texture_folders is None:
+            texture_folders = find_texture_folders(path)
+        images = load_textures(textures, texture_folders)
+        uv = (bary_buffer[covered, :, None] * uvs[tri]).sum(axis=1)
+        for i, tex in enumerate(textures):
+            texture = images[tex]
+            if texture is None:
+                continue
+            use = texture_ids[tri] == i
+            h, w = texture.shape[:2]
+            # uvs have their origin at the bottom like in Blender, texture rows start at the top
+            columns = (np.mod(uv[use, 0], 1.0) * w).astype(np.int64) % w
+            rows = ((1.0 - np.mod(uv[use, 1], 1.0)) * h).astype(np.int64) % h
+            colors[use] = texture[rows, columns, :3] / 255.0
+
+    image[covered, :3] = np.clip(colors * shade[tri, None] * 255.0, 0, 255).astype(np.uint8)
+    image[covered, 3] = 255
+    return image.reshape(size, size, 4)
+
+def get_thumbnail_path(path, size=THUMBNAIL_SIZE, use_textures=True):
+    return os.path.join(cache.get_cache_dir('thumbnails'), cache.get_file_key(path, size, use_textures) + '.png')
+
+def make_thumbnail(path, size=THUMBNAIL_SIZE, use_textures=True):
+    '''Returns the path of the cached thumbnail of a model, rendering it if needed.
+    Returns None if the model can't be read'''
+    try:
+        thumbnail_path = get_thumbnail_path(path, size, use_textures)
+        if not os.path.isfile(thumbnail_path):
+            image = render_thumbnail(path, size, use_textures)
+            # written under a temporary name, so readers never see a half written file
+            temp_path = thumbnail_path + '.{}.tmp'.format(os.getpid())
+            write_png(temp_path, image)
+            os.replace(temp_path, thumbnail_path)
+        return thumbnail_path
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        print('!!! Failed to make thumbnail of {}: {}'.format(path, e), file=sys.stderr)
+        return None
+
+def make_thumbnails(paths, size=THUMBNAIL_SIZE, use_textures=True, max_workers=None):
+    # returns thumbnail paths in the order of model paths, models are rendered on a process pool
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(make_thumbnail, paths, [size] * len(paths), [use_textures] * len(paths), chunksize=8))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render cached thumbnails of p3d models.')
+    parser.add_argument('inputs', nargs='+', help='p3d files or glob patterns, ** matches subfolders')
+    parser.add_argument('-s', '--size', type=int, default=THUMBNAIL_SIZE, help='thumbnail size in pixels')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='amount of worker processes')
+    parser.add_argument('--no-textures', action='store_true', help='draw models without textures')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for pattern in args.inputs:
+        paths += sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+
+    thumbnails = make_thumbnails(paths, args.size, not args.no_textures, args.jobs)
+    for path, thumbnail in zip(paths, thumbnails):
+        if thumbnail is not None:
+            print('{} -> {}'.format(path, thumbnail))
+
+    return 0 if all(thumbnails) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
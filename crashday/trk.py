@@ -0,0 +1,193 @@
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+from . import cpk
+
+# Reading of Crashday .trk tracks. A track is a grid of tiles, every tile names a .cfl field file
+# which in turn names the .p3d model of the tile, and a height map with 4 samples per tile side.
+#
+# Layout of the parts used here:
+#   'CDTRK' signature, current time, author and comment strings, 20 unknown bytes, style byte
+#   and ambience string
+#   field files: <H count, null terminated names
+#   <2H width and height, then width * height tiles of <H field, rotation, mirrored, height bytes
+#   dynamic object files: <H count, names; dynamic objects: <H count of <H object and <4f position, rotation
+#   checkpoints: <H count of <H tiles, permission byte, <f ground bumpiness and scenery byte
+#   height map: (4 * height + 1) rows of (4 * width + 1) <f samples
+
+SIGNATURE = b'CDTRK'
+# tile side and height map spacing in model units
+TILE_SIZE = 20.0
+HEIGHT_MAP_STEP = TILE_SIZE / 4.0
+# height of one tile level
+HEIGHT_STEP = 5.0
+
+TILE_DTYPE = np.dtype([('field', '<u2'), ('rotation', 'u1'), ('mirrored', 'u1'), ('height', 'u1')])
+DYNAMIC_OBJECT_SIZE = 18
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, format):
+        values = struct.unpack_from(format, self.data, self.offset)
+        self.offset += struct.calcsize(format)
+        return values[0] if len(values) == 1 else values
+
+    def read_str(self):
+        end = self.data.find(b'\x00', self.offset)
+        if end < 0:
+            raise ValueError('Unterminated string at offset {}'.format(self.offset))
+        value = str(self.data[self.offset:end], 'latin-1')
+        self.offset = end + 1
+        return value
+
+    def skip(self, size):
+        self.offset += size
+
+class Track:
+    def __init__(self):
+        self.author = ''
+        self.comment = ''
+        self.ambience = ''
+        self.field_files = []
+        self.width = 0
+        self.height = 0
+        # (height, width) array of TILE_DTYPE, first row is the top of the track
+        self.tiles = None
+        # (4 * height + 1, 4 * width + 1) float array
+        self.height_map = None
+
+    def __str__(self):
+        return 'track {}x{}, {} field files, {} tiles used\n'.format(
+            self.width, self.height, len(self.field_files), len(self.get_placements()))
+
+    def read(self, data):
+        r = Reader(data)
+        if data[:len(SIGNATURE)] != SIGNATURE:
+            raise ValueError('Not a Crashday track, missing {} signature'.format(SIGNATURE.decode('ascii')))
+        r.skip(len(SIGNATURE))
+
+        r.read('<I')
+        self.author = r.read_str()
+        self.comment = r.read_str()
+        r.skip(21)
+        self.ambience = r.read_str()
+
+        self.field_files = [r.read_str() for i in range(r.read('<H'))]
+
+        self.width, self.height = r.read('<2H')
+        count = self.width * self.height
+        self.tiles = np.frombuffer(data, TILE_DTYPE, count, r.offset).reshape(self.height, self.width)
+        r.skip(count * TILE_DTYPE.itemsize)
+
+        for i in range(r.read('<H')):
+            r.read_str()
+        r.skip(DYNAMIC_OBJECT_SIZE * r.read('<H'))
+        r.skip(2 * r.read('<H'))
+        r.skip(6)
+
+        rows, columns = 4 * self.height + 1, 4 * self.width + 1
+        self.height_map = np.frombuffer(data, '<f4', rows * columns, r.offset).reshape(rows, columns)
+
+    def get_placements(self):
+        '''Returns (field index, column, row, rotation, mirrored, height) of every tile using
+        a field file. Other indices mark cells covered by bigger tiles'''
+        rows, columns = np.nonzero(self.tiles['field'] < len(self.field_files))
+        tiles = self.tiles[rows, columns]
+        return [(int(t['field']), int(c), int(r), int(t['rotation']) & 3, bool(t['mirrored']), int(t['height']))
+                for t, c, r in zip(tiles, columns, rows)]
+
+    def get_used_fields(self):
+        # field indices in order of first use
+        fields = self.tiles['field'].ravel()
+        fields = fields[fields < len(self.field_files)]
+        unique, first = np.unique(fields, return_index=True)
+        return [int(i) for i in unique[np.argsort(first)]]
+
+def read_track(path):
+    t = Track()
+    with open(path, 'rb') as file:
+        t.read(file.read())
+    return t
+
+def find_content_roots(track_path):
+    '''Returns content sources for tiles of a track, loose content folders first and then .cpk
+    archives of the game, as folder paths and (archive, prefix) tuples'''
+    roots = []
+    archives = []
+    folder = os.path.dirname(os.path.abspath(track_path))
+    while True:
+        for content in (os.path.join(folder, 'content'), os.path.join(folder, 'data', 'content')):
+            if os.path.isdir(content) and content not in roots:
+                roots.append(content)
+        data = os.path.join(folder, 'data')
+        if os.path.isdir(data):
+            archives += cpk.find_archives(data)
+
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            break
+        folder = parent
+
+    # broken archives are skipped, tiles are then searched in the others
+    for path in archives:
+        try:
+            roots.append((cpk.get_archive(path), 'content/'))
+        except (OSError, zipfile.BadZipFile) as e:
+            print('! Skipped broken archive {}: {}'.format(path, e))
+    return roots
+
+def find_content(roots, subfolder, name):
+    # returns (filepath, archive entry) of the first source having the file, or None
+    name = name.replace('\\', '/')
+    for root in roots:
+        if isinstance(root, tuple):
+            archive, prefix = root
+            entry = archive.find(prefix + subfolder + '/' + name)
+            if entry is not None:
+                return archive.path, entry
+            continue
+
+        path = os.path.join(root, subfolder, *name.split('/'))
+        if os.path.isfile(path):
+            return path, ''
+        # names in tracks don't always match the case of the files
+        folder, file_name = os.path.split(path)
+        if os.path.isdir(folder):
+            for f in os.listdir(folder):
+                if f.lower() == file_name.lower():
+                    return os.path.join(folder, f), ''
+    return None
+
+def read_content(source):
+    filepath, entry = source
+    if entry:
+        return cpk.get_archive(filepath).read(entry)
+    with open(filepath, 'rb') as file:
+        return file.read()
+
+def get_field_model(data):
+    # .cfl field files are text, the first .p3d name in them is the model of the tile
+    for line in str(data, 'latin-1').splitlines():
+        for word in line.split('#')[0].split():
+            if word.lower().endswith('.p3d'):
+                return word
+    return None
+
+def resolve_field(roots, field_file):
+    '''Returns (filepath, archive entry) of the model of a field file, or None if it can't be found'''
+    if field_file.lower().endswith('.p3d'):
+        return find_content(roots, 'models', field_file)
+
+    source = find_content(roots, 'tiles', field_file)
+    if source is None:
+        return None
+    model = get_field_model(read_content(source))
+    if model is None:
+        return None
+    return find_content(roots, 'models', model)
@@ -0,0 +1,210 @@
+import sys
+import glob
+import struct
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+from . import p3d
+
+# Integrity checks of p3d files. Vertices, polygons and texture infos of every mesh are checked
+# as arrays, so validating a model costs about as much as reading it from disk.
+#
+# Usage from the addon folder:
+#   python -m crashday.validate "mods/**/*.p3d"
+
+POLYGON_DTYPE = np.dtype([
+    ('p1', '<u2'), ('u1', '<f4'), ('v1', '<f4'),
+    ('p3', '<u2'), ('u3', '<f4'), ('v3', '<f4'),
+    ('p2', '<u2'), ('u2', '<f4'), ('v2', '<f4'),
+])
+
+class Validator:
+    '''Walks a whole p3d file in data and collects (offset, message) problems'''
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.errors = []
+
+    def error(self, offset, message):
+        self.errors.append((offset, message))
+
+    def need(self, offset, count, what):
+        # counts which don't fit into the rest of the file make every following offset wrong
+        if offset + count > self.size:
+            self.error(offset, '{} needs {} bytes, only {} left'.format(what, count, self.size - offset))
+            return False
+        return True
+
+    def tag(self, offset, name):
+        if self.data[offset:offset + len(name)] != name:
+            self.error(offset, 'Missing {} tag'.format(name.decode('ascii')))
+            return None
+        return offset + len(name)
+
+    def string(self, offset, what):
+        end = self.data.find(b'\x00', offset)
+        if end < 0:
+            self.error(offset, 'Unterminated {} name'.format(what))
+            return None
+        return end + 1
+
+    def floats(self, offset, count, what):
+        values = np.frombuffer(self.data, '<f4', count, offset)
+        bad = np.flatnonzero(~np.isfinite(values))
+        if len(bad):
+            self.error(offset + int(bad[0]) * 4, '{} has {} NaN or infinite values'.format(what, len(bad)))
+        return values
+
+    def check_mesh(self, offset, num_textures):
+        # returns the offset after the mesh or None if the rest of the file can't be read
+        start = offset
+        offset = self.string(offset, 'mesh')
+        if offset is None:
+            return None
+        name = str(self.data[start:offset - 1], 'utf-8', 'replace')
+
+        header_size = p3d.MESH_HEADER_SIZE + p3d.TEXTURE_INFO_SIZE * num_textures
+        if not self.need(offset, header_size + 2, 'Mesh {} header'.format(name)):
+            return None
+        self.floats(offset + 4, 6, 'Mesh {} position and size'.format(name))
+        infos_offset = offset + p3d.MESH_HEADER_SIZE
+        infos = np.frombuffer(self.data, '<u2', 7 * num_textures, infos_offset).reshape(-1, 7).astype(np.int64)
+        offset += header_size
+
+        num_vertices = struct.unpack_from('<H', self.data, offset)[0]
+        offset += 2
+        if not self.need(offset, p3d.VERTEX_SIZE * num_vertices + 2, 'Mesh {} with {} vertices'.format(name, num_vertices)):
+            return None
+        self.floats(offset, 3 * num_vertices, 'Mesh {} vertices'.format(name))
+        offset += p3d.VERTEX_SIZE * num_vertices
+
+        num_polys = struct.unpack_from('<H', self.data, offset)[0]
+        offset += 2
+        if not self.need(offset, p3d.POLYGON_SIZE * num_polys, 'Mesh {} with {} polygons'.format(name, num_polys)):
+            return None
+        polys = np.frombuffer(self.data, POLYGON_DTYPE, num_polys, offset)
+
+        indices = np.column_stack((polys['p1'], polys['p2'], polys['p3']))
+        bad = np.flatnonzero((indices >= num_vertices).any(axis=1))
+        if len(bad):
+            self.error(offset + int(bad[0]) * p3d.POLYGON_SIZE,
+                       'Mesh {}: {} polygons use vertices over num_vertices {}'.format(name, len(bad), num_vertices))
+
+        uvs = np.column_stack([polys[i] for i in ('u1', 'v1', 'u2', 'v2', 'u3', 'v3')])
+        bad = np.flatnonzero(~np.isfinite(uvs).all(axis=1))
+        if len(bad):
+            self.error(offset + int(bad[0]) * p3d.POLYGON_SIZE,
+                       'Mesh {}: {} polygons have NaN or infinite uvs'.format(name, len(bad)))
+
+        # runs of used textures must cover every polygon once, in any texture order
+        totals = infos[:, 1:].sum(axis=1)
+        used = np.flatnonzero(totals > 0)
+        starts = infos[used, 0]
+        order = np.argsort(starts, kind='stable')
+        starts = starts[order]
+        ends = starts + totals[used][order]
+        if len(used) == 0:
+            if num_polys:
+                self.error(infos_offset, 'Mesh {}: texture infos cover none of {} polygons'.format(name, num_polys))
+        elif starts[0] != 0 or ends[-1] != num_polys or (starts[1:] != ends[:-1]).any():
+            gaps = np.flatnonzero(starts[1:] != ends[:-1])
+            first = used[order][gaps[0] + 1] if len(gaps) else used[order][0 if starts[0] != 0 else -1]
+            self.error(infos_offset + int(first) * p3d.TEXTURE_INFO_SIZE,
+                       'Mesh {}: texture infos cover polygons {}..{} with gaps or overlaps, mesh has {} polygons'.format(
+                       name, int(starts[0]), int(ends[-1]), num_polys))
+
+        return offset + p3d.POLYGON_SIZE * num_polys
+
+    def check(self):
+        offset = self.tag(0, b'P3D\x02')
+        if offset is None or not self.need(offset, 12, 'Model size'):
+            return self.errors
+        self.floats(offset, 3, 'Model size')
+        offset += 12
+
+        offset = self.tag(offset, b'TEX')
+        if offset is None or not self.need(offset, 5, 'Texture list'):
+            return self.errors
+        num_textures = self.data[offset + 4]
+        offset += 5
+        for i in range(num_textures):
+            offset = self.string(offset, 'texture')
+            if offset is None:
+                return self.errors
+
+        offset = self.tag(offset, b'LIGHTS')
+        if offset is None or not self.need(offset, 6, 'Light list'):
+            return self.errors
+        num_lights = struct.unpack_from('<H', self.data, offset + 4)[0]
+        offset += 6
+        for i in range(num_lights):
+            offset = self.string(offset, 'light')
+            if offset is None or not self.need(offset, 23, 'Light'):
+                return self.errors
+            self.floats(offset, 4, 'Light position and range')
+            offset += 23
+
+        offset = self.tag(offset, b'MESHES')
+        if offset is None or not self.need(offset, 6, 'Mesh list'):
+            return self.errors
+        num_meshes = struct.unpack_from('<H', self.data, offset + 4)[0]
+        offset += 6
+        for i in range(num_meshes):
+            offset = self.tag(offset, b'SUBMESH')
+            if offset is None or not self.need(offset, 4, 'Mesh'):
+                return self.errors
+            offset = self.check_mesh(offset + 4, num_textures)
+            if offset is None:
+                return self.errors
+
+        offset = self.tag(offset, b'USER')
+        if offset is not None:
+            self.need(offset, 8, 'User data')
+
+        return self.errors
+
+def validate(data):
+    '''Checks a whole p3d file in bytes. Returns a list of (offset, message) problems, empty if the file is valid'''
+    return Validator(data).check()
+
+def validate_file(path):
+    with open(path, 'rb') as file:
+        return validate(file.read())
+
+def format_errors(errors, name=''):
+    return ['{}offset {}: {}'.format(name + ' ' if name else '', offset, message) for offset, message in errors]
+
+def check_path(path):
+    try:
+        return path, validate_file(path)
+    except OSError as e:
+        return path, [(0, str(e))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check p3d files for structural errors.')
+    parser.add_argument('inputs', nargs='+', help='p3d files or glob patterns, ** matches subfolders')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='amount of worker processes')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print broken files')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for pattern in args.inputs:
+        paths += sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+
+    broken = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for path, errors in executor.map(check_path, paths, chunksize=16):
+            if errors:
+                broken += 1
+                for line in format_errors(errors, path):
+                    print(line)
+            elif not args.quiet:
+                print('{} OK'.format(path))
+
+    print('{} files checked, {} broken'.format(len(paths), broken))
+    return 1 if broken else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import collections
+
+from . import p3d
+
+# Post-transform vertex cache optimization of p3d meshes.
+# Triangles are only reordered inside their (texture, material type) runs,
+# every run is a separate draw call in game, so texture infos stay valid
+# and the model looks exactly the same.
+
+# size of the simulated FIFO post-transform vertex cache
+CACHE_SIZE = 16
+
+def count_cache_misses(tris, cache_size=CACHE_SIZE):
+    misses = 0
+    cache = collections.deque()
+    cached = set()
+    for tri in tris:
+        for v in tri:
+            if v not in cached:
+                misses += 1
+                cache.append(v)
+                cached.add(v)
+                if len(cache) > cache_size:
+                    cached.discard(cache.popleft())
+
+    return misses
+
+def calc_acmr(m, cache_size=CACHE_SIZE):
+    # average cache miss ratio - vertices transformed per triangle.
+    # cache is flushed between runs as every run is a separate draw call
+    if len(m.polys) == 0:
+        return 0.0
+
+    misses = 0
+    for ti in m.texture_infos:
+        for material, start, count in ti.get_runs():
+            misses += count_cache_misses(p3d.get_tris(m.polys[start:start + count]), cache_size)
+
+    return misses / len(m.polys)
+
+def tipsify(tris, cache_size=CACHE_SIZE):
+    # Tipsify by Sander, Nehab and Barczak, 'Fast Triangle Reordering for
+    # Vertex Locality and Reduced Overdraw'.
+    # returns clusters of triangle indices, a new cluster is started every time
+    # the algorithm has to jump to a vertex which is not in the cache anymore
+    adjacency = {}
+    for t, tri in enumerate(tris):
+        for v in tri:
+            adjacency.setdefault(v, []).append(t)
+
+    live = {v: len(ts) for v, ts in adjacency.items()}
+    timestamps = dict.fromkeys(adjacency, 0)
+    emitted = [False] * len(tris)
+    dead_end = []
+
+    # vertices in first use order, used when the dead-end stack runs out
+    vertex_order = list(adjacency)
+    cursor = 0
+
+    time = cache_size + 1
+    clusters = []
+    cluster = []
+
+    fan = vertex_order[0] if vertex_order else None
+    while fan is not None:
+        candidates = []
+        for t in adjacency[fan]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            cluster.append(t)
+            for v in tris[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - timestamps[v] > cache_size:
+                    timestamps[v] = time
+                    time += 1
+
+        # pick the next fanning vertex which will still be in the cache
+        # after all of its triangles are emitted
+        fan = None
+        best_priority = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - timestamps[v] + 2 * live[v] <= cache_size:
+                    priority = time - timestamps[v]
+                if priority > best_priority:
+                    best_priority = priority
+                    fan = v
+
+        if fan is not None:
+            continue
+
+        # dead-end, try recently used vertices first
+        while dead_end:
+            v = dead_end.pop()
+            if live[v] > 0:
+                fan = v
+                break
+
+        if fan is None:
+            while cursor < len(vertex_order):
+                v = vertex_order[cursor]
+                if live[v] > 0:
+                    fan = v
+                    break
+                cursor += 1
+
+        if cluster and (fan is None or time - timestamps[fan] > cache_size):
+            clusters.append(cluster)
+            cluster = []
+
+    if cluster:
+        clusters.append(cluster)
+
+    return clusters
+
+def sort_clusters_for_overdraw(clusters, tris, vertices):
+    # draw clusters which face away from the center of the run first,
+    # they are the most likely to occlude the rest of the model
+    def sub(a, b):
+        return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+    def cross(a, b):
+        return (a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0])
+
+    centroids = []
+    normals = []
+    center = [0.0, 0.0, 0.0]
+    for cluster in clusters:
+        c = [0.0, 0.0, 0.0]
+        n = [0.0, 0.0, 0.0]
+        for t in cluster:
+            a, b, d = (vertices[v] for v in tris[t])
+            # area weighted normal
+            tn = cross(sub(b, a), sub(d, a))
+            for i in range(3):
+                c[i] += (a[i] + b[i] + d[i]) / 3.0
+                n[i] += tn[i]
+        for i in range(3):
+            center[i] += c[i]
+            c[i] /= len(cluster)
+        centroids.append(c)
+        normals.append(n)
+
+    num_tris = sum(len(cluster) for cluster in clusters)
+    center = [i / num_tris for i in center]
+
+    def occlusion(ci):
+        dc = sub(centroids[ci], center)
+        n = normals[ci]
+        return dc[0]*n[0] + dc[1]*n[1] + dc[2]*n[2]
+
+    order = sorted(range(len(clusters)), key=occlusion, reverse=True)
+    return [clusters[ci] for ci in order]
+
+def reorder_vertices(m):
+    # renumber vertices in the order they are first used by polygons
+    # for better vertex fetch locality
+    remap = {}
+    for pol in m.polys:
+        for v in (pol.p1, pol.p2, pol.p3):
+            if v not in remap:
+                remap[v] = len(remap)
+
+    # vertices which are not used by any polygon keep their order at the end
+    for v in range(len(m.vertices)):
+        if v not in remap:
+            remap[v] = len(remap)
+
+    vertices = [None] * len(m.vertices)
+    for old, new in remap.items():
+        vertices[new] = m.vertices[old]
+    m.vertices = vertices
+
+    for pol in m.polys:
+        pol.p1 = remap[pol.p1]
+        pol.p2 = remap[pol.p2]
+        pol.p3 = remap[pol.p3]
+
+def optimize_mesh(m, overdraw=False, cache_size=CACHE_SIZE):
+    # reorders triangles of every run of the mesh and renumbers its vertices
+    # returns acmr before and after the optimization
+    before = calc_acmr(m, cache_size)
+
+    old_polys = list(m.polys)
+    for ti in m.texture_infos:
+        for material, start, count in ti.get_runs():
+            if count < 2:
+                continue
+
+            run = m.polys[start:start + count]
+            tris = p3d.get_tris(run)
+            clusters = tipsify(tris, cache_size)
+            if overdraw and len(clusters) > 1:
+                clusters = sort_clusters_for_overdraw(clusters, tris, m.vertices)
+
+            m.polys[start:start + count] = [run[t] for cluster in clusters for t in cluster]
+
+    after = calc_acmr(m, cache_size)
+
+    # tipsify is a heuristic, keep the original order if it did not help
+    if after > before:
+        m.polys = old_polys
+        after = before
+
+    reorder_vertices(m)
+
+    return before, after
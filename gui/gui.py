@@ -87,4 +87,70 @@ class DATA_PT_p3d_mesh(bpy.types.Panel):
         layout.label(text='Only the last four are set manually, other ones are set by the game.')
         layout.label(text='They are not designed for editing in p3d, but you may still try.')
         layout.label(text='Main, Tracing and Collision are auto assigned on export')
-        layout.prop_menu_enum(settings, 'flags')
\ No newline at end of file
+        layout.prop_menu_enum(settings, 'flags')
+
+        layout.prop(settings, 'generate_lods')
+
+class VIEW3D_PT_p3d_report(bpy.types.Panel):
+    bl_idname      = 'VIEW3D_PT_p3d_report'
+    bl_label       = 'Crashday - Export Report'
+    bl_space_type  = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category    = 'Crashday'
+
+    def draw(self, context):
+        layout = self.layout
+
+        # filled by the exporter
+        text = bpy.data.texts.get('p3d export report')
+        if text is None:
+            layout.label(text='Export a model or do a dry run to see its report')
+            return
+
+        col = layout.column(align=True)
+        for line in text.lines:
+            if line.body:
+                col.label(text=line.body, icon='ERROR' if line.body.startswith('!') else 'NONE')
+
+class VIEW3D_PT_p3d_source(bpy.types.Panel):
+    bl_idname      = 'VIEW3D_PT_p3d_source'
+    bl_label       = 'Crashday - Source File'
+    bl_space_type  = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category    = 'Crashday'
+
+    @classmethod
+    def poll(cls, context):
+        return context.view_layer.active_layer_collection.collection.cdp3d.filepath != ''
+
+    def draw(self, context):
+        layout = self.layout
+        col = context.view_layer.active_layer_collection.collection
+        settings = col.cdp3d
+
+        layout.label(text=bpy.path.basename(settings.filepath))
+        if settings.archive_entry:
+            layout.label(text=settings.archive_entry)
+        layout.prop(settings, 'watch')
+        layout.operator('import_scene.cdp3d_reload', text='Reload changed meshes')
+
+class VIEW3D_PT_p3d_library(bpy.types.Panel):
+    bl_idname      = 'VIEW3D_PT_p3d_library'
+    bl_label       = 'Crashday - Model Library'
+    bl_space_type  = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category    = 'Crashday'
+
+    def draw(self, context):
+        layout = self.layout
+        settings = context.scene.cdp3d_library
+
+        layout.prop(settings, 'folder')
+        layout.prop(settings, 'filter', icon='VIEWZOOM')
+        layout.operator('import_scene.cdp3d_library_refresh', icon='FILE_REFRESH')
+
+        if settings.folder:
+            layout.template_icon_view(settings, 'model', show_labels=True, scale=6.0)
+            layout.operator('import_scene.cdp3d_library_import', icon='IMPORT')
+
+        layout.operator('import_scene.cdp3d_clear_linked_cache', icon='TRASH')
@@ -1,14 +1,54 @@
 import bpy
+import bmesh
+import io
+import os
+import sys
 import struct
+import hashlib
+import pickle
 import datetime
+import tempfile
+import subprocess
 import mathutils
+import numpy as np
 
 from ..crashday import p3d
+from ..crashday import vcache
+from ..crashday import compact
+from ..crashday import split
+from ..crashday import lod
+from ..crashday import proxy
+from ..crashday import atlas
+from ..crashday import report
+from ..crashday import validate
+from ..crashday import batch
+from ..crashday import cache
+from ..crashday import dds
+from ..crashday import edgesplit
+from . import occlusion
 
 if 'bpy' in locals():
     import importlib
     importlib.reload(p3d)
-
+    importlib.reload(vcache)
+    importlib.reload(compact)
+    importlib.reload(split)
+    importlib.reload(lod)
+    importlib.reload(proxy)
+    importlib.reload(atlas)
+    importlib.reload(report)
+    importlib.reload(validate)
+    importlib.reload(batch)
+    importlib.reload(cache)
+    importlib.reload(dds)
+    importlib.reload(edgesplit)
+    importlib.reload(occlusion)
+
+
+# name of the text datablock storing the last export report
+REPORT_TEXT_NAME = 'p3d export report'
+# below this amount of polys to decimate, summed over all levels, LODs are generated in Blender
+LOD_PROCESS_POLYS = 20000
 
 def color_to_int(value):
     return int('%02x%02x%02x' % (int(value[0]*255), int(value[1]*255), int(value[2]*255)), 16)
@@ -19,7 +59,43 @@ def error_no_main(self, context):
 def sanitise_mesh_name(name):
     return name.replace(' ', '_')
 
-def get_textures_used(ob):
+def strip_name_suffix(name):
+    # blender adds .001 like suffixes to duplicate names,
+    # so every model in a batch export will have them on main, mainshad etc.
+    base, sep, suffix = name.rpartition('.')
+    if sep and suffix.isdigit():
+        return base
+    return name
+
+class ExportLog:
+    def __init__(self, path=None):
+        self.file = None
+        if path:
+            self.file = open(path, 'a')
+
+    def write(self, message, echo=True):
+        if echo:
+            print(message)
+        if self.file:
+            self.file.write(message + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def get_material_texture(mat):
+    if mat.cdp3d.use_texture and mat.node_tree:
+        img = mat.node_tree.nodes.get('Image Texture') # get texture used in the material
+        if img and img.image: # if exists and has linked texture
+            tn = img.image.name.rsplit( ".", 1 )[0] # remove extension if present
+            mat.cdp3d.material_name = tn
+            return tn
+
+    # otherwise use material preset in cdp3d material properties
+    return mat.cdp3d.material_name
+
+def get_textures_used(ob, texture_cache=None):
     textures = []
 
     m = None
@@ -42,61 +118,20 @@ def get_textures_used(ob):
         ob.data.materials.append(col_white)
 
     for mat in ob.data.materials:
-        tn = ''
-        if mat.cdp3d.use_texture:
-            if mat.node_tree:
-                img = mat.node_tree.nodes.get('Image Texture') # get texture used in the material
-                if img and img.image: # if exists and has linked texture
-                    tn = img.image.name.rsplit( ".", 1 )[0] # remove extension if present
-                    mat.cdp3d.material_name = tn
-                else:
-                    tn = mat.cdp3d.material_name # otherwise use material preset in cdp3d material properties
-            else:
-                tn = mat.cdp3d.material_name
+        # materials are shared between models, so batch exports resolve each one only once
+        if texture_cache is not None and mat.name in texture_cache:
+            tn = texture_cache[mat.name]
         else:
-            tn = mat.cdp3d.material_name
+            tn = get_material_texture(mat)
+            if texture_cache is not None:
+                texture_cache[mat.name] = tn
 
         if tn not in textures:
             textures.append(tn)
 
     return textures
 
-def save(operator,
-         context, filepath='',
-         use_selection=True,
-         use_mesh_modifiers=True,
-         use_empty_for_floor_level=True,
-         bbox_mode='MAIN',
-         force_main_mesh=False,
-         export_log=True):
-
-    # get the folder where file will be saved and add a log in that folder
-    work_path = '\\'.join(filepath.split('\\')[0:-1])
-
-    log_file = None
-    if export_log:
-        log_file = open(work_path + '//export-log.txt', 'a')
-    date = datetime.datetime.now()
-    if log_file:
-        log_file.write('Started exporting on {}\nFile path: {}\n'.format(date.strftime('%d-%m-%Y %H:%M:%S'), filepath))
-    print('\nExporting file to {}'.format(filepath))
-
-    # create empty p3d model
-    p = p3d.P3D()
-
-    # exit edit mode
-    if bpy.ops.object.mode_set.poll():
-        bpy.ops.object.mode_set(mode='OBJECT')
-
-    # get dependencies graph for applying modifiers
-    dg = bpy.context.evaluated_depsgraph_get()
-
-    col = bpy.context.scene.collection
-
-    # stores the list of exported meshes - useful for modders to define in .cca
-    exported_meshes_string = ''
-
-    # store list oj objects to export
+def get_export_objects(col, dg, use_selection, use_mesh_modifiers):
     objects = []
     for ob in col.all_objects:
          if ob.visible_get():
@@ -106,6 +141,248 @@ def save(operator,
             elif ob.select_get():
                 objects.append(ob.evaluated_get(dg) if use_mesh_modifiers else ob)
 
+    return objects
+
+def get_split_vertices(mesh, split_seams=False):
+    '''Splits vertices of a mesh along sharp edges, edges over the auto smooth angle and optionally seams.
+    Returns the new vertex of every loop and the mesh vertex of every new vertex'''
+    loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+    loop_edges = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loop_vertices)
+    mesh.loops.foreach_get('edge_index', loop_edges)
+
+    loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+    loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_starts)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+    loop_polys, next_loops = edgesplit.get_loop_polys(loop_starts, loop_totals)
+
+    sharp_edges = np.empty(len(mesh.edges), dtype=bool)
+    mesh.edges.foreach_get('use_edge_sharp', sharp_edges)
+
+    if mesh.use_auto_smooth:
+        normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+        mesh.polygons.foreach_get('normal', normals)
+        sharp_edges |= edgesplit.get_angle_sharp_edges(loop_edges, loop_polys, normals.reshape(-1, 3),
+                                                       len(mesh.edges), mesh.auto_smooth_angle)
+
+    if split_seams:
+        seams = np.empty(len(mesh.edges), dtype=bool)
+        mesh.edges.foreach_get('use_seam', seams)
+        sharp_edges |= seams
+
+    return edgesplit.split_vertices(loop_vertices, loop_edges, next_loops, sharp_edges)
+
+def get_bounds(ob, mesh, current_low = [0.0,0.0,0.0], current_max = [0.0,0.0,0.0]):
+    low = current_low
+    high = current_max
+
+    if len(mesh.vertices) > 0:
+        low = ob.matrix_world @ mesh.vertices[0].co
+        high = ob.matrix_world @ mesh.vertices[0].co
+
+    for v in mesh.vertices:
+        pos = ob.matrix_world @ v.co
+        for i in range(3):
+            if low[i] > pos[i]:
+                low[i] = pos[i]
+            if high[i] < pos[i]:
+                high[i] = pos[i]
+
+    return (low, high)
+
+def get_textures_folder(work_path):
+    # mods keep models and textures in sibling folders
+    parent, folder = os.path.split(os.path.normpath(work_path))
+    if folder.lower() == 'models':
+        return os.path.join(parent, 'textures')
+    return work_path
+
+def find_texture_image(texture):
+    for img in bpy.data.images:
+        if img.name.rsplit('.', 1)[0] == texture and img.size[0] > 0 and img.size[1] > 0:
+            return img
+    return None
+
+def get_image_pixels(img):
+    # returns (height, width, 4) rgba pixels, bottom row first
+    w, h = img.size
+    pixels = np.empty(w * h * img.channels, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(h, w, img.channels)
+
+    if img.channels == 4:
+        return pixels
+
+    rgba = np.ones((h, w, 4), dtype=np.float32)
+    if img.channels < 3:
+        rgba[..., :3] = pixels[..., :1]
+    else:
+        rgba[..., :3] = pixels[..., :3]
+    return rgba
+
+def get_transparent_textures(textures, log):
+    # textures with any alpha below one, textures which can't be found are treated as transparent
+    transparent = set()
+    for tex in textures:
+        img = find_texture_image(tex)
+        if img is None:
+            log.write('! Texture {} was not found, its polys don\'t hide other polys.'.format(tex))
+            transparent.add(tex)
+        elif (get_image_pixels(img)[..., 3] < 1.0).any():
+            transparent.add(tex)
+    return transparent
+
+def save_tga(name, pixels, path):
+    h, w = pixels.shape[:2]
+    img = bpy.data.images.new(name, w, h, alpha=True)
+    img.pixels.foreach_set(pixels.ravel())
+    img.filepath_raw = path
+    img.file_format = 'TARGA'
+    img.save()
+    bpy.data.images.remove(img)
+
+def save_atlas_images(atlas_images, log):
+    # atlases are written only once the model passed dry run and budget checks
+    for name, pixels, path in atlas_images:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_tga(name, pixels, path)
+        log.write('Saved texture atlas {}'.format(path))
+
+def pack_texture_atlas(p, meshes, atlas_name, directory, atlas_size, max_texture_size, log):
+    '''Packs small textures of meshes into atlases and remaps their polys.
+    Returns (name, pixels, path) of every atlas image, they are composed in memory and not saved'''
+    images = {}
+    for tex in atlas.get_packable_textures(meshes, p.textures):
+        img = find_texture_image(tex)
+        if img is not None and max(img.size) <= max_texture_size:
+            images[tex] = img
+
+    if len(images) < 2:
+        log.write('Texture atlas: less than two small untiled textures found, nothing to pack.')
+        return []
+
+    textures = list(images)
+    sizes = [tuple(images[tex].size) for tex in textures]
+    placements, atlas_sizes = atlas.pack_rects(sizes, atlas_size)
+
+    runs_before = [p3d.count_runs(m) for m in meshes]
+
+    atlas_images = []
+    rects = {}
+    atlas_names = ['{}{}'.format(atlas_name, a) for a in range(len(atlas_sizes))]
+    for a, size in enumerate(atlas_sizes):
+        packed = [i for i, placement in enumerate(placements) if placement is not None and placement[0] == a]
+
+        pixels = atlas.compose_atlas(size,
+                                     [get_image_pixels(images[textures[i]]) for i in packed],
+                                     [placements[i] for i in packed])
+        path = os.path.join(directory, atlas_names[a] + '.tga')
+        atlas_images.append((atlas_names[a], pixels, path))
+        log.write('Texture atlas {} {}x{}: {}'.format(path, size[0], size[1], ' '.join(textures[i] for i in packed)))
+
+        for i in packed:
+            rects[textures[i]] = (atlas_names[a], placements[i][1], placements[i][2],
+                                  sizes[i][0], sizes[i][1], size[0], size[1])
+
+    atlas.remap_polys(meshes, rects)
+
+    p.textures = [tex for tex in p.textures if tex not in rects] + atlas_names
+    p.num_textures = len(p.textures)
+
+    for m, before in zip(meshes, runs_before):
+        m.sort_polys(p.textures)
+        log.write('Texture atlas {}: {} -> {} texture runs'.format(m.name, before, p3d.count_runs(m)))
+
+    return atlas_images
+
+def get_convex_hull(vertices):
+    bm = bmesh.new()
+    for v in vertices:
+        bm.verts.new(v)
+
+    hull = bmesh.ops.convex_hull(bm, input=bm.verts[:])
+    bmesh.ops.delete(bm, geom=hull['geom_interior'] + hull['geom_unused'], context='VERTS')
+    bmesh.ops.triangulate(bm, faces=bm.faces[:])
+
+    bm.verts.index_update()
+    hull_vertices = [tuple(v.co) for v in bm.verts]
+    hull_tris = [tuple(v.index for v in f.verts) for f in bm.faces]
+    bm.free()
+
+    return hull_vertices, hull_tris
+
+def run_tool(module, args, log):
+    # process pools only work outside of Blender, so crashday modules run in Blender's python from the addon folder.
+    # returns True if the tool succeeded
+    python = getattr(bpy.app, 'binary_path_python', sys.executable)
+    addon_folder = os.path.dirname(os.path.dirname(os.path.abspath(p3d.__file__)))
+    result = subprocess.run([python, '-m', 'crashday.' + module] + args, cwd=addon_folder,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in result.stdout.splitlines():
+        log.write(line)
+    return result.returncode == 0
+
+def generate_lod_meshes(meshes, ratios, textures, log):
+    # returns the list of generated levels of every mesh, levels are empty if generation failed.
+    # starting the process pool takes longer than decimating a few small meshes
+    if sum(len(m.polys) for m in meshes) * len(lod.get_levels(ratios)) < LOD_PROCESS_POLYS:
+        return [[lod.decimate_mesh(m, level, ratio, textures) for level, ratio in lod.get_levels(ratios)] for m in meshes]
+
+    with tempfile.TemporaryDirectory() as folder:
+        input_path = os.path.join(folder, 'meshes.pickle')
+        output_path = os.path.join(folder, 'levels.pickle')
+        with open(input_path, 'wb') as file:
+            pickle.dump({'meshes': [lod.get_mesh_data(m) for m in meshes], 'ratios': ratios, 'textures': textures}, file)
+
+        if not run_tool('lod', [input_path, output_path], log):
+            log.write('!!! LOD generation failed, no levels were generated.')
+            return [[] for m in meshes]
+
+        with open(output_path, 'rb') as file:
+            return [[lod.make_mesh(data, textures) for data in levels] for levels in pickle.load(file)]
+
+def build_p3d(objects, log,
+              floor_level_location=mathutils.Vector((0.0, 0.0, 0.0)),
+              use_empty_for_floor_level=True,
+              bbox_mode='MAIN',
+              force_main_mesh=False,
+              compact_geometry=False,
+              weld_distance=0.0001,
+              optimize_vertex_cache=False,
+              optimize_overdraw=False,
+              generate_lods=False,
+              lod_ratios={},
+              generate_shadow_mesh=False,
+              shadow_mesh_polys=500,
+              generate_collision_mesh=False,
+              collision_mesh_mode='HULL',
+              collision_mesh_polys=200,
+              use_texture_atlas=False,
+              atlas_size=1024,
+              atlas_max_texture_size=256,
+              atlas_name='atlas',
+              atlas_directory='',
+              chunk_mode='NONE',
+              chunk_size=10.0,
+              chunk_polys=2000,
+              batch_static_meshes=False,
+              batch_max_polys=4000,
+              batch_cell_size=20.0,
+              remove_hidden_faces=False,
+              hidden_face_rays=32,
+              split_sharp_edges=False,
+              split_seams=False,
+              texture_cache=None,
+              report_lines=None,
+              atlas_images=None,
+              name_of=lambda ob: ob.name):
+    '''Converts a list of (evaluated) objects into a p3d model.
+    Returns the model and the list of exported mesh names, or None if the model can't be exported'''
+
+    # create empty p3d model
+    p = p3d.P3D()
+
     # store the list of all the used textures
     p.textures = []
 
@@ -117,74 +394,60 @@ def save(operator,
     main_like = None
     any = None
 
+    # scene order depends on how objects were linked, sort them so exports of the same scene are byte identical
+    objects = sorted(objects, key=lambda ob: (name_of(ob), ob.name))
+
     # find the main, sadow and coll mesh of the model
     for ob in objects:
         if ob.type == 'MESH':
             any = ob
-            p.textures = list(set(p.textures + get_textures_used(ob)))
-            if 'main' in ob.name:
+            for tex in get_textures_used(ob, texture_cache):
+                if tex not in p.textures:
+                    p.textures.append(tex)
+            name = name_of(ob)
+            if 'main' in name:
                 main_like = ob
-            if ob.name == 'main':
+            if name == 'main':
                 main = ob
                 main_like = ob
                 any = ob
-            if ob.name == 'mainshad':
+            if name == 'mainshad':
                 shad = ob
-            if ob.name == 'maincoll':
+            if name == 'maincoll':
                 coll = ob
 
     # save the amount of textures used in p3d model
+    p.textures.sort()
     p.num_textures = len(p.textures)
 
     # p3d models must have a main mesh
     if main is None:
         if not force_main_mesh:
-            bpy.context.window_manager.popup_menu(error_no_main, title='No main mesh', icon='ERROR')
-            print('!!! Failed to export p3d. No main mesh found.')
-            if log_file:
-                log_file.write('!!! Failed to export p3d. No main mesh found.\n')
-                log_file.close()
-            return {'CANCELLED'}
+            log.write('!!! Failed to export p3d. No main mesh found.')
+            return None
         else:
             if main_like is not None:
-                print('Found main like mesh: {}. Using as main'.format(main_like.name))
+                log.write('Found main like mesh: {}. Using as main'.format(main_like.name))
                 main = main_like
             elif any is not None:
-                print('Found some mesh: {}. Using as main'.format(any.name))
+                log.write('Found some mesh: {}. Using as main'.format(any.name))
                 main = any
             else:
-                print('!!! Failed to export p3d. No meshes found.')
-                if log_file:
-                    log_file.write('!!! Failed to export p3d. No meshes found.\n')
-                    log_file.close()
-                return {'CANCELLED'}
-
-    if shad is None:
-        print('! Shadow mesh was not found, using main mesh for shadow.')
-        if log_file:
-            log_file.write('! Shadow mesh was not found, using main mesh for shadow.\n')
-    if coll is None:
-        print('! Collision mesh was not found, using main mesh for collisions.')
-        if log_file:
-            log_file.write('! Collision mesh was not found, using main mesh for collisions.\n')
-
-    def get_bounds(ob, mesh, current_low = [0.0,0.0,0.0], current_max = [0.0,0.0,0.0]):
-        low = current_low
-        high = current_max
-
-        if len(mesh.vertices) > 0:
-            low = ob.matrix_world @ mesh.vertices[0].co
-            high = ob.matrix_world @ mesh.vertices[0].co
-
-        for v in mesh.vertices:
-            pos = ob.matrix_world @ v.co
-            for i in range(3):
-                if low[i] > pos[i]:
-                    low[i] = pos[i]
-                if high[i] < pos[i]:
-                    high[i] = pos[i]
-
-        return (low, high)
+                log.write('!!! Failed to export p3d. No meshes found.')
+                return None
+
+    # generated meshes replace using the main mesh for shadows and collisions
+    generate_shad = shad is None and generate_shadow_mesh
+    generate_coll = coll is None and generate_collision_mesh
+
+    if generate_shad:
+        log.write('! Shadow mesh was not found, generating it from main mesh.')
+    elif shad is None:
+        log.write('! Shadow mesh was not found, using main mesh for shadow.')
+    if generate_coll:
+        log.write('! Collision mesh was not found, generating it from main mesh.')
+    elif coll is None:
+        log.write('! Collision mesh was not found, using main mesh for collisions.')
 
     # the main mesh in p3d is always at 0.0.
     # this means we need to move all other models alongside main mesh
@@ -192,18 +455,20 @@ def save(operator,
     all_bounds = get_bounds(main, main_mesh)
     main_bounds = get_bounds(main, main_mesh)
     main_center = (main_bounds[1] + main_bounds[0])/2.0
-    
-    floor_level = bpy.data.objects.get('floor_level')
-    if floor_level is None:
-        floor_level = bpy.data.objects.new('floor_level', None)
-        col.objects.link(floor_level)
-        floor_level.location = (0.0,0.0,0.0)
-        floor_level.empty_display_type = 'PLAIN_AXES'
 
     if use_empty_for_floor_level:
-        delta = (floor_level.location - main_bounds[0])[2]
+        delta = (floor_level_location - main_bounds[0])[2]
         main_center[2] += delta/2
 
+    # stores the list of exported meshes - useful for modders to define in .cca
+    exported_meshes = []
+
+    # converted meshes, finished after all of them are converted
+    # so lods can be generated for all of them at once
+    built_meshes = []
+    lod_meshes = []
+    main_m = None
+
     # iterate through all objects in the scene and save into p3d model
     p.meshes = []
     p.lights = []
@@ -212,7 +477,7 @@ def save(operator,
             p.num_lights += 1
 
             light = p3d.Light()
-            light.name = sanitise_mesh_name(ob.name)
+            light.name = sanitise_mesh_name(name_of(ob))
             light.pos = ob.matrix_world.to_translation() - main_center + main.matrix_world.to_translation()
             light.range = ob.data.energy
             light.color = color_to_int(ob.data.color)
@@ -226,7 +491,7 @@ def save(operator,
         if ob.type == 'MESH':
             m = p3d.Mesh()
 
-            m.name = sanitise_mesh_name(ob.name)
+            m.name = sanitise_mesh_name(name_of(ob))
 
             mesh = ob.to_mesh()
 
@@ -246,10 +511,18 @@ def save(operator,
                 #p.height = max(p.height, all_bounds[1][2] - all_bounds[0][2])
                 p.depth = max(p.depth, all_bounds[1][1] - all_bounds[0][1])
 
+            # hard edges are made by splitting vertices, loops then point to the split vertices
+            loop_vertices = None
+            source_vertices = range(len(mesh.vertices))
+            if split_sharp_edges:
+                loop_vertices, source_vertices = get_split_vertices(mesh, split_seams)
+                if len(source_vertices) != len(mesh.vertices):
+                    log.write('Split hard edges of {}: vertices {} -> {}'.format(m.name, len(mesh.vertices), len(source_vertices)))
+
             # save vertices
             m.vertices = []
-            for v in mesh.vertices:
-                m.vertices.append((ob.matrix_world @ v.co) - (mb[1] + mb[0])/2.0)
+            for i in source_vertices:
+                m.vertices.append((ob.matrix_world @ mesh.vertices[i].co) - (mb[1] + mb[0])/2.0)
 
             m.num_vertices = len(m.vertices)
 
@@ -260,8 +533,7 @@ def save(operator,
                 m.height += ((mb[1] + mb[0]))[2]
 
                 if use_empty_for_floor_level:
-                    delta = (floor_level.location - main_bounds[0])[2]
-                    p.height = -floor_level.location[2]*2
+                    p.height = -floor_level_location[2]*2
                 else:
                     p.height = m.height
 
@@ -289,9 +561,9 @@ def save(operator,
             # save the flags
             if ob == main:
                 m.flags |= 1
-                if shad is None:
+                if shad is None and not generate_shad:
                     m.flags |= 4
-                if coll is None:
+                if coll is None and not generate_coll:
                     m.flags |= 8
             elif ob == shad:
                 m.flags ^= 2
@@ -302,9 +574,8 @@ def save(operator,
 
             mesh.calc_loop_triangles()
 
-            # save polys in blender order and texture infos
-            m.texture_infos = [p3d.TextureInfo() for i in range(p.num_textures)]
-            polys = []
+            # save polys in blender order
+            m.polys = []
             if len(mesh.uv_layers) == 0:
                 mesh.uv_layers.new()
             for uv_layer in mesh.uv_layers:
@@ -317,20 +588,6 @@ def save(operator,
                     # TODO: if a polygon is assigned to a material which was deleted this will error
                     pol.texture = ob.data.materials[tri.material_index].cdp3d.material_name
                     pol.material = ob.data.materials[tri.material_index].cdp3d.material_type
-                    
-                    i = p.textures.index(pol.texture)
-                    if pol.material == 'FLAT':
-                        m.texture_infos[i].num_flat += 1
-                    if pol.material == 'FLAT_METAL':
-                        m.texture_infos[i].num_flat_metal += 1
-                    if pol.material == 'GOURAUD':
-                        m.texture_infos[i].num_gouraud += 1
-                    if pol.material == 'GOURAUD_METAL':
-                        m.texture_infos[i].num_gouraud_metal += 1
-                    if pol.material == 'GOURAUD_METAL_ENV':
-                        m.texture_infos[i].num_gouraud_metal_env += 1
-                    if pol.material == 'SHINING':
-                        m.texture_infos[i].num_shining += 1
 
                     # polygon info
                     pol.p1 = tri.vertices[0]
@@ -342,68 +599,472 @@ def save(operator,
                     pol.p3 = tri.vertices[2]
                     pol.u3, pol.v3 = uv_layer.data[tri.loops[2]].uv
 
-                    polys.append(pol)
+                    if loop_vertices is not None:
+                        pol.p1, pol.p2, pol.p3 = (int(loop_vertices[l]) for l in tri.loops)
+
+                    m.polys.append(pol)
+
+            if compact_geometry:
+                # split edges are borders, which are never welded
+                sharp_vertices = [] if split_sharp_edges else [v for e in mesh.edges if e.use_edge_sharp for v in e.vertices]
+                stats = compact.compact_mesh(m, weld_distance, sharp_vertices)
+                log.write('Compacted {}: vertices {} -> {} ({} welded, {} unused), polys {} -> {} ({} degenerate, {} duplicate)'.format(
+                    m.name, stats['vertices'], m.num_vertices, stats['welded'], stats['unused'],
+                    stats['polys'], len(m.polys), stats['degenerate'], stats['duplicate']))
 
             # reorder polys into CD format, to align texture infos
-            m.polys = []
-            for t in range(len(p.textures)):
-                if t > 0:
-                    m.texture_infos[t].texture_start = m.texture_infos[t-1].texture_start 
-                    m.texture_infos[t].texture_start += m.texture_infos[t-1].num_flat
-                    m.texture_infos[t].texture_start += m.texture_infos[t-1].num_flat_metal
-                    m.texture_infos[t].texture_start += m.texture_infos[t-1].num_gouraud
-                    m.texture_infos[t].texture_start += m.texture_infos[t-1].num_gouraud_metal
-                    m.texture_infos[t].texture_start += m.texture_infos[t-1].num_gouraud_metal_env
-                    m.texture_infos[t].texture_start += m.texture_infos[t-1].num_shining
-
-                for i, pol in enumerate(polys):
-                    if pol.texture == p.textures[t] and pol.material == 'FLAT':
-                        m.polys.append(pol)
-                
-                for i, pol in enumerate(polys):
-                    if pol.texture == p.textures[t] and pol.material == 'FLAT_METAL':
-                        m.polys.append(pol)
-
-                for i, pol in enumerate(polys):
-                    if pol.texture == p.textures[t] and pol.material == 'GOURAUD':
-                        m.polys.append(pol)
-
-                for i, pol in enumerate(polys):
-                    if pol.texture == p.textures[t] and pol.material == 'GOURAUD_METAL':
-                        m.polys.append(pol)
-
-                for i, pol in enumerate(polys):
-                    if pol.texture == p.textures[t] and pol.material == 'GOURAUD_METAL_ENV':
-                        m.polys.append(pol)
-
-                for i, pol in enumerate(polys):
-                    if pol.texture == p.textures[t] and pol.material == 'SHINING':
-                        m.polys.append(pol)
-
-
-            m.num_polys = len(m.polys)
+            m.sort_polys(p.textures)
+
+            use_lods = generate_lods and mesh.cdp3d.generate_lods
+
+            ob.to_mesh_clear()
 
             if len(m.vertices) == 0 or len(m.polys) == 0:
-                message = 'Can\'t export empty mesh: {}. {} vertices, {} polys. Ignoring'.format(m.name, len(m.vertices), len(m.polys))
-                print(message)
-                if log_file:
-                    log_file.write(message)
-            else:
-                p.num_meshes += 1
-                p.meshes.append(m)
-                exported_meshes_string += ob.name + ' '
+                log.write('Can\'t export empty mesh: {}. {} vertices, {} polys. Ignoring'.format(m.name, len(m.vertices), len(m.polys)))
+                continue
 
-    # save p3d into file
-    file = open(filepath, 'wb')
+            built_meshes.append((name_of(ob), m))
+            if ob == main:
+                main_m = m
+            if use_lods:
+                lod_meshes.append(m)
+
+    # hidden triangles are removed before anything is generated from the meshes
+    if remove_hidden_faces:
+        removed = occlusion.remove_hidden_faces([m for name, m in built_meshes], p.textures, hidden_face_rays,
+                                                get_transparent_textures(p.textures, log))
+        for name, count in removed:
+            log.write('Removed {} hidden polys from {}'.format(count, name))
+        for name, m in built_meshes:
+            if len(m.polys) == 0:
+                log.write('{} is hidden completely, it was not exported'.format(m.name))
+        built_meshes = [(name, m) for name, m in built_meshes if len(m.polys) > 0]
+        log.write('Hidden face removal: {} polys removed from {} meshes'.format(sum(count for name, count in removed), len(removed)))
+
+    # atlas changes texture runs, so it has to be done before anything depending on them
+    # atlas images are only composed here, the caller saves them after dry run and budget checks
+    if use_texture_atlas:
+        images = pack_texture_atlas(p, [m for name, m in built_meshes], atlas_name, atlas_directory,
+                                    atlas_size, atlas_max_texture_size, log)
+        if atlas_images is not None:
+            atlas_images += images
+
+    if main_m is not None and generate_shad:
+        shad_m = proxy.make_shadow_mesh(main_m, shadow_mesh_polys, p.textures)
+        built_meshes.append((shad_m.name, shad_m))
+        log.write('Generated {}: {} polys'.format(shad_m.name, len(shad_m.polys)))
+
+    if main_m is not None and generate_coll:
+        hull = get_convex_hull(main_m.vertices) if collision_mesh_mode == 'HULL' else None
+        coll_m = proxy.make_collision_mesh(main_m, collision_mesh_polys, p.textures, hull)
+        built_meshes.append((coll_m.name, coll_m))
+        log.write('Generated {}: {} polys'.format(coll_m.name, len(coll_m.polys)))
+
+    # decimation is slow, so all levels are generated on a process pool
+    lods = {}
+    if lod_meshes:
+        for m, levels in zip(lod_meshes, generate_lod_meshes(lod_meshes, lod_ratios, p.textures, log)):
+            if levels and m.flags & lod.ALL_LOD_FLAGS == 0 and m.flags & p3d.MAIN_FLAG:
+                m.flags |= lod.NOLOD_FLAG
+            lods[id(m)] = levels
+            for l in levels:
+                log.write('Generated {}: {} polys -> {} polys'.format(l.name, len(m.polys), len(l.polys)))
+
+    # merged meshes can't have their own levels, so meshes with generated levels are kept
+    if batch_static_meshes:
+        before = len(built_meshes)
+        kept = [(name, m) for name, m in built_meshes if id(m) in lods]
+        batched, batches = batch.batch_meshes([(name, m) for name, m in built_meshes if id(m) not in lods],
+                                              p.textures, batch_max_polys, batch_cell_size)
+        built_meshes = kept + batched
+        for batch_name, names in batches:
+            log.write('Batched {} meshes into {}: {}'.format(len(names), batch_name, ' '.join(names)))
+
+        line = 'Draw call batching: {} meshes -> {} meshes'.format(before, len(built_meshes))
+        log.write(line)
+        if report_lines is not None:
+            report_lines.append(line)
+
+    for name, m in built_meshes:
+        for l, lm in enumerate([m] + lods.get(id(m), [])):
+            # levels are already small, only the full mesh is chunked
+            chunks = [lm]
+            if chunk_mode != 'NONE' and l == 0:
+                chunks = split.chunk_mesh(lm, p.textures, chunk_mode, chunk_size, chunk_polys)
+                if len(chunks) > 1:
+                    log.write('Chunked {} with {} polys into {} meshes: {}'.format(
+                        lm.name, len(lm.polys), len(chunks), ' '.join(cm.name for cm in chunks)))
+
+            for c, cm in enumerate(chunks):
+                # p3d can't store more than 65535 vertices or polys in one mesh
+                meshes = [cm]
+                if split.is_over_limit(cm):
+                    meshes = split.split_mesh(cm, p.textures)
+                    log.write('{} has {} vertices and {} polys, which is over the p3d limit. Split into {} meshes: {}'.format(
+                        cm.name, len(cm.vertices), len(cm.polys), len(meshes), ' '.join(sm.name for sm in meshes)))
+
+                for i, sm in enumerate(meshes):
+                    if optimize_vertex_cache:
+                        acmr_before, acmr_after = vcache.optimize_mesh(sm, optimize_overdraw)
+                        log.write('Vertex cache {}: ACMR {:.3f} -> {:.3f}'.format(sm.name, acmr_before, acmr_after))
+
+                    p.num_meshes += 1
+                    p.meshes.append(sm)
+                    exported_meshes.append(name if l == 0 and c == 0 and i == 0 else sm.name)
+
+    return p, exported_meshes
+
+def get_file_hash(filepath):
+    try:
+        with open(filepath, 'rb') as file:
+            return hashlib.sha1(file.read()).hexdigest()
+    except OSError:
+        return None
+
+def write_p3d(p, filepath, log=None):
+    # the model is encoded in memory and only written if it differs from the existing file,
+    # so unchanged models keep their mtime. Returns True if the file was written
     print(p)
+    file = io.BytesIO()
     p.write(file)
-    file.close()
+    data = file.getvalue()
+
+    if log is not None:
+        for line in validate.format_errors(validate.validate(data)):
+            log.write('!!! Exported model is broken, ' + line)
+
+    if hashlib.sha1(data).hexdigest() == get_file_hash(filepath):
+        return False
+
+    with open(filepath, 'wb') as file:
+        file.write(data)
+    return True
+
+def find_texture_file(texture, folder):
+    for img in bpy.data.images:
+        if img.name.rsplit('.', 1)[0] == texture and img.filepath:
+            path = bpy.path.abspath(img.filepath)
+            if os.path.isfile(path):
+                return path
+
+    for ext in ('.tga', '.dds'):
+        path = os.path.join(folder, texture + ext)
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+def get_dds_source(texture, folder):
+    # returns a .tga named like the texture, images which are not such a file are saved as one first
+    path = os.path.join(folder, texture + '.tga')
+    if os.path.isfile(path):
+        return path
+
+    img = find_texture_image(texture)
+    if img is None:
+        return None
+
+    path = bpy.path.abspath(img.filepath) if img.filepath else ''
+    name = os.path.splitext(os.path.basename(path))[0]
+    if (path.lower().endswith('.tga') and name.lower() == texture.lower() and os.path.isfile(path)
+            and img.packed_file is None and not img.is_dirty):
+        return path
+
+    path = os.path.join(cache.get_cache_dir('dds'), texture + '.tga')
+    save_tga(texture, get_image_pixels(img), path)
+    return path
+
+def export_dds_textures(textures, work_path, log):
+    folder = get_textures_folder(work_path)
+    sources = []
+    for tex in textures:
+        source = get_dds_source(tex, folder)
+        if source is None:
+            log.write('! Texture {} was not found, no .dds written.'.format(tex))
+        else:
+            sources.append(source)
+    if not sources:
+        return
+
+    os.makedirs(folder, exist_ok=True)
+
+    # encoding runs on a process pool
+    if not run_tool('dds', ['-o', folder] + sources, log):
+        log.write('!!! Some textures could not be written as .dds.')
+
+def check_budgets(p, work_path, log, report_lines, budgets, atlas_images=()):
+    # texture sizes are read from file headers, so this stays fast for big textures.
+    # atlases are not saved yet, their sizes come from the composed images
+    texture_folder = get_textures_folder(work_path)
+    texture_sizes = {}
+    for tex in p.textures:
+        path = find_texture_file(tex, texture_folder)
+        texture_sizes[tex] = report.read_texture_size(path) if path else None
+    for name, pixels, path in atlas_images:
+        texture_sizes[name] = (pixels.shape[1], pixels.shape[0], 'TGA 32bit')
+
+    lines, problems = report.make_report(p, texture_sizes, **budgets)
+    for line in lines:
+        log.write(line)
+    report_lines += lines
+
+    return problems
+
+def store_report(lines):
+    # the report is shown in Crashday - Export Report panel
+    text = bpy.data.texts.get(REPORT_TEXT_NAME)
+    if text is None:
+        text = bpy.data.texts.new(REPORT_TEXT_NAME)
+    text.clear()
+    text.write('\n'.join(lines))
+
+def save_batch(context, directory, dg, log, report_lines,
+               use_selection=True,
+               use_mesh_modifiers=True,
+               dry_run=False,
+               export_dds=False,
+               budget_mode='WARN',
+               budgets={},
+               **build_options):
+    # every child collection of the active collection is a separate model
+    parent = context.view_layer.active_layer_collection.collection
+    if len(parent.children) == 0:
+        log.write('!!! Failed to batch export. Active collection {} has no child collections.'.format(parent.name))
+        return {'CANCELLED'}
+
+    # materials are shared between the models, resolve their textures once
+    texture_cache = {}
+
+    exported = []
+    failed = []
+    for col in parent.children:
+        file_name = sanitise_mesh_name(col.name).lower() + '.p3d'
+        log.write('\nModel {} -> {}'.format(col.name, file_name))
+
+        objects = get_export_objects(col, dg, use_selection, use_mesh_modifiers)
+
+        floor_level_location = mathutils.Vector((0.0, 0.0, 0.0))
+        for ob in col.all_objects:
+            if strip_name_suffix(ob.name) == 'floor_level':
+                floor_level_location = ob.location
+                break
+
+        report_lines.append('Model {}'.format(file_name))
+        atlas_images = []
+        result = build_p3d(objects, log,
+                           floor_level_location=floor_level_location,
+                           texture_cache=texture_cache,
+                           name_of=lambda ob: strip_name_suffix(ob.name),
+                           atlas_name=sanitise_mesh_name(col.name).lower() + '_atlas',
+                           report_lines=report_lines,
+                           atlas_images=atlas_images,
+                           **build_options)
+        if result is None:
+            report_lines.append('!!! Failed to export, no main mesh found.')
+            failed.append(col.name)
+            continue
+
+        p, exported_meshes = result
+
+        problems = check_budgets(p, directory, log, report_lines, budgets, atlas_images)
+        if problems and budget_mode == 'FAIL':
+            log.write('!!! {} budget problems found, {} was not written.'.format(problems, file_name))
+            failed.append(col.name)
+            continue
+
+        if not dry_run:
+            save_atlas_images(atlas_images, log)
+        if not dry_run and not write_p3d(p, os.path.join(directory, file_name), log):
+            log.write('Model did not change, {} was not rewritten.'.format(file_name))
+        if not dry_run and export_dds:
+            export_dds_textures(p.textures, directory, log)
+
+        log.write('Meshes: {}'.format(' '.join(exported_meshes)), echo=False)
+        exported.append(col.name)
+
+    log.write('\nBatch {} finished: {} exported, {} failed.'.format('dry run' if dry_run else 'export', len(exported), len(failed)))
+    if failed:
+        log.write('Failed models: {}'.format(' '.join(failed)))
+
+    return {'FINISHED'} if exported else {'CANCELLED'}
+
+def save(operator, context, **keywords):
+    # edge split modifiers would split the mesh a second time, they are disabled while exporting
+    modifiers = []
+    if keywords.get('split_sharp_edges'):
+        modifiers = [mod for ob in bpy.data.objects for mod in ob.modifiers
+                     if mod.type == 'EDGE_SPLIT' and mod.show_viewport]
+    for mod in modifiers:
+        mod.show_viewport = False
+    try:
+        return save_scene(operator, context, **keywords)
+    finally:
+        for mod in modifiers:
+            mod.show_viewport = True
+
+def save_scene(operator,
+               context, filepath='',
+               use_selection=True,
+               use_mesh_modifiers=True,
+               use_empty_for_floor_level=True,
+               bbox_mode='MAIN',
+               force_main_mesh=False,
+               export_log=True,
+               batch_mode=False,
+               compact_geometry=False,
+               weld_distance=0.0001,
+               optimize_vertex_cache=False,
+               optimize_overdraw=False,
+               generate_lods=False,
+               lod2_ratio=0.5,
+               lod3_ratio=0.25,
+               lod4_ratio=0.1,
+               generate_shadow_mesh=False,
+               shadow_mesh_polys=500,
+               generate_collision_mesh=False,
+               collision_mesh_mode='HULL',
+               collision_mesh_polys=200,
+               use_texture_atlas=False,
+               atlas_size='1024',
+               atlas_max_texture_size=256,
+               chunk_mode='NONE',
+               chunk_size=10.0,
+               chunk_polys=2000,
+               batch_static_meshes=False,
+               batch_max_polys=4000,
+               batch_cell_size=20.0,
+               remove_hidden_faces=False,
+               hidden_face_rays=32,
+               split_sharp_edges=False,
+               split_seams=False,
+               export_dds=False,
+               dry_run=False,
+               budget_mode='WARN',
+               budget_max_vertices=65535,
+               budget_max_polys=65535,
+               budget_max_draw_calls=32,
+               budget_max_texture_size=1024):
+
+    # get the folder where file will be saved and add a log in that folder
+    work_path = os.path.dirname(filepath)
+
+    log = ExportLog(os.path.join(work_path, 'export-log.txt') if export_log else None)
+    date = datetime.datetime.now()
+    log.write('Started exporting on {}\nFile path: {}'.format(date.strftime('%d-%m-%Y %H:%M:%S'), work_path if batch_mode else filepath), echo=False)
+    print('\nExporting file to {}'.format(work_path if batch_mode else filepath))
+
+    # options shared by every exported model
+    build_options = dict(use_empty_for_floor_level=use_empty_for_floor_level,
+                         bbox_mode=bbox_mode,
+                         force_main_mesh=force_main_mesh,
+                         compact_geometry=compact_geometry,
+                         weld_distance=weld_distance,
+                         optimize_vertex_cache=optimize_vertex_cache,
+                         optimize_overdraw=optimize_overdraw,
+                         generate_lods=generate_lods,
+                         lod_ratios={2: lod2_ratio, 3: lod3_ratio, 4: lod4_ratio},
+                         generate_shadow_mesh=generate_shadow_mesh,
+                         shadow_mesh_polys=shadow_mesh_polys,
+                         generate_collision_mesh=generate_collision_mesh,
+                         collision_mesh_mode=collision_mesh_mode,
+                         collision_mesh_polys=collision_mesh_polys,
+                         use_texture_atlas=use_texture_atlas,
+                         atlas_size=int(atlas_size),
+                         atlas_max_texture_size=atlas_max_texture_size,
+                         atlas_directory=get_textures_folder(work_path),
+                         chunk_mode=chunk_mode,
+                         chunk_size=chunk_size,
+                         chunk_polys=chunk_polys,
+                         batch_static_meshes=batch_static_meshes,
+                         batch_max_polys=batch_max_polys,
+                         batch_cell_size=batch_cell_size,
+                         remove_hidden_faces=remove_hidden_faces,
+                         hidden_face_rays=hidden_face_rays,
+                         split_sharp_edges=split_sharp_edges,
+                         split_seams=split_seams)
+
+    budgets = dict(max_vertices=budget_max_vertices,
+                   max_polys=budget_max_polys,
+                   max_draw_calls=budget_max_draw_calls,
+                   max_texture_size=budget_max_texture_size)
+    report_lines = []
+
+    # exit edit mode
+    if bpy.ops.object.mode_set.poll():
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    # get dependencies graph for applying modifiers
+    dg = bpy.context.evaluated_depsgraph_get()
+
+    if batch_mode:
+        result = save_batch(context, work_path, dg, log, report_lines,
+                            use_selection=use_selection,
+                            use_mesh_modifiers=use_mesh_modifiers,
+                            dry_run=dry_run,
+                            export_dds=export_dds,
+                            budget_mode=budget_mode,
+                            budgets=budgets,
+                            **build_options)
+        store_report(report_lines)
+        log.write('Finished p3d export.\n', echo=False)
+        log.close()
+        return result
+
+    col = bpy.context.scene.collection
+
+    # store list oj objects to export
+    objects = get_export_objects(col, dg, use_selection, use_mesh_modifiers)
+
+    floor_level = bpy.data.objects.get('floor_level')
+    if floor_level is None:
+        floor_level = bpy.data.objects.new('floor_level', None)
+        col.objects.link(floor_level)
+        floor_level.location = (0.0,0.0,0.0)
+        floor_level.empty_display_type = 'PLAIN_AXES'
+
+    report_lines.append('Model {}'.format(os.path.basename(filepath)))
+    atlas_images = []
+    result = build_p3d(objects, log,
+                       floor_level_location=floor_level.location,
+                       atlas_name=sanitise_mesh_name(os.path.splitext(os.path.basename(filepath))[0]).lower() + '_atlas',
+                       report_lines=report_lines,
+                       atlas_images=atlas_images,
+                       **build_options)
+
+    if result is None:
+        if not force_main_mesh:
+            bpy.context.window_manager.popup_menu(error_no_main, title='No main mesh', icon='ERROR')
+        log.close()
+        return {'CANCELLED'}
+
+    p, exported_meshes = result
+
+    problems = check_budgets(p, work_path, log, report_lines, budgets, atlas_images)
+    store_report(report_lines)
+
+    if problems and budget_mode == 'FAIL':
+        operator.report({'ERROR'}, '{} budget problems found, p3d was not written. Check Crashday - Export Report panel.'.format(problems))
+        log.write('!!! {} budget problems found, p3d was not written.\n'.format(problems))
+        log.close()
+        return {'CANCELLED'}
+
+    if dry_run:
+        log.write('Dry run finished, p3d was not written.\n')
+        log.close()
+        return {'FINISHED'}
+
+    save_atlas_images(atlas_images, log)
+
+    # save p3d into file
+    if not write_p3d(p, filepath, log):
+        log.write('Model did not change, p3d was not rewritten.')
+    if export_dds:
+        export_dds_textures(p.textures, work_path, log)
 
     print('p3d exported')
-    if log_file:
-        log_file.write('Meshes: {}\n'.format(exported_meshes_string))
-        log_file.write('Finished p3d export.\n\n')
-        log_file.close()
+    log.write('Meshes: {}'.format(' '.join(exported_meshes) + ' '), echo=False)
+    log.write('Finished p3d export.\n', echo=False)
+    log.close()
 
     return {'FINISHED'}
 
@@ -1,14 +1,42 @@
 import bpy, bmesh, os
+import io
+import sys
 import time
+import math
 import struct
+import hashlib
+import zlib
+import zipfile
+import concurrent.futures
+
+import numpy as np
 
 from pathlib import Path
 
 from ..crashday import p3d
+from ..crashday import cpk
+from ..crashday import validate
+from ..crashday import trk
+from ..crashday import cache
 
 if 'bpy' in locals():
     import importlib
     importlib.reload(p3d)
+    importlib.reload(cpk)
+    importlib.reload(validate)
+    importlib.reload(trk)
+    importlib.reload(cache)
+
+# seconds of work done per timer event by the modal import
+TIME_SLICE = 0.05
+# seconds between checks of watched source files
+WATCH_INTERVAL = 1.0
+# bytes of appended cached .blend models kept on disk, least recently used models are removed first
+MODEL_CACHE_SIZE = 1 << 30
+# folder of cached models in Blender's user datafiles, linked models are never removed
+MODEL_CACHE_FOLDER = 'cdp3d_models'
+APPENDED_FOLDER = 'appended'
+LINKED_FOLDER = 'linked'
 
 def int_to_color(value):
     return (((value >> 16) & 255)/255.0, ((value >> 8) & 255)/255.0, (value & 255)/255.0)
@@ -34,7 +62,11 @@ def shorten_path(path, ind):
     out = os.path.join('..\\', *folders[ind:])
     return out
 
-def find_texture_paths(filepath, search_path):
+def find_texture_paths(filepath, search_path, archive_entry=''):
+    # models inside archives are treated as if the archive was a folder
+    if archive_entry:
+        filepath = os.path.join(filepath, *archive_entry.replace('\\', '/').split('/'))
+
     drive, folders = get_folders_array_from_path(filepath)
     is_car = True if folders[1] == 'cars' else False
     car_name = None
@@ -76,6 +108,19 @@ def find_texture_paths(filepath, search_path):
         if os.path.isdir(textures_cd_path):
             search_path.append(textures_cd_path)
             print('Added general crashday textures path {}'.format(shorten_path(textures_cd_path, ind)))
+
+        # packed original cd textures, loose files override them like in game
+        for archive_path in cpk.find_archives(os.path.join(drive, *folders[:ind+1], 'data')):
+            # one broken archive must not stop textures being found in the others
+            try:
+                archive = cpk.get_archive(archive_path)
+            except (OSError, zipfile.BadZipFile) as e:
+                print('! Skipped broken archive {}: {}'.format(archive_path, e))
+                continue
+            if is_car and car_name is not None:
+                search_path.append((archive, 'content/textures/cars/{}/'.format(car_name)))
+            search_path.append((archive, 'content/textures/'))
+            print('Added crashday archive {}'.format(archive))
     except ValueError:
         print('Couldn\'t find Crashday folder, no general textures loaded')
 
@@ -93,31 +138,66 @@ def texture_exists(full_path, file_name):
     else:
         return None
 
-def add_textures(p3d_model, paths):
-    for tex in p3d_model.textures:
-        texture = bpy.data.textures.get(tex)
-
-        if texture is None:
-            texture = bpy.data.textures.new(tex, type='IMAGE')
-
-        img = None
-        for p in paths:
-            path = texture_exists(p, tex)
-            if path is not None:
-                img = bpy.data.images.load(path)
+def texture_exists_in_archive(archive, prefix, file_name):
+    p = prefix + os.path.splitext(file_name)[0]
+    for ext in ('.tga', '.dds'):
+        if archive.find(p + ext) is not None:
+            print('Loaded {} in {}'.format(p + ext, archive.path))
+            return p + ext
+    return None
+
+def load_archive_image(archive, name):
+    # images are packed from memory, so nothing is extracted from the archive
+    data = archive.read(name)
+    img = bpy.data.images.new(name.split('/')[-1], 1, 1)
+    img.pack(data=data, data_len=len(data))
+    img.source = 'FILE'
+    return img
+
+def add_texture(tex, paths, created=None):
+    # created collects (data collection, datablock) of every new datablock, so a cancelled import can remove them
+    texture = bpy.data.textures.get(tex)
+
+    if texture is None:
+        texture = bpy.data.textures.new(tex, type='IMAGE')
+        if created is not None:
+            created.append((bpy.data.textures, texture))
+
+    img = None
+    for p in paths:
+        if isinstance(p, tuple):
+            archive, prefix = p
+            name = texture_exists_in_archive(archive, prefix, tex)
+            if name is not None:
+                img = load_archive_image(archive, name)
                 texture.image = img
                 break
-        if img is None:
-            print('Failed to load {}'.format(tex))
+            continue
+
+        path = texture_exists(p, tex)
+        if path is not None:
+            img = bpy.data.images.load(path)
+            texture.image = img
+            break
+    if img is None:
+        print('Failed to load {}'.format(tex))
+    elif created is not None:
+        created.append((bpy.data.images, img))
+
+def add_textures(p3d_model, paths, created=None):
+    for tex in p3d_model.textures:
+        add_texture(tex, paths, created)
 
 def get_material_name(material_name):
     return material_name[1] + ' ' + material_name[0].lower()
 
-def add_material(obj, material_name):
+def add_material(obj, material_name, created=None):
     material = bpy.data.materials.get(get_material_name(material_name))
 
     if material is None:
         material = bpy.data.materials.new(get_material_name(material_name))
+        if created is not None:
+            created.append((bpy.data.materials, material))
 
         material.cdp3d.material_name = material_name[1]
         material.cdp3d.material_type = material_name[0]
@@ -157,125 +237,494 @@ def add_material(obj, material_name):
 
     obj.data.materials.append(material)
 
-def create_meshes(p3d_model, col, use_edge_split_modifier, remove_doubles_distance):
-    for m in p3d_model.meshes:
-        mesh = bpy.data.meshes.new(name=m.name)
-        obj = bpy.data.objects.new(mesh.name, mesh)
-        obj.location = m.pos
+def create_mesh(m, col, use_edge_split_modifier, remove_doubles_distance, created=None, source_hash=''):
+    mesh = bpy.data.meshes.new(name=m.name)
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    obj.location = m.pos
+    if created is not None:
+        created.append((bpy.data.meshes, mesh))
+        created.append((bpy.data.objects, obj))
 
-        col.objects.link(obj)
+    col.objects.link(obj)
 
-        # if 'coll' in m.name or 'shad' in m.name or 'lod' in m.name or '.' in m.name:
-        #     obj.hide_set(True)
+    # if 'coll' in m.name or 'shad' in m.name or 'lod' in m.name or '.' in m.name:
+    #     obj.hide_set(True)
 
-        items = mesh.cdp3d.bl_rna.properties['flags'].enum_items
-        
-        flags = set()
-        for flag in items:
-            # print(flag.value)
-            if m.flags & flag.value:
-                flags.add(flag.identifier)
+    fill_mesh(obj, m, use_edge_split_modifier, remove_doubles_distance, created, source_hash)
 
-        mesh.cdp3d.flags = flags
+def fill_mesh(obj, m, use_edge_split_modifier, remove_doubles_distance, created=None, source_hash=''):
+    # creates geometry, flags and materials of an empty mesh of obj
+    mesh = obj.data
+    mesh.cdp3d.source_name = m.name
+    mesh.cdp3d.source_hash = source_hash
 
-        for t in m.materials_used:
-            add_material(obj, t)
+    items = mesh.cdp3d.bl_rna.properties['flags'].enum_items
+    
+    flags = set()
+    for flag in items:
+        # print(flag.value)
+        if m.flags & flag.value:
+            flags.add(flag.identifier)
 
-        faces = []
-        uvs = []
+    mesh.cdp3d.flags = flags
 
-        for i in range(m.num_polys):
-            faces.append([m.polys[i].p1, m.polys[i].p2, m.polys[i].p3])
-            uvs.append((m.polys[i].u1, m.polys[i].v1))
-            uvs.append((m.polys[i].u2, m.polys[i].v2))
-            uvs.append((m.polys[i].u3, m.polys[i].v3))
-        
-        mesh.from_pydata(m.vertices, [], faces)
+    for t in m.materials_used:
+        add_material(obj, t, created)
+
+    faces = []
+    uvs = []
+
+    for i in range(m.num_polys):
+        faces.append([m.polys[i].p1, m.polys[i].p2, m.polys[i].p3])
+        uvs.append((m.polys[i].u1, m.polys[i].v1))
+        uvs.append((m.polys[i].u2, m.polys[i].v2))
+        uvs.append((m.polys[i].u3, m.polys[i].v3))
+    
+    mesh.from_pydata(m.vertices, [], faces)
 
-        for i, f in enumerate(mesh.polygons):
-            mat_ind = [(j, item) for j, item in enumerate(m.materials_used) if item[1] == m.polys[i].texture and item[0] == m.polys[i].material]
-            f.material_index = mat_ind[0][0]
-            if  mat_ind[0][1][0] == 'GOURAUD' or mat_ind[0][1][0] == 'GOURAUD_METAL' or mat_ind[0][1][0] == 'GOURAUD_METAL_ENV':
-                f.use_smooth = True
+    for i, f in enumerate(mesh.polygons):
+        mat_ind = [(j, item) for j, item in enumerate(m.materials_used) if item[1] == m.polys[i].texture and item[0] == m.polys[i].material]
+        f.material_index = mat_ind[0][0]
+        if  mat_ind[0][1][0] == 'GOURAUD' or mat_ind[0][1][0] == 'GOURAUD_METAL' or mat_ind[0][1][0] == 'GOURAUD_METAL_ENV':
+            f.use_smooth = True
 
-        uv_layer = mesh.uv_layers.new(do_init=False)
-        mesh.uv_layers.active = uv_layer
+    uv_layer = mesh.uv_layers.new(do_init=False)
+    mesh.uv_layers.active = uv_layer
 
-        uv_layer.data.foreach_set('uv', [uv for pair in [uvs[i] for i, l in enumerate(mesh.loops)] for uv in pair])
+    uv_layer.data.foreach_set('uv', [uv for pair in [uvs[i] for i, l in enumerate(mesh.loops)] for uv in pair])
 
-        if use_edge_split_modifier:
-            bm = bmesh.new()
-            bm.from_mesh(mesh)
+    if use_edge_split_modifier:
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
 
-            for edge in bm.edges:
-                if len(edge.link_loops) == 1:
-                    edge.smooth = False
+        for edge in bm.edges:
+            if len(edge.link_loops) == 1:
+                edge.smooth = False
 
-            bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=remove_doubles_distance)
+        bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=remove_doubles_distance)
+        if obj.modifiers.get('EdgeSplit') is None:
             mod = obj.modifiers.new('EdgeSplit', 'EDGE_SPLIT')
             mod.use_edge_angle = False
-            bm.to_mesh(mesh)
-            bm.free()
+        bm.to_mesh(mesh)
+        bm.free()
 
+def create_meshes(p3d_model, col, use_edge_split_modifier, remove_doubles_distance, created=None):
+    for m in p3d_model.meshes:
+        create_mesh(m, col, use_edge_split_modifier, remove_doubles_distance, created)
 
-def create_lights(p3d_model, col):
-    for l in p3d_model.lights:
-        new_light = bpy.data.lights.new(name=l.name, type='POINT')
-        new_light.color = int_to_color(l.color)
-        new_light.energy = l.range
+def create_light(l, col, created=None):
+    new_light = bpy.data.lights.new(name=l.name, type='POINT')
+    new_light.color = int_to_color(l.color)
+    new_light.energy = l.range
 
-        new_light.cdp3d.corona = l.show_corona
-        new_light.cdp3d.lens_flares = l.show_lens_flares
-        new_light.cdp3d.lightup_environment = l.lightup_environment
+    new_light.cdp3d.corona = l.show_corona
+    new_light.cdp3d.lens_flares = l.show_lens_flares
+    new_light.cdp3d.lightup_environment = l.lightup_environment
 
-        light_object = bpy.data.objects.new(new_light.name, new_light)
-        light_object.location = l.pos
+    light_object = bpy.data.objects.new(new_light.name, new_light)
+    light_object.location = l.pos
+    if created is not None:
+        created.append((bpy.data.lights, new_light))
+        created.append((bpy.data.objects, light_object))
 
-        col.objects.link(light_object)
+    col.objects.link(light_object)
+
+def create_lights(p3d_model, col, created=None):
+    for l in p3d_model.lights:
+        create_light(l, col, created)
 
-def create_pos(col, pos, name):
+def create_pos(col, pos, name, created=None):
     obj = bpy.data.objects.new(name, None)
     col.objects.link(obj)
+    if created is not None:
+        created.append((bpy.data.objects, obj))
 
     obj.location = pos
     obj.empty_display_type = 'PLAIN_AXES'
 
-def load(operator,
-         context,
-         use_edge_split_modifier=True,
-         remove_doubles_distance=0.00001,
-         filepath='',
-         search_textures=True):
-
+def remove_created(created):
+    # objects were created after their data, so removing in reverse frees users first
+    for data, block in reversed(created):
+        try:
+            data.remove(block)
+        except (ReferenceError, RuntimeError):
+            pass
+    created.clear()
+
+def read_source(filepath, archive_entry=''):
+    # returns the whole model file, models in .cpk archives are read from the archive
+    if filepath.lower().endswith('.cpk'):
+        archive = cpk.get_archive(filepath)
+        if archive.find(archive_entry) is None:
+            return None
+        return archive.read(archive_entry)
+
+    with open(filepath, 'rb') as file:
+        return file.read()
+
+def get_source_stamp(filepath):
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return '{}:{}'.format(st.st_size, st.st_mtime_ns)
+
+def get_mesh_hashes(data):
+    # content hash of every mesh block, used to find changed meshes when the file is reloaded
+    _, blocks = p3d.scan_meshes(data)
+    view = memoryview(data)
+    return [hashlib.sha1(view[offset:offset + size]).hexdigest() for name, offset, size in blocks]
+
+def split_patterns(text):
+    # name patterns are separated by commas
+    return [pattern.strip() for pattern in text.split(',') if pattern.strip()]
+
+def select_blocks(data, blocks, include_meshes='', exclude_meshes='', required_flags=0, forbidden_flags=0):
+    # mesh blocks passing the import filter, only name and flags of every block are read
+    include = split_patterns(include_meshes)
+    exclude = split_patterns(exclude_meshes)
+    if not include and not exclude and not required_flags and not forbidden_flags:
+        return blocks
+    return [(name, offset, size) for name, offset, size in blocks
+            if p3d.match_mesh(name, p3d.get_mesh_flags(data, offset), include, exclude, required_flags, forbidden_flags)]
+
+def get_used_textures(p):
+    # textures of the decoded meshes, textures of skipped meshes are not loaded
+    used = {material_name[1] for m in p.meshes for material_name in m.materials_used}
+    return [tex for tex in p.textures if tex in used]
+
+def read_model(operator, filepath, search_textures, archive_entry='', created=None, mesh_filter=()):
+    # parses the model and creates its collection, mesh_filter are select_blocks arguments
+    # returns (model, collection, texture search paths, mesh hashes) or None
     file_name = filepath.split('\\')[-1]
+    is_archive = filepath.lower().endswith('.cpk')
+    if is_archive:
+        file_name = archive_entry.replace('\\', '/').split('/')[-1]
 
     print('\nImporting file {} from {}'.format(file_name, filepath))
 
-    search_path = []
-    if search_textures:
-        find_texture_paths(filepath, search_path)
+    stamp = get_source_stamp(filepath)
+    data = read_source(filepath, archive_entry)
+    if data is None:
+        operator.report({'ERROR'}, 'Model \'{}\' was not found in {}'.format(archive_entry, filepath))
+        return None
+
+    # broken files would otherwise fail somewhere deep in reading or creating meshes
+    errors = validate.validate(data)
+    if errors:
+        for line in validate.format_errors(errors):
+            print('!!! ' + line)
+        operator.report({'ERROR'}, '{} is broken, {} problems found: {}'.format(file_name, len(errors), validate.format_errors(errors)[0]))
+        return None
 
-    p = p3d.P3D()
+    # meshes are decoded only if they pass the filter, skipped ones cost a header read
+    p, blocks = p3d.scan_meshes(data)
+    selected = select_blocks(data, blocks, *mesh_filter)
+    if len(selected) != len(blocks):
+        print('! Import filter skipped {} of {} meshes'.format(len(blocks) - len(selected), len(blocks)))
+
+    file = io.BytesIO(data)
+    view = memoryview(data)
+    hashes = []
+    for name, offset, size in selected:
+        file.seek(offset)
+        m = p3d.Mesh()
+        m.read(file, p.textures, p.num_textures)
+        p.meshes.append(m)
+        hashes.append(hashlib.sha1(view[offset:offset + size]).hexdigest())
+    p.num_meshes = len(p.meshes)
 
-    file = open(filepath, 'rb')
-    p.read(file)
-    file.close()
+    search_path = []
+    if search_textures:
+        find_texture_paths(filepath, search_path, archive_entry if is_archive else '')
 
     print(p)
 
     col = bpy.data.collections.new(file_name) 
     bpy.context.scene.collection.children.link(col)
+    if created is not None:
+        created.append((bpy.data.collections, col))
+
+    col.cdp3d.filepath = filepath
+    col.cdp3d.archive_entry = archive_entry
+    col.cdp3d.source_stamp = stamp or ''
+    col.cdp3d.search_textures = search_textures
+    if mesh_filter:
+        include_meshes, exclude_meshes, required_flags, forbidden_flags = mesh_filter
+        col.cdp3d.include_meshes = include_meshes
+        col.cdp3d.exclude_meshes = exclude_meshes
+        col.cdp3d.required_flags = required_flags
+        col.cdp3d.forbidden_flags = forbidden_flags
+
+    return p, col, search_path, hashes
+
+def build_model(p, col, search_path, use_edge_split_modifier, remove_doubles_distance, created=None, hashes=None):
+    # creates the model in small steps, yields after every texture, light and mesh
+    col.cdp3d.use_edge_split_modifier = use_edge_split_modifier
+    col.cdp3d.remove_doubles_distance = remove_doubles_distance
+
+    for tex in get_used_textures(p):
+        add_texture(tex, search_path, created)
+        yield
+    for l in p.lights:
+        create_light(l, col, created)
+        yield
+    for i, m in enumerate(p.meshes):
+        create_mesh(m, col, use_edge_split_modifier, remove_doubles_distance, created, hashes[i] if hashes else '')
+        yield
+
+    create_pos(col, (0.0, 0.0, - p.height/2.0), 'floor_level', created)
+    yield
+
+def get_addon_version():
+    return sys.modules[__package__.rpartition('.')[0]].bl_info['version']
+
+def get_model_cache_dir(link):
+    # saved projects link cached models, so they are kept in Blender's user folder instead of temp
+    folder = os.path.join(MODEL_CACHE_FOLDER, LINKED_FOLDER if link else APPENDED_FOLDER)
+    return bpy.utils.user_resource('DATAFILES', path=folder, create=True)
+
+def clear_linked_cache():
+    '''Removes linked cached models except the ones the open file links. Other saved projects
+    linking removed models lose them, so this is only done on request. Returns the amount of removed models'''
+    used = [bpy.path.abspath(library.filepath) for library in bpy.data.libraries]
+    return cache.trim_cache(get_model_cache_dir(True), 0, used)
+
+def get_cache_path(filepath, archive_entry, link, *settings):
+    # cached models are keyed by source path, size and mtime, the addon version and import settings
+    try:
+        key = cache.get_file_key(filepath, archive_entry, get_addon_version(), *settings)
+    except OSError:
+        return None
+    return os.path.join(get_model_cache_dir(link), key + '.blend')
+
+def load_cached(context, cache_path, link):
+    # appends or links the collection of a cached model, returns None if the model is not cached
+    if cache_path is None or not os.path.isfile(cache_path):
+        return None
 
-    add_textures(p, search_path)
-    create_lights(p, col)
-    create_meshes(p, col, use_edge_split_modifier, remove_doubles_distance)
+    with bpy.data.libraries.load(cache_path, link=link) as (data_from, data_to):
+        data_to.collections = data_from.collections[:1]
+    if not data_to.collections or data_to.collections[0] is None:
+        return None
 
-    create_pos(col, (0.0, 0.0, - p.height/2.0), 'floor_level')
+    col = data_to.collections[0]
+    context.scene.collection.children.link(col)
+    cache.touch(cache_path)
+    print('Loaded {} from model cache {}'.format(col.name, cache_path))
+    return col
 
+def save_cached(col, cache_path):
+    # the collection is written with its objects, meshes, materials and images
+    temp_path = cache_path[:-len('.blend')] + '.tmp.blend'
+    try:
+        bpy.data.libraries.write(temp_path, {col})
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print('! Failed to write model cache {}: {}'.format(cache_path, e))
+        return
+
+    # any saved project may link models of the linked folder, only appended models are removed
+    folder = os.path.dirname(cache_path)
+    if os.path.basename(folder) == APPENDED_FOLDER:
+        cache.trim_cache(folder, MODEL_CACHE_SIZE)
+
+class ImportJob:
+    '''Import split into time slices, so the modal import operator keeps Blender responsive'''
+    def __init__(self, col, steps, total, created, cache_path=None):
+        self.col = col
+        self.created = created
+        self.done = 0
+        self.total = total
+        self.steps = steps
+        self.cache_path = cache_path
+
+    def step(self, time_slice):
+        # builds for up to time_slice seconds, returns True when the whole model is created
+        end = time.perf_counter() + time_slice
+        for _ in self.steps:
+            self.done += 1
+            if time.perf_counter() >= end:
+                return False
+
+        if self.cache_path is not None:
+            save_cached(self.col, self.cache_path)
+        print('Done importing .p3d file')
+        return True
+
+    def cancel(self):
+        self.steps.close()
+        remove_created(self.created)
+        print('Import cancelled, removed partially imported model')
+
+def no_steps():
+    # steps of a model loaded from the cache, nothing is left to build
+    return
+    yield
+
+def start_load(operator,
+               context,
+               use_edge_split_modifier=True,
+               remove_doubles_distance=0.00001,
+               filepath='',
+               search_textures=True,
+               archive_entry='',
+               model_cache='NONE',
+               include_meshes='',
+               exclude_meshes='',
+               required_flags=set(),
+               forbidden_flags=set()):
+    mesh_filter = (include_meshes, exclude_meshes, p3d.get_flag_mask(required_flags), p3d.get_flag_mask(forbidden_flags))
+
+    cache_path = None
+    if model_cache != 'NONE':
+        cache_path = get_cache_path(filepath, archive_entry, model_cache == 'LINK', search_textures, use_edge_split_modifier, remove_doubles_distance, *mesh_filter)
+        col = load_cached(context, cache_path, model_cache == 'LINK')
+        if col is not None:
+            return ImportJob(col, no_steps(), 0, [])
+
+    created = []
+    model = read_model(operator, filepath, search_textures, archive_entry, created, mesh_filter)
+    if model is None:
+        return None
+
+    p, col, search_path, hashes = model
+    steps = build_model(p, col, search_path, use_edge_split_modifier, remove_doubles_distance, created, hashes)
+    total = len(get_used_textures(p)) + len(p.lights) + len(p.meshes) + 1
+    return ImportJob(col, steps, total, created, cache_path)
+
+def load(operator,
+         context,
+         use_edge_split_modifier=True,
+         remove_doubles_distance=0.00001,
+         filepath='',
+         search_textures=True,
+         archive_entry='',
+         model_cache='NONE',
+         include_meshes='',
+         exclude_meshes='',
+         required_flags=set(),
+         forbidden_flags=set()):
+    mesh_filter = (include_meshes, exclude_meshes, p3d.get_flag_mask(required_flags), p3d.get_flag_mask(forbidden_flags))
+
+    cache_path = None
+    if model_cache != 'NONE':
+        cache_path = get_cache_path(filepath, archive_entry, model_cache == 'LINK', search_textures, use_edge_split_modifier, remove_doubles_distance, *mesh_filter)
+        if load_cached(context, cache_path, model_cache == 'LINK') is not None:
+            return {'FINISHED'}
+
+    model = read_model(operator, filepath, search_textures, archive_entry, mesh_filter=mesh_filter)
+    if model is None:
+        return {'CANCELLED'}
+
+    p, col, search_path, hashes = model
+    for _ in build_model(p, col, search_path, use_edge_split_modifier, remove_doubles_distance, hashes=hashes):
+        pass
+
+    if cache_path is not None:
+        save_cached(col, cache_path)
     print('Done importing .p3d file')
 
     return {'FINISHED'}
 
+def reload_model(col):
+    '''Rereads the source file of an imported collection and rebuilds only meshes whose
+    content changed. Objects keep their transforms, materials and images are reused.
+    Returns (changed, added, removed) mesh counts'''
+    settings = col.cdp3d
+    stamp = get_source_stamp(settings.filepath)
+    data = read_source(settings.filepath, settings.archive_entry)
+    if data is None:
+        raise KeyError('Model \'{}\' was not found in {}'.format(settings.archive_entry, settings.filepath))
+
+    errors = validate.validate(data)
+    if errors:
+        raise ValueError(validate.format_errors(errors)[0])
+
+    # meshes skipped by the import filter stay skipped
+    header, blocks = p3d.scan_meshes(data)
+    blocks = select_blocks(data, blocks, settings.include_meshes, settings.exclude_meshes,
+                           settings.required_flags, settings.forbidden_flags)
+    view = memoryview(data)
+    file = io.BytesIO(data)
+
+    objects = {}
+    for obj in col.objects:
+        if obj.type == 'MESH' and obj.data.cdp3d.source_name:
+            objects[obj.data.cdp3d.source_name] = obj
+
+    search_path = None
+    changed = added = 0
+    names = set()
+    for name, offset, size in blocks:
+        names.add(name)
+        source_hash = hashlib.sha1(view[offset:offset + size]).hexdigest()
+        obj = objects.get(name)
+        if obj is not None and obj.data.cdp3d.source_hash == source_hash:
+            continue
+
+        # only changed meshes are decoded
+        file.seek(offset)
+        m = p3d.Mesh()
+        m.read(file, header.textures, header.num_textures)
+
+        for material_name in m.materials_used:
+            if bpy.data.textures.get(material_name[1]) is None:
+                if search_path is None:
+                    search_path = []
+                    if settings.search_textures:
+                        find_texture_paths(settings.filepath, search_path, settings.archive_entry)
+                add_texture(material_name[1], search_path)
+
+        if obj is None:
+            create_mesh(m, col, settings.use_edge_split_modifier, settings.remove_doubles_distance, source_hash=source_hash)
+            added += 1
+            continue
+
+        old_mesh = obj.data
+        obj.data = bpy.data.meshes.new(name=m.name)
+        fill_mesh(obj, m, settings.use_edge_split_modifier, settings.remove_doubles_distance, source_hash=source_hash)
+        if old_mesh.users == 0:
+            bpy.data.meshes.remove(old_mesh)
+        changed += 1
+
+    removed = 0
+    for name, obj in objects.items():
+        if name not in names:
+            mesh = obj.data
+            bpy.data.objects.remove(obj)
+            if mesh.users == 0:
+                bpy.data.meshes.remove(mesh)
+            removed += 1
+
+    settings.source_stamp = stamp or ''
+    return changed, added, removed
+
+def watch_models():
+    # timer checking source files of watched collections
+    for col in bpy.data.collections:
+        settings = col.cdp3d
+        # linked models can't be changed
+        if not settings.watch or not settings.filepath or col.library is not None:
+            continue
+
+        stamp = get_source_stamp(settings.filepath)
+        if stamp is None or stamp == settings.source_stamp:
+            continue
+
+        start = time.perf_counter()
+        try:
+            changed, added, removed = reload_model(col)
+        except (OSError, KeyError, ValueError, struct.error) as e:
+            # the file may still be being written, try again on the next check
+            print('!!! Failed to reload {}: {}'.format(settings.filepath, e))
+            continue
+
+        print('Reloaded {} in {:.0f} ms: {} changed, {} added, {} removed meshes'.format(
+            col.name, (time.perf_counter() - start) * 1000.0, changed, added, removed))
+
+    return WATCH_INTERVAL
+
 def add_position(line, col, name):
     line = line.split('#')[0]
     line = line.strip()
@@ -337,6 +786,174 @@ def load_cca(operator, context, filepath=''):
     file.close()
 
     return {'FINISHED'}
-    
-    
 
+# errors of damaged archives and unreadable tile files, such tiles are skipped
+TILE_ERRORS = (OSError, KeyError, ValueError, struct.error, zlib.error, zipfile.BadZipFile)
+
+def resolve_tile(roots, field_file):
+    # runs in worker threads, so nothing here may use bpy
+    # returns (source, None) or (None, problem)
+    try:
+        source = trk.resolve_field(roots, field_file)
+    except TILE_ERRORS as e:
+        return None, str(e)
+    if source is None:
+        return None, 'model was not found'
+    return source, None
+
+def read_tile(source):
+    # runs in worker threads, so nothing here may use bpy
+    # returns (data, None) or (None, problem)
+    try:
+        return trk.read_content(source), None
+    except TILE_ERRORS as e:
+        return None, str(e)
+
+def parse_tile(data):
+    # returns (model, mesh hashes) or (None, problem)
+    try:
+        errors = validate.validate(data)
+        if errors:
+            return None, validate.format_errors(errors)[0]
+
+        p = p3d.P3D()
+        p.read(data)
+        return p, get_mesh_hashes(data)
+    except TILE_ERRORS as e:
+        return None, str(e)
+
+def build_tile(p, source, hashes, col, search_path, use_edge_split_modifier, remove_doubles_distance):
+    # tiles share most textures, only missing ones are loaded
+    for tex in p.textures:
+        if bpy.data.textures.get(tex) is None:
+            add_texture(tex, search_path)
+    for l in p.lights:
+        create_light(l, col)
+    for i, m in enumerate(p.meshes):
+        create_mesh(m, col, use_edge_split_modifier, remove_doubles_distance, source_hash=hashes[i])
+
+    col.cdp3d.filepath = source[0]
+    col.cdp3d.archive_entry = source[1]
+    col.cdp3d.source_stamp = get_source_stamp(source[0]) or ''
+    col.cdp3d.use_edge_split_modifier = use_edge_split_modifier
+    col.cdp3d.remove_doubles_distance = remove_doubles_distance
+
+def create_height_map(t, col):
+    # one grid mesh, vertices are set as arrays since big tracks have hundreds of thousands of samples
+    rows, columns = t.height_map.shape
+    y, x = np.mgrid[0:rows, 0:columns]
+    vertices = np.column_stack((x.ravel() * trk.HEIGHT_MAP_STEP, -y.ravel() * trk.HEIGHT_MAP_STEP,
+                                t.height_map.ravel())).astype(np.float32)
+
+    corners = (np.arange(rows - 1)[:, None] * columns + np.arange(columns - 1)).ravel()
+    quads = np.column_stack((corners, corners + columns, corners + columns + 1, corners + 1)).astype(np.int32)
+
+    mesh = bpy.data.meshes.new('terrain')
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set('co', vertices.ravel())
+    mesh.loops.add(quads.size)
+    mesh.loops.foreach_set('vertex_index', quads.ravel())
+    mesh.polygons.add(len(quads))
+    mesh.polygons.foreach_set('loop_start', np.arange(0, quads.size, 4, dtype=np.int32))
+    mesh.polygons.foreach_set('loop_total', np.full(len(quads), 4, dtype=np.int32))
+    mesh.update(calc_edges=True)
+
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    col.objects.link(obj)
+
+def load_trk(operator,
+             context,
+             use_edge_split_modifier=True,
+             remove_doubles_distance=0.00001,
+             filepath='',
+             search_textures=True,
+             import_height_map=True):
+    start = time.perf_counter()
+    file_name = os.path.basename(filepath)
+    print('\nImporting track {}'.format(filepath))
+
+    try:
+        t = trk.read_track(filepath)
+    except (OSError, ValueError, struct.error) as e:
+        operator.report({'ERROR'}, 'Failed to read track {}: {}'.format(file_name, e))
+        return {'CANCELLED'}
+    print(t)
+
+    roots = trk.find_content_roots(filepath)
+    fields = t.get_used_fields()
+
+    # field files are resolved to models first, so every distinct model is read and decoded once.
+    # threads only read files and archives, decoding holds the GIL and is done here while they read
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        resolved = list(executor.map(lambda i: resolve_tile(roots, t.field_files[i]), fields))
+
+        field_sources = {}
+        for i, (source, problem) in zip(fields, resolved):
+            if source is None:
+                print('!!! Tile {} was skipped: {}'.format(t.field_files[i], problem))
+                continue
+            field_sources[i] = source
+
+        sources = list(dict.fromkeys(field_sources.values()))
+        tiles = [parse_tile(data) if data is not None else (None, problem)
+                 for data, problem in executor.map(read_tile, sources)]
+
+    track_col = bpy.data.collections.new(file_name)
+    context.scene.collection.children.link(track_col)
+
+    # tile models are only shown through instances
+    tiles_col = bpy.data.collections.new(file_name + ' tiles')
+    track_col.children.link(tiles_col)
+    layer_collection = context.view_layer.layer_collection.children[track_col.name].children[tiles_col.name]
+    layer_collection.exclude = True
+
+    search_paths = {}
+    tile_cols = {}
+    for source, (p, hashes) in zip(sources, tiles):
+        model_file = os.path.basename(source[1].replace('\\', '/') if source[1] else source[0])
+        if p is None:
+            print('!!! Tile model {} was skipped: {}'.format(model_file, hashes))
+            continue
+
+        search_path = []
+        if search_textures:
+            key = (source[0], os.path.dirname(source[1]))
+            if key not in search_paths:
+                search_paths[key] = []
+                find_texture_paths(source[0], search_paths[key], source[1])
+            search_path = search_paths[key]
+
+        col = bpy.data.collections.new(os.path.splitext(model_file)[0])
+        tiles_col.children.link(col)
+        col.cdp3d.search_textures = search_textures
+        build_tile(p, source, hashes, col, search_path, use_edge_split_modifier, remove_doubles_distance)
+        tile_cols[source] = col
+
+    placements = 0
+    for field, column, row, rotation, mirrored, height in t.get_placements():
+        col = tile_cols.get(field_sources.get(field))
+        if col is None:
+            continue
+
+        obj = bpy.data.objects.new('{} {},{}'.format(col.name, column, row), None)
+        obj.instance_type = 'COLLECTION'
+        obj.instance_collection = col
+        obj.location = ((column + 0.5) * trk.TILE_SIZE, -(row + 0.5) * trk.TILE_SIZE, height * trk.HEIGHT_STEP)
+        # rotation is in clockwise quarter turns, mirroring flips the tile before rotating it
+        obj.rotation_euler = (0.0, 0.0, -rotation * math.pi / 2.0)
+        if mirrored:
+            obj.scale = (-1.0, 1.0, 1.0)
+        track_col.objects.link(obj)
+        placements += 1
+
+    if import_height_map:
+        create_height_map(t, track_col)
+
+    missing = len([i for i in fields if field_sources.get(i) not in tile_cols])
+    if missing:
+        operator.report({'WARNING'}, '{} of {} tiles were not found, see the console'.format(missing, len(fields)))
+
+    print('Done importing track in {:.1f} s: {} tiles, {} placements'.format(
+        time.perf_counter() - start, len(tile_cols), placements))
+
+    return {'FINISHED'}
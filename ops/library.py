@@ -0,0 +1,103 @@
+import bpy
+import bpy.utils.previews
+import os
+import sys
+import glob
+import subprocess
+
+from ..crashday import thumbnail
+
+if 'bpy' in locals():
+    import importlib
+    importlib.reload(thumbnail)
+
+# Model library browser, shows cached thumbnails of every model in a folder.
+# Thumbnails are rendered by crashday/thumbnail.py in a separate Python process,
+# so Blender stays responsive while a big library is processed.
+
+previews = None
+# enum items have to be kept alive while Blender uses them
+items = []
+items_key = None
+# running thumbnail process and the folder it renders
+process = None
+process_folder = ''
+
+def register():
+    global previews
+    previews = bpy.utils.previews.new()
+
+def unregister():
+    global previews
+    if previews is not None:
+        bpy.utils.previews.remove(previews)
+        previews = None
+
+def find_models(folder):
+    return sorted(glob.glob(os.path.join(folder, '**', '*.p3d'), recursive=True))
+
+def get_items(self, context):
+    global items, items_key
+
+    folder = bpy.path.abspath(self.folder)
+    key = (folder, self.filter.lower(), process is None)
+    if key == items_key:
+        return items
+
+    items = []
+    if folder and os.path.isdir(folder):
+        for path in find_models(folder):
+            name = os.path.relpath(path, folder)
+            if self.filter.lower() not in name.lower():
+                continue
+
+            icon = 'FILE_3D'
+            thumbnail_path = thumbnail.get_thumbnail_path(path)
+            if os.path.isfile(thumbnail_path):
+                preview = previews.get(thumbnail_path)
+                if preview is None:
+                    preview = previews.load(thumbnail_path, thumbnail_path, 'IMAGE')
+                icon = preview.icon_id
+            items.append((path, name, path, icon, len(items)))
+
+    if not items:
+        items.append(('', 'No models', 'No .p3d models found in the library folder', 'ERROR', 0))
+
+    items_key = key
+    return items
+
+def is_rendering():
+    return process is not None
+
+def check_process():
+    # timer waiting for the thumbnail process, previews are reloaded when it finishes
+    global process
+    if process is None:
+        return None
+    if process.poll() is None:
+        return 0.5
+
+    if process.returncode != 0:
+        print('! Some thumbnails of {} could not be rendered'.format(process_folder))
+    process = None
+
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            area.tag_redraw()
+    return None
+
+def render_thumbnails(folder):
+    '''Starts rendering missing thumbnails of every model in folder. Returns False if rendering is already running'''
+    global process, process_folder
+    if process is not None:
+        return False
+
+    # blender 2.83 has the path of its python in binary_path_python, newer versions in sys.executable
+    python = getattr(bpy.app, 'binary_path_python', sys.executable)
+    addon_folder = os.path.dirname(os.path.dirname(os.path.abspath(thumbnail.__file__)))
+    process = subprocess.Popen([python, '-m', 'crashday.thumbnail', os.path.join(folder, '**', '*.p3d')],
+                               cwd=addon_folder, stdout=subprocess.DEVNULL)
+    process_folder = folder
+
+    bpy.app.timers.register(check_process, first_interval=0.5)
+    return True
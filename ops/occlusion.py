@@ -0,0 +1,136 @@
+import math
+
+import numpy as np
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+
+from ..crashday import p3d
+from ..crashday import lod
+
+# Removal of triangles which can't be seen from outside of the model, e.g. faces inside other
+# parts or faces covered by touching parts. Rays are cast from a few points of every triangle
+# into a hemisphere around its normal, a triangle is hidden when none of them leave the model.
+# Only meshes which are always drawn together with a mesh can hide its triangles.
+
+# shadow and collision geometry must stay closed, meshes with these flags are never changed
+KEEP_FLAGS = p3d.TRACE_FLAG | p3d.COLLISION_FLAG
+# detachable and breakable parts can be gone, so they neither hide anything nor get changed.
+# meshes with variant flags are drawn only instead of other meshes
+VARIANT_FLAGS = lod.ALL_LOD_FLAGS | p3d.DAMAGED_FLAG | p3d.LOOSE_FLAGS
+# ray origins are moved off the surface by this distance
+RAY_OFFSET = 1e-4
+# samples are moved from the corners towards the center of the triangle by this fraction
+SAMPLE_INSET = 0.1
+
+def get_hemisphere(count):
+    # evenly spread directions around +z, from a fibonacci spiral
+    i = np.arange(count) + 0.5
+    z = 1.0 - i / count
+    r = np.sqrt(1.0 - z * z)
+    angle = math.pi * (3.0 - math.sqrt(5.0)) * i
+    return np.column_stack((r * np.cos(angle), r * np.sin(angle), z))
+
+def get_basis(normal):
+    # rotation from +z to normal, as rows of tangent, bitangent and normal
+    helper = np.array((1.0, 0.0, 0.0)) if abs(normal[0]) < 0.9 else np.array((0.0, 1.0, 0.0))
+    tangent = np.cross(helper, normal)
+    tangent /= np.linalg.norm(tangent)
+    return np.array((tangent, np.cross(normal, tangent), normal))
+
+def get_mesh_tris(m):
+    # triangles of a p3d mesh in model space, as a (polys, 3, 3) array
+    vertices = np.array([tuple(v) for v in m.vertices], dtype=np.float64).reshape(-1, 3) + np.array(tuple(m.pos))
+    tris = np.array([(pol.p1, pol.p2, pol.p3) for pol in m.polys], dtype=np.int64).reshape(-1, 3)
+    return vertices[tris]
+
+def get_occluders(meshes, i):
+    '''Returns indices of meshes always drawn together with meshes[i]: the mesh itself, meshes
+    without LOD, damaged, detachable or breakable flags, and for LOD meshes meshes of the same level'''
+    level = meshes[i].flags & lod.ALL_LOD_FLAGS
+    occluders = []
+    for j, m in enumerate(meshes):
+        variant = m.flags & VARIANT_FLAGS
+        if j == i or variant == 0 or (level and variant == level):
+            occluders.append(j)
+    return tuple(occluders)
+
+def build_tree(tris):
+    return BVHTree.FromPolygons([tuple(v) for v in tris.reshape(-1, 3).tolist()],
+                                [(i * 3, i * 3 + 1, i * 3 + 2) for i in range(len(tris))],
+                                all_triangles=True)
+
+def is_hidden(tree, corners, directions):
+    normal = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+    length = np.linalg.norm(normal)
+    # degenerate triangles have no visible area
+    if length == 0.0:
+        return True
+    normal /= length
+
+    center = corners.mean(axis=0)
+    samples = [center] + [c + (center - c) * SAMPLE_INSET for c in corners]
+    rays = directions @ get_basis(normal)
+
+    for sample in samples:
+        origin = Vector(sample + normal * RAY_OFFSET)
+        for ray in rays:
+            if tree.ray_cast(origin, Vector(ray))[0] is None:
+                return False
+    return True
+
+def find_hidden(tree, tris, directions):
+    return [i for i, corners in enumerate(tris) if is_hidden(tree, corners, directions)]
+
+def remove_polys(m, hidden, textures):
+    # drops polys with indices in hidden and vertices only they used
+    hidden = set(hidden)
+    m.polys = [pol for i, pol in enumerate(m.polys) if i not in hidden]
+
+    used = sorted({i for pol in m.polys for i in (pol.p1, pol.p2, pol.p3)})
+    new_index = {old: new for new, old in enumerate(used)}
+    m.vertices = [m.vertices[i] for i in used]
+    m.num_vertices = len(m.vertices)
+    for pol in m.polys:
+        pol.p1, pol.p2, pol.p3 = new_index[pol.p1], new_index[pol.p2], new_index[pol.p3]
+
+    m.sort_polys(textures)
+
+def remove_hidden_faces(meshes, textures, rays=32, transparent_textures=()):
+    '''Removes triangles which can't be seen from outside from visible meshes without shadow,
+    collision, detachable and breakable flags. Triangles are hidden only by meshes always drawn
+    together with their mesh, polys with transparent_textures hide nothing. Meshes which are hidden
+    completely are left without polys, except main mesh. Returns (mesh name, removed polys) of changed meshes'''
+    visible = [m for m in meshes if m.flags & p3d.VISIBLE_FLAG and m.polys]
+    if not visible:
+        return []
+
+    mesh_tris = [get_mesh_tris(m) for m in visible]
+    # triangles which rays can't pass through
+    opaque_tris = [tris[[pol.texture not in transparent_textures for pol in m.polys]]
+                   for m, tris in zip(visible, mesh_tris)]
+    directions = get_hemisphere(rays)
+
+    # ray casts hold the GIL, so triangles are checked one by one
+    trees = {}
+    removed = []
+    for i, (m, tris) in enumerate(zip(visible, mesh_tris)):
+        if m.flags & (KEEP_FLAGS | p3d.LOOSE_FLAGS):
+            continue
+
+        occluders = get_occluders(visible, i)
+        if occluders not in trees:
+            occluder_tris = np.concatenate([opaque_tris[j] for j in occluders])
+            trees[occluders] = build_tree(occluder_tris) if len(occluder_tris) else None
+        tree = trees[occluders]
+        if tree is None:
+            continue
+
+        hidden = find_hidden(tree, tris, directions)
+        # main mesh has to stay even when it is inside something else
+        if not hidden or (len(hidden) == len(tris) and m.flags & 1):
+            continue
+
+        remove_polys(m, hidden, textures)
+        removed.append((m.name, len(hidden)))
+
+    return removed
@@ -1,9 +1,12 @@
 import bpy 
+import os
+import struct
 
 from bpy.props import (
         BoolProperty,
         EnumProperty,
         FloatProperty,
+        IntProperty,
         StringProperty,
         )
 from bpy_extras.io_utils import (
@@ -13,12 +16,15 @@ from bpy_extras.io_utils import (
 
 from . import export_cdp3d
 from . import import_cdp3d
+from . import library
+from ..props.props import MESH_FLAG_ITEMS
 
 
 if 'bpy' in locals():
     import importlib
     importlib.reload(import_cdp3d)
     importlib.reload(export_cdp3d)
+    importlib.reload(library)
 
 class IMPORT_OT_cdcca(bpy.types.Operator, ImportHelper):
     bl_idname       = 'import_scene.cdcca'
@@ -43,9 +49,19 @@ class IMPORT_OT_cdp3d(bpy.types.Operator, ImportHelper):
     bl_options      = {'UNDO'}
 
     filename_ext    = '.p3d'
-    filter_glob     : StringProperty(default='*.p3d', 
+    filter_glob     : StringProperty(default='*.p3d;*.cpk', 
                                      options={'HIDDEN'})
 
+    # state of the modal import
+    _job            = None
+    _timer          = None
+
+    archive_entry   : StringProperty(
+        name        = 'Model in archive',
+        description = 'When a .cpk archive is selected, path of the model inside it, e.g. content/models/cars/buggy/buggy.p3d',
+        default     = ''
+    )
+
     use_edge_split_modifier : BoolProperty(
         name        = 'Use EdgeSplit, remove doubles',
         default     = True
@@ -62,11 +78,207 @@ class IMPORT_OT_cdp3d(bpy.types.Operator, ImportHelper):
         default     = True
     )
 
+    model_cache     : EnumProperty(
+        name        = 'Model cache',
+        description = 'Keep imported models in cached .blend files, so importing them again only loads the cached file',
+        items       = (
+            ('NONE',    'Off',      'Always read the model'),
+            ('APPEND',  'Append',   'Append the cached model, it can be edited like an imported one'),
+            ('LINK',    'Link',     'Link the cached model, it is read-only but uses the least memory')
+        ),
+        default     = 'NONE'
+    )
+
+    include_meshes  : StringProperty(
+        name        = 'Include meshes',
+        description = 'Comma separated mesh name patterns, e.g. main, body*. Only matching meshes are imported, empty imports every mesh',
+        default     = ''
+    )
+
+    exclude_meshes  : StringProperty(
+        name        = 'Exclude meshes',
+        description = 'Comma separated mesh name patterns, e.g. *lod*, *_dmg. Matching meshes are not imported',
+        default     = ''
+    )
+
+    required_flags  : EnumProperty(
+        name        = 'Required flags',
+        description = 'Only meshes with all of these flags are imported',
+        options     = {'ENUM_FLAG'},
+        items       = MESH_FLAG_ITEMS,
+        default     = set()
+    )
+
+    forbidden_flags : EnumProperty(
+        name        = 'Forbidden flags',
+        description = 'Meshes with any of these flags are not imported',
+        options     = {'ENUM_FLAG'},
+        items       = MESH_FLAG_ITEMS,
+        default     = set()
+    )
+
+    use_modal       : BoolProperty(
+        name        = 'Import in steps',
+        description = 'Build the model in small steps with a progress bar, so Blender stays responsive. Press Esc to cancel',
+        default     = True
+    )
+
+    def execute(self, context):
+        from . import import_cdp3d
+        keywords = self.as_keywords(ignore=('filter_glob', 'use_modal'))
+
+        # scripts and background mode have no window to run a modal operator in
+        if not self.use_modal or context.window is None:
+            return import_cdp3d.load(self, context, **keywords)
+
+        self._job = import_cdp3d.start_load(self, context, **keywords)
+        if self._job is None:
+            return {'CANCELLED'}
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, self._job.total)
+
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        from . import import_cdp3d
+
+        if event.type == 'ESC':
+            self.cancel(context)
+            self.report({'WARNING'}, 'Import cancelled')
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        if self._job.step(import_cdp3d.TIME_SLICE):
+            self.stop(context)
+            return {'FINISHED'}
+
+        context.window_manager.progress_update(self._job.done)
+        return {'RUNNING_MODAL'}
+
+    def stop(self, context):
+        wm = context.window_manager
+        if self._timer is not None:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+        wm.progress_end()
+
+    def cancel(self, context):
+        # also called by Blender when the operator is stopped from outside, e.g. when the file is closed
+        if self._timer is not None:
+            self._job.cancel()
+            self.stop(context)
+
+class IMPORT_OT_cdp3d_reload(bpy.types.Operator):
+    bl_idname       = 'import_scene.cdp3d_reload'
+    bl_label        = 'Reload P3D'
+    bl_description  = 'Reload changed meshes of the active collection from its source .p3d file'
+    bl_options      = {'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        col = context.view_layer.active_layer_collection.collection
+        return col.cdp3d.filepath != '' and col.library is None
+
+    def execute(self, context):
+        from . import import_cdp3d
+        col = context.view_layer.active_layer_collection.collection
+
+        try:
+            changed, added, removed = import_cdp3d.reload_model(col)
+        except (OSError, KeyError, ValueError, struct.error) as e:
+            self.report({'ERROR'}, 'Failed to reload {}: {}'.format(col.cdp3d.filepath, e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, '{} changed, {} added, {} removed meshes'.format(changed, added, removed))
+        return {'FINISHED'}
+
+class IMPORT_OT_cdp3d_clear_linked_cache(bpy.types.Operator):
+    bl_idname       = 'import_scene.cdp3d_clear_linked_cache'
+    bl_label        = 'Clear Linked Model Cache'
+    bl_description  = 'Remove cached models imported with Model cache set to Link, except the ones this file links. Other saved files linking them lose those models'
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_confirm(self, event)
+
+    def execute(self, context):
+        from . import import_cdp3d
+        removed = import_cdp3d.clear_linked_cache()
+        self.report({'INFO'}, 'Removed {} linked cached models'.format(removed))
+        return {'FINISHED'}
+
+class IMPORT_OT_cdp3d_library_refresh(bpy.types.Operator):
+    bl_idname       = 'import_scene.cdp3d_library_refresh'
+    bl_label        = 'Render Thumbnails'
+    bl_description  = 'Render missing thumbnails of models in the library folder in the background'
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.cdp3d_library.folder != '' and not library.is_rendering()
+
+    def execute(self, context):
+        folder = bpy.path.abspath(context.scene.cdp3d_library.folder)
+        if not os.path.isdir(folder):
+            self.report({'ERROR'}, 'Library folder {} does not exist'.format(folder))
+            return {'CANCELLED'}
+
+        library.render_thumbnails(folder)
+        return {'FINISHED'}
+
+class IMPORT_OT_cdp3d_library_import(bpy.types.Operator):
+    bl_idname       = 'import_scene.cdp3d_library_import'
+    bl_label        = 'Import Model'
+    bl_description  = 'Import the model selected in the library'
+    bl_options      = {'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.cdp3d_library.model != ''
+
+    def execute(self, context):
+        return import_cdp3d.load(self, context, filepath=context.scene.cdp3d_library.model)
+
+class IMPORT_OT_cdtrk(bpy.types.Operator, ImportHelper):
+    bl_idname       = 'import_scene.cdtrk'
+    bl_label        = 'Import TRK'
+    bl_description  = 'Import Crashday RE .trk track, every distinct tile model is imported once and placed as collection instances'
+    bl_options      = {'UNDO'}
+
+    filename_ext    = '.trk'
+    filter_glob     : StringProperty(default='*.trk', 
+                                     options={'HIDDEN'})
+
+    use_edge_split_modifier : BoolProperty(
+        name        = 'Use EdgeSplit, remove doubles',
+        default     = True
+    )
+
+    remove_doubles_distance : FloatProperty(
+        name        = 'Remove doubles distance',
+        default     = 0.00001
+    )
+
+    search_textures : BoolProperty(
+        name        = 'Search textures',
+        description = 'Tries to find texture folders and load correct textures for the tiles',
+        default     = True
+    )
+
+    import_height_map : BoolProperty(
+        name        = 'Import terrain',
+        description = 'Create a mesh of the track height map',
+        default     = True
+    )
+
     def execute(self, context):
         from . import import_cdp3d
         keywords = self.as_keywords(ignore=('filter_glob',))
 
-        return import_cdp3d.load(self, context, **keywords)
+        return import_cdp3d.load_trk(self, context, **keywords)
 
 class EXPORT_OT_cdcca(bpy.types.Operator, ExportHelper):
     bl_idname       = 'export_scene.cdcca'
@@ -133,6 +345,243 @@ class EXPORT_OT_cdp3d(bpy.types.Operator, ExportHelper):
         default     = False
     )
 
+    batch_mode      : BoolProperty(
+        name        = 'Batch export collections',
+        description = 'Export every child collection of the active collection into a separate <collection name>.p3d file in the selected folder',
+        default     = False
+    )
+
+    compact_geometry : BoolProperty(
+        name        = 'Compact geometry',
+        description = 'Weld vertices, remove degenerate and duplicate polygons and unused vertices. Hard edges of gouraud materials are kept',
+        default     = False
+    )
+
+    weld_distance : FloatProperty(
+        name        = 'Weld distance',
+        description = 'Vertices closer than this distance are welded when compacting geometry',
+        default     = 0.0001,
+        min         = 0.0
+    )
+
+    optimize_vertex_cache : BoolProperty(
+        name        = 'Optimize vertex cache',
+        description = 'Reorder triangles inside every texture and material run for better GPU vertex cache usage. Does not change how the model looks',
+        default     = False
+    )
+
+    optimize_overdraw : BoolProperty(
+        name        = 'Optimize overdraw',
+        description = 'When optimizing vertex cache, also draw outward facing triangle clusters first to reduce overdraw',
+        default     = False
+    )
+
+    generate_lods   : BoolProperty(
+        name        = 'Generate LODs',
+        description = 'Generate decimated LOD 2, 3 and 4 meshes for meshes with \'Generate LODs\' enabled in Crashday - Mesh panel',
+        default     = False
+    )
+
+    lod2_ratio      : FloatProperty(
+        name        = 'LOD 2 ratio',
+        description = 'Amount of polygons kept in LOD 2 mesh. 0 disables this level',
+        default     = 0.5,
+        min         = 0.0,
+        max         = 1.0
+    )
+
+    lod3_ratio      : FloatProperty(
+        name        = 'LOD 3 ratio',
+        description = 'Amount of polygons kept in LOD 3 mesh. 0 disables this level',
+        default     = 0.25,
+        min         = 0.0,
+        max         = 1.0
+    )
+
+    lod4_ratio      : FloatProperty(
+        name        = 'LOD 4 ratio',
+        description = 'Amount of polygons kept in LOD 4 mesh. 0 disables this level',
+        default     = 0.1,
+        min         = 0.0,
+        max         = 1.0
+    )
+
+    generate_shadow_mesh : BoolProperty(
+        name        = 'Generate shadow mesh',
+        description = 'If there is no \'mainshad\' mesh, generate a simplified one from the main mesh instead of using main mesh for shadows',
+        default     = False
+    )
+
+    shadow_mesh_polys : IntProperty(
+        name        = 'Shadow mesh polygons',
+        description = 'Maximum amount of polygons in generated shadow mesh',
+        default     = 500,
+        min         = 4
+    )
+
+    generate_collision_mesh : BoolProperty(
+        name        = 'Generate collision mesh',
+        description = 'If there is no \'maincoll\' mesh, generate a simplified one from the main mesh instead of using main mesh for collisions',
+        default     = False
+    )
+
+    collision_mesh_mode : EnumProperty(
+        name        = 'Collision mesh mode',
+        items       = (
+            ('HULL',        'Convex hull',  'Use a convex hull of the main mesh'),
+            ('DECIMATE',    'Decimate',     'Use a decimated main mesh, keeps concave shapes')
+        ),
+        default     = 'HULL'
+    )
+
+    collision_mesh_polys : IntProperty(
+        name        = 'Collision mesh polygons',
+        description = 'Maximum amount of polygons in generated collision mesh',
+        default     = 200,
+        min         = 4
+    )
+
+    use_texture_atlas : BoolProperty(
+        name        = 'Pack texture atlas',
+        description = 'Pack small textures which are not tiled into atlas .tga files saved into mod\'s textures folder, reduces draw calls',
+        default     = False
+    )
+
+    atlas_size      : EnumProperty(
+        name        = 'Atlas size',
+        items       = (
+            ('512',     '512',      '512x512 atlas'),
+            ('1024',    '1024',     '1024x1024 atlas'),
+            ('2048',    '2048',     '2048x2048 atlas')
+        ),
+        default     = '1024'
+    )
+
+    atlas_max_texture_size : IntProperty(
+        name        = 'Max packed texture size',
+        description = 'Only textures with both sides smaller or equal to this size are packed',
+        default     = 256,
+        min         = 1
+    )
+
+    remove_hidden_faces : BoolProperty(
+        name        = 'Remove hidden faces',
+        description = 'Remove polygons which can\'t be seen from outside of the model, e.g. faces inside other parts. LOD levels and damaged versions don\'t hide each other, shadow, collision, detachable and breakable meshes are not changed',
+        default     = False
+    )
+
+    hidden_face_rays : IntProperty(
+        name        = 'Hidden face rays',
+        description = 'Rays cast from every point of a polygon to check if it can be seen, more rays find small gaps',
+        default     = 32,
+        min         = 4,
+        max         = 256
+    )
+
+    split_sharp_edges : BoolProperty(
+        name        = 'Split sharp edges',
+        description = 'Make hard edges by splitting vertices on sharp edges and edges over the auto smooth angle. Edge Split modifiers are ignored while exporting',
+        default     = False
+    )
+
+    split_seams     : BoolProperty(
+        name        = 'Split seams',
+        description = 'Also make hard edges on UV seams when splitting sharp edges',
+        default     = False
+    )
+
+    chunk_mode      : EnumProperty(
+        name        = 'Chunk meshes',
+        description = 'Split big visible meshes into spatial chunks with their own bounds, so the game can cull parts of them',
+        items       = (
+            ('NONE',    'Off',      'Export every mesh as one submesh'),
+            ('GRID',    'Grid',     'Split meshes into horizontal grid cells'),
+            ('KD',      'K-d tree', 'Halve meshes along their longest axis until chunks are small enough')
+        ),
+        default     = 'NONE'
+    )
+
+    chunk_size      : FloatProperty(
+        name        = 'Chunk size',
+        description = 'Side of grid cells when chunking meshes with a grid',
+        default     = 10.0,
+        min         = 0.1
+    )
+
+    chunk_polys     : IntProperty(
+        name        = 'Chunk polygons',
+        description = 'Maximum amount of polygons in a chunk when chunking meshes with a k-d tree',
+        default     = 2000,
+        min         = 1
+    )
+
+    batch_static_meshes : BoolProperty(
+        name        = 'Batch small meshes',
+        description = 'Merge small meshes with the same flags which are close to each other into one mesh, reduces draw calls. Main, shadow, collision, LOD, detachable and breakable meshes are not merged',
+        default     = False
+    )
+
+    batch_max_polys : IntProperty(
+        name        = 'Batch polygons',
+        description = 'Maximum amount of polygons in a merged mesh, bigger meshes are not merged',
+        default     = 4000,
+        min         = 1
+    )
+
+    batch_cell_size : FloatProperty(
+        name        = 'Batch cell size',
+        description = 'Only meshes with centers in the same horizontal cell of this size are merged',
+        default     = 20.0,
+        min         = 0.1
+    )
+
+    export_dds      : BoolProperty(
+        name        = 'Export DDS textures',
+        description = 'Write used textures as DXT compressed .dds files with mipmaps into mod\'s textures folder. Textures which did not change are skipped',
+        default     = False
+    )
+
+    dry_run         : BoolProperty(
+        name        = 'Dry run',
+        description = 'Convert the model and create a performance report without writing the .p3d file',
+        default     = False
+    )
+
+    budget_mode     : EnumProperty(
+        name        = 'Budget check',
+        description = 'What to do when the model is over budget',
+        items       = (
+            ('WARN',    'Warn',     'Report problems but still export the model'),
+            ('FAIL',    'Fail',     'Do not export models which are over budget')
+        ),
+        default     = 'WARN'
+    )
+
+    budget_max_vertices : IntProperty(
+        name        = 'Max vertices per mesh',
+        default     = 65535,
+        min         = 1
+    )
+
+    budget_max_polys : IntProperty(
+        name        = 'Max polygons per mesh',
+        default     = 65535,
+        min         = 1
+    )
+
+    budget_max_draw_calls : IntProperty(
+        name        = 'Max draw calls per mesh',
+        description = 'Every texture and material type combination used by a mesh is a separate draw call',
+        default     = 32,
+        min         = 1
+    )
+
+    budget_max_texture_size : IntProperty(
+        name        = 'Max texture size',
+        default     = 1024,
+        min         = 1
+    )
+
     def execute(self, context):
         from . import export_cdp3d
 
@@ -0,0 +1,102 @@
+# Conversion worker of crashday/daemon.py, runs inside a background Blender:
+#   blender --background --factory-startup --python ops/worker.py -- <addon folder>
+# Registers the addon once, then reads JSON jobs from stdin, one per line.
+# Everything printed while a job runs is its log, the result of every job is a
+# single line starting with RESULT_PREFIX.
+
+import bpy
+import os
+import sys
+import json
+import importlib
+import traceback
+
+RESULT_PREFIX = 'CDP3D_RESULT '
+
+def register_addon(addon_folder):
+    sys.path.insert(0, os.path.dirname(addon_folder))
+    addon = importlib.import_module(os.path.basename(addon_folder))
+    addon.register()
+    return addon
+
+def reset_scene():
+    bpy.ops.wm.read_homefile(use_empty=True)
+
+def find_layer_collection(layer_collection, name):
+    if layer_collection.name == name:
+        return layer_collection
+    for child in layer_collection.children:
+        found = find_layer_collection(child, name)
+        if found is not None:
+            return found
+    return None
+
+def isolate_collection(name):
+    # exporter takes every visible object of the scene, so everything outside the collection is excluded
+    root = bpy.context.view_layer.layer_collection
+    target = find_layer_collection(root, name)
+    if target is None:
+        raise KeyError('Collection {} was not found'.format(name))
+
+    def exclude(layer_collection):
+        # returns True if target is inside layer_collection
+        if layer_collection == target:
+            return True
+        inside = False
+        for child in layer_collection.children:
+            if exclude(child):
+                inside = True
+            else:
+                child.exclude = True
+        return inside
+
+    exclude(root)
+    bpy.context.view_layer.active_layer_collection = target
+
+def run_import(job):
+    reset_scene()
+    options = dict(job.get('options', {}), use_modal=False)
+    result = bpy.ops.import_scene.cdp3d(filepath=job['input'], **options)
+    if 'FINISHED' not in result:
+        raise RuntimeError('Import failed: {}'.format(', '.join(result)))
+
+    output = job.get('output') or os.path.splitext(job['input'])[0] + '.blend'
+    bpy.ops.wm.save_as_mainfile(filepath=output)
+    return {'output': output}
+
+def run_export(job):
+    bpy.ops.wm.open_mainfile(filepath=job['input'])
+    if job.get('collection'):
+        isolate_collection(job['collection'])
+
+    output = job.get('output') or os.path.splitext(job['input'])[0] + '.p3d'
+    result = bpy.ops.export_scene.cdp3d(filepath=output, **job.get('options', {}))
+    if 'FINISHED' not in result:
+        raise RuntimeError('Export failed: {}'.format(', '.join(result)))
+    return {'output': output}
+
+JOBS = {
+    'import': run_import,
+    'export': run_export,
+}
+
+def main():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    register_addon(os.path.abspath(argv[0]))
+
+    print(RESULT_PREFIX + json.dumps({'ready': True}), flush=True)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        try:
+            job = json.loads(line)
+            result = JOBS[job['type']](job)
+            result['ok'] = True
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            result = {'ok': False, 'error': str(e)}
+
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+main()
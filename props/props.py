@@ -1,5 +1,7 @@
 import bpy
 
+from ..ops import library
+
 class CDP3DMaterialProps(bpy.types.PropertyGroup):
     use_texture     : bpy.props.BoolProperty (
         name        = 'Try using texture name',
@@ -51,87 +53,187 @@ class CDP3DLightProps(bpy.types.PropertyGroup):
     def register():
         bpy.types.Light.cdp3d = bpy.props.PointerProperty(type=CDP3DLightProps)
 
+# mesh flags saved in .p3d, values are the bits of the flags
+MESH_FLAG_ITEMS = (
+    ('MAIN', 'Main',
+    'Main mesh',
+    1 << 0),
+    ('VIS', 'Visible',
+    'Is visible', 
+    1 << 1),
+    ('TRACE', 'Tracing',
+    'Used to detect bullet hits, maybe shadows? This is used for cars',
+    1 << 2),
+    ('COLL', 'Collision',
+    'Is collision shape? This is used for cars',
+    1 << 3),
+    ('NOLOD', 'LOD 1 aka normal mesh',
+    'Level of detail 1. Used for default looking meshes',
+    1 << 4),
+    ('LOD0', 'LOD 0',
+    'Level of detail 0. Used for best looking mesh up-close',
+    1 << 5),
+    ('LOD2', 'LOD 2',
+    'Level of detail 2. Used for the first worse looking mesh',
+    1 << 6),
+    ('LOD3', 'LOD 3',
+    'Level of detail 3. Used for the second worst looking mesh',
+    1 << 7),
+    ('LOD4', 'LOD 4',
+    'Level of detail 4. Used for the worst looking mesh',
+    1 << 8),
+    ('SUB0', 'SUBMESH LOD 0',
+    '??????????????????????',
+    1 << 9),
+    ('SUB2', 'SUBMESH LOD 2',
+    '??????????????????????',
+    1 << 10),
+    ('SUB3', 'SUBMESH LOD 3',
+    '??????????????????????',
+    1 << 11),
+    ('SUB4', 'SUBMESH LOD 4',
+    '??????????????????????',
+    1 << 12),
+    ('DET', 'Detachable',
+    'Object can be lost from the car',
+    1 << 13),
+    ('BRG', 'Breakable glass',
+    '',
+    1 << 14),
+    ('BRP', 'Breakable plastic',
+    '',
+    1 << 15),
+    ('BRW', 'Breakable wood',
+    '',
+    1 << 16),
+    ('BRM', 'Breakable metal',
+    '',
+    1 << 17),
+    ('BRE', 'Breakable explosive',
+    '',
+    1 << 18),
+    ('LIPL', 'License plate',
+    '',
+    1 << 19),
+    ('HDL', 'Headlights',
+    '',
+    1 << 20),
+    ('BRL', 'Brakelights',
+    '',
+    1 << 21),
+    ('DMG', 'Damaged version',
+    'This object appears when some other object is getting damaged',
+    1 << 22),
+    ('NOCL', 'No collision',
+    'This object has no collisions with cars',
+    1 << 23),
+)
+
 class CDP3DMeshProps(bpy.types.PropertyGroup):
     flags           : bpy.props.EnumProperty(
         name        = 'Flags',
         description = 'Flags set for this mesh.',
         options     = {'ENUM_FLAG'},
-        items       = (
-            ('MAIN', 'Main',
-            'Main mesh',
-            1 << 0),
-            ('VIS', 'Visible',
-            'Is visible', 
-            1 << 1),
-            ('TRACE', 'Tracing',
-            'Used to detect bullet hits, maybe shadows? This is used for cars',
-            1 << 2),
-            ('COLL', 'Collision',
-            'Is collision shape? This is used for cars',
-            1 << 3),
-            ('NOLOD', 'LOD 1 aka normal mesh',
-            'Level of detail 1. Used for default looking meshes',
-            1 << 4),
-            ('LOD0', 'LOD 0',
-            'Level of detail 0. Used for best looking mesh up-close',
-            1 << 5),
-            ('LOD2', 'LOD 2',
-            'Level of detail 2. Used for the first worse looking mesh',
-            1 << 6),
-            ('LOD3', 'LOD 3',
-            'Level of detail 3. Used for the second worst looking mesh',
-            1 << 7),
-            ('LOD4', 'LOD 4',
-            'Level of detail 4. Used for the worst looking mesh',
-            1 << 8),
-            ('SUB0', 'SUBMESH LOD 0',
-            '??????????????????????',
-            1 << 9),
-            ('SUB2', 'SUBMESH LOD 2',
-            '??????????????????????',
-            1 << 10),
-            ('SUB3', 'SUBMESH LOD 3',
-            '??????????????????????',
-            1 << 11),
-            ('SUB4', 'SUBMESH LOD 4',
-            '??????????????????????',
-            1 << 12),
-            ('DET', 'Detachable',
-            'Object can be lost from the car',
-            1 << 13),
-            ('BRG', 'Breakable glass',
-            '',
-            1 << 14),
-            ('BRP', 'Breakable plastic',
-            '',
-            1 << 15),
-            ('BRW', 'Breakable wood',
-            '',
-            1 << 16),
-            ('BRM', 'Breakable metal',
-            '',
-            1 << 17),
-            ('BRE', 'Breakable explosive',
-            '',
-            1 << 18),
-            ('LIPL', 'License plate',
-            '',
-            1 << 19),
-            ('HDL', 'Headlights',
-            '',
-            1 << 20),
-            ('BRL', 'Brakelights',
-            '',
-            1 << 21),
-            ('DMG', 'Damaged version',
-            'This object appears when some other object is getting damaged',
-            1 << 22),
-            ('NOCL', 'No collision',
-            'This object has no collisions with cars',
-            1 << 23),
-        ),
+        items       = MESH_FLAG_ITEMS,
         default     = {'VIS'}
     )
 
+    generate_lods   : bpy.props.BoolProperty(
+        name        = 'Generate LODs',
+        description = 'Generate decimated LOD meshes of this mesh on export, if enabled in export settings',
+        default     = False
+    )
+
+    # set on import, used to find meshes which changed in the source file
+    source_name     : bpy.props.StringProperty(
+        name        = 'Source mesh name',
+        options     = {'HIDDEN'}
+    )
+
+    source_hash     : bpy.props.StringProperty(
+        name        = 'Source mesh hash',
+        options     = {'HIDDEN'}
+    )
+
+    def register():
+        bpy.types.Mesh.cdp3d = bpy.props.PointerProperty(type=CDP3DMeshProps)
+
+class CDP3DCollectionProps(bpy.types.PropertyGroup):
+    filepath        : bpy.props.StringProperty(
+        name        = 'Source file',
+        description = 'File this model was imported from',
+        subtype     = 'FILE_PATH'
+    )
+
+    archive_entry   : bpy.props.StringProperty(
+        name        = 'Model in archive',
+        description = 'Path of the model inside a .cpk archive'
+    )
+
+    watch           : bpy.props.BoolProperty(
+        name        = 'Watch for changes',
+        description = 'Reload changed meshes when the source file changes on disk',
+        default     = False
+    )
+
+    # size and mtime of the source file when it was last read
+    source_stamp    : bpy.props.StringProperty(
+        options     = {'HIDDEN'}
+    )
+
+    use_edge_split_modifier : bpy.props.BoolProperty(
+        options     = {'HIDDEN'},
+        default     = True
+    )
+
+    remove_doubles_distance : bpy.props.FloatProperty(
+        options     = {'HIDDEN'},
+        default     = 0.00001
+    )
+
+    search_textures : bpy.props.BoolProperty(
+        options     = {'HIDDEN'},
+        default     = True
+    )
+
+    # import filter, reloading skips the same meshes
+    include_meshes  : bpy.props.StringProperty(
+        options     = {'HIDDEN'}
+    )
+
+    exclude_meshes  : bpy.props.StringProperty(
+        options     = {'HIDDEN'}
+    )
+
+    required_flags  : bpy.props.IntProperty(
+        options     = {'HIDDEN'},
+        default     = 0
+    )
+
+    forbidden_flags : bpy.props.IntProperty(
+        options     = {'HIDDEN'},
+        default     = 0
+    )
+
+    def register():
+        bpy.types.Collection.cdp3d = bpy.props.PointerProperty(type=CDP3DCollectionProps)
+
+class CDP3DLibraryProps(bpy.types.PropertyGroup):
+    folder          : bpy.props.StringProperty(
+        name        = 'Library folder',
+        description = 'Folder with .p3d models, subfolders are searched too',
+        subtype     = 'DIR_PATH'
+    )
+
+    filter          : bpy.props.StringProperty(
+        name        = 'Filter',
+        description = 'Only show models with this text in their path'
+    )
+
+    model           : bpy.props.EnumProperty(
+        name        = 'Model',
+        items       = library.get_items
+    )
+
     def register():
-        bpy.types.Mesh.cdp3d = bpy.props.PointerProperty(type=CDP3DMeshProps)
\ No newline at end of file
+        bpy.types.Scene.cdp3d_library = bpy.props.PointerProperty(type=CDP3DLibraryProps)
\ No newline at end of file
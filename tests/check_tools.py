@@ -0,0 +1,189 @@
+import os
+import sys
+import struct
+import tempfile
+
+# Checks of the Blender-free tools, only Python 3 and NumPy are needed.
+# Run it from the addon folder:
+#   python tests/check_tools.py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crashday import p3d
+from crashday import patch
+from crashday import convert
+from crashday import validate
+
+GRID = 6
+
+def make_mesh(name, flags, pos, textures):
+    # a grid of flat and gouraud triangles alternating between two textures
+    m = p3d.Mesh()
+    m.name = name
+    m.flags = flags
+    m.pos = list(pos)
+    m.vertices = [(x * 0.5 - 1.0, y * 0.5 - 1.0, (x * y) % 3 * 0.1) for y in range(GRID) for x in range(GRID)]
+    m.num_vertices = len(m.vertices)
+    for y in range(GRID - 1):
+        for x in range(GRID - 1):
+            a = y * GRID + x
+            for i, tri in enumerate(((a, a + 1, a + GRID), (a + 1, a + GRID + 1, a + GRID))):
+                pol = p3d.Polygon()
+                pol.p1, pol.p2, pol.p3 = tri
+                pol.texture = textures[(x + y) % 2]
+                pol.material = ('FLAT', 'GOURAUD')[i]
+                pol.u1, pol.v1 = x / GRID, y / GRID
+                pol.u2, pol.v2 = (x + 1) / GRID, y / GRID
+                pol.u3, pol.v3 = x / GRID, (y + 1) / GRID
+                m.polys.append(pol)
+    m.length, m.depth, m.height = 2.5, 2.5, 0.2
+    return m
+
+def make_model():
+    p = p3d.P3D()
+    p.textures = ['body', 'glass']
+    p.meshes = [make_mesh('main', 3, (0.0, 0.0, 0.0), p.textures),
+                make_mesh('door', 2, (1.0, 2.0, 0.5), p.textures[::-1])]
+    for m in p.meshes:
+        m.sort_polys(p.textures)
+
+    light = p3d.Light()
+    light.name = 'headlight'
+    light.pos = [1.0, 2.0, 3.0]
+    light.color = 0x123456
+    light.show_corona = False
+    p.lights = [light]
+
+    p.length, p.height, p.depth = 5.0, 1.0, 5.0
+    p.num_textures = len(p.textures)
+    p.num_lights = len(p.lights)
+    p.num_meshes = len(p.meshes)
+    return p
+
+def write_model(path):
+    with open(path, 'wb') as file:
+        make_model().write(file)
+
+def read_model(path):
+    p = p3d.P3D()
+    with open(path, 'rb') as file:
+        p.read(file.read())
+    return p
+
+def get_corners(m):
+    # world positions, uvs, texture and material of every polygon corner, independent of vertex order
+    return sorted(tuple(round(m.vertices[v][i] + m.pos[i], 4) for i in range(3)) + (round(u, 4), round(v_, 4), pol.texture, pol.material)
+                  for pol in m.polys for v, u, v_ in ((pol.p1, pol.u1, pol.v1), (pol.p2, pol.u2, pol.v2), (pol.p3, pol.u3, pol.v3)))
+
+def check_convert(folder):
+    src = os.path.join(folder, 'model.p3d')
+    write_model(src)
+    original = read_model(src)
+
+    for ext in ('glb', 'obj'):
+        converted = os.path.join(folder, 'model.' + ext)
+        back = os.path.join(folder, 'model_{}.p3d'.format(ext))
+        convert.convert(src, converted)
+        convert.convert(converted, back)
+        assert validate.validate_file(back) == [], ext
+
+        p = read_model(back)
+        assert sorted(p.textures) == sorted(original.textures), ext
+        assert [(m.name, m.flags) for m in p.meshes] == [(m.name, m.flags) for m in original.meshes], ext
+        for a, b in zip(original.meshes, p.meshes):
+            assert get_corners(a) == get_corners(b), (ext, a.name)
+        assert [(l.name, l.color, l.show_corona) for l in p.lights] == [(l.name, l.color, l.show_corona) for l in original.lights], ext
+        assert [round(v, 4) for v in p.lights[0].pos] == original.lights[0].pos, ext
+
+def check_patch(folder):
+    path = os.path.join(folder, 'patched.p3d')
+    write_model(path)
+    original = read_model(path)
+
+    with patch.P3DPatcher(path) as patcher:
+        assert patcher.set_mesh_flags('d*', add=p3d.get_flag_mask(('NOCL',))) == 1
+        assert patcher.set_light('*', range=4.0, color=0xffcc00) == 1
+        # same length is patched in place, a longer name rewrites the file
+        assert patcher.rename_textures({'BODY': 'skin'}) == 1
+        assert patcher.rename_textures({'glass': 'windshield'}) == 1
+        assert patcher.rename_textures({'missing': 'other'}) == 0
+        assert patcher.get_mesh_flags('door') == 2 | p3d.get_flag_mask(('NOCL',))
+
+    assert not [name for name in os.listdir(folder) if name.startswith('tmp')]
+    assert validate.validate_file(path) == []
+
+    p = read_model(path)
+    assert p.textures == ['skin', 'windshield']
+    assert [m.flags for m in p.meshes] == [3, 2 | p3d.get_flag_mask(('NOCL',))]
+    assert (p.lights[0].range, p.lights[0].color) == (4.0, 0xffcc00)
+    names = {'body': 'skin', 'glass': 'windshield'}
+    for a, b in zip(original.meshes, p.meshes):
+        assert [(c[:5], names[c[5]], c[6]) for c in get_corners(a)] == [(c[:5], c[5], c[6]) for c in get_corners(b)]
+
+    # renaming back restores the original file
+    with patch.P3DPatcher(path) as patcher:
+        patcher.set_mesh_flags('door', flags=2)
+        patcher.set_light('*', range=original.lights[0].range, color=original.lights[0].color)
+        patcher.rename_textures({'skin': 'body', 'windshield': 'glass'})
+    unchanged = os.path.join(folder, 'unchanged.p3d')
+    write_model(unchanged)
+    with open(path, 'rb') as a, open(unchanged, 'rb') as b:
+        assert a.read() == b.read()
+
+def check_validate(folder):
+    path = os.path.join(folder, 'model.p3d')
+    write_model(path)
+    with open(path, 'rb') as file:
+        data = file.read()
+    assert validate.validate(data) == []
+
+    layout = patch.scan_layout(data)
+    name, header, infos = layout.meshes[0]
+    vertices = infos + p3d.TEXTURE_INFO_SIZE * len(layout.textures) + 2
+    polys = vertices + p3d.VERTEX_SIZE * GRID * GRID + 2
+
+    # every truncated file is broken and errors point into the file
+    for size in range(0, len(data), 7):
+        errors = validate.validate(data[:size])
+        assert errors, size
+        assert all(0 <= offset <= size for offset, message in errors), (size, errors)
+
+    # vertex array cut in the middle is reported where the vertices start
+    errors = validate.validate(data[:vertices + 5])
+    assert errors == [(vertices, errors[0][1])] and 'needs' in errors[0][1], errors
+
+    # NaN coordinate of the third vertex
+    broken = bytearray(data)
+    struct.pack_into('<f', broken, vertices + 2 * p3d.VERTEX_SIZE + 4, float('nan'))
+    assert validate.validate(bytes(broken)) == [(vertices + 2 * p3d.VERTEX_SIZE + 4, 'Mesh main vertices has 1 NaN or infinite values')]
+
+    # vertex index of the fifth polygon over num_vertices
+    broken = bytearray(data)
+    struct.pack_into('<H', broken, polys + 4 * p3d.POLYGON_SIZE, GRID * GRID)
+    errors = validate.validate(bytes(broken))
+    assert [offset for offset, message in errors] == [polys + 4 * p3d.POLYGON_SIZE], errors
+
+    # second texture info starting one polygon late leaves a gap
+    broken = bytearray(data)
+    start = struct.unpack_from('<H', data, infos + p3d.TEXTURE_INFO_SIZE)[0]
+    struct.pack_into('<H', broken, infos + p3d.TEXTURE_INFO_SIZE, start + 1)
+    errors = validate.validate(bytes(broken))
+    assert [offset for offset, message in errors] == [infos + p3d.TEXTURE_INFO_SIZE], errors
+
+    # broken tag of the first mesh, SUBMESH and its size come before the name
+    tag = header - len(name) - 1 - 4 - 7
+    broken = bytearray(data)
+    broken[tag:tag + 7] = b'XXXXXXX'
+    assert validate.validate(bytes(broken)) == [(tag, 'Missing SUBMESH tag')]
+
+CHECKS = (check_convert, check_patch, check_validate)
+
+def main():
+    for check in CHECKS:
+        with tempfile.TemporaryDirectory() as folder:
+            check(folder)
+        print('{}: ok'.format(check.__name__))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())